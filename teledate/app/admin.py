@@ -0,0 +1,448 @@
+"""
+Teledate database maintenance.
+
+All the commands run on one event loop with one engine per shard, the bulk
+ones work in batches of users or records with a transaction per batch.
+
+Usage:
+    python teledate/app/admin.py stats
+    python teledate/app/admin.py prune --limit 30
+    python teledate/app/admin.py orphans
+    python teledate/app/admin.py vacuum
+    python teledate/app/admin.py reindex
+    python teledate/app/admin.py export records.csv
+    python teledate/app/admin.py events events.jsonl
+    python teledate/app/admin.py rebalance
+    python teledate/app/admin.py quota
+    python teledate/app/admin.py rollups
+    python teledate/app/admin.py users
+    python teledate/app/admin.py migrate
+    python teledate/app/admin.py --tenant 123456 quota
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+from pathlib import Path
+
+import database as db
+import migrations
+from sqlalchemy import bindparam, delete, func, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+BATCH_SIZE = 1000
+
+# Maintenance statements by the dialect name
+VACUUM = {
+    'sqlite': ['VACUUM', 'ANALYZE'],
+    'mysql': ['OPTIMIZE TABLE {table}', 'ANALYZE TABLE {table}'],
+}
+REINDEX = {
+    'sqlite': ['REINDEX {table}'],
+    'mysql': ['ALTER TABLE {table} FORCE'],
+}
+
+
+def progress(shard: db.Shard, message: str, started: float) -> None:
+    """Print the progress of the shard operation."""
+    print(
+        f'Shard {shard.index}: {message} '
+        f'({time.perf_counter() - started:.1f} sec)',
+        flush=True,
+    )
+
+
+async def get_user_batches(shard: db.Shard, batch_size: int):
+    """Get the shard user IDs batches ordered by ID."""
+    last_id = 0
+    while True:
+        async with shard.engine.connect() as conn:
+            user_ids: list[int] = (
+                await conn.scalars(
+                    select(db.User.id)
+                    .where(db.User.id > last_id)
+                    .order_by(db.User.id)
+                    .limit(batch_size),
+                )
+            ).all()
+        if not user_ids:
+            return
+        last_id = user_ids[-1]
+        yield user_ids
+
+
+async def users(args: argparse.Namespace) -> None:
+    """Print the tenant's users of all shards."""
+    for user_id, name in await db.get_users_list():
+        print(user_id, name)
+
+
+async def stats(args: argparse.Namespace) -> None:
+    """Print the number of users, activities and records of each shard."""
+    for shard in db.shards:
+        async with shard.engine.connect() as conn:
+            users_count = await conn.scalar(
+                select(func.count()).select_from(db.User),
+            )
+            activities_count = await conn.scalar(
+                select(func.count()).select_from(db.Activity),
+            )
+            records_count, first_date, last_date = (
+                await conn.execute(
+                    select(
+                        func.count(),
+                        func.min(db.Record.date),
+                        func.max(db.Record.date),
+                    ),
+                )
+            ).one()
+            per_user = (
+                select(func.count().label('records'))
+                .select_from(db.Record)
+                .group_by(db.Record.user_id)
+                .subquery()
+            )
+            max_records = await conn.scalar(
+                select(func.max(per_user.c.records)),
+            )
+        print(
+            f'Shard {shard.index}: {users_count} users, '
+            f'{activities_count} activities, {records_count} records '
+            f'(max {max_records or 0} per user, '
+            f'{users_count and records_count / users_count:.1f} average), '
+            f'from {first_date} to {last_date}',
+        )
+
+
+async def delete_records(
+    shard: db.Shard,
+    conn: AsyncConnection,
+    rows: list,
+) -> None:
+    """Delete the selected records with their events in the transaction."""
+    await conn.execute(
+        delete(db.Record).where(db.Record.id.in_([row.id for row in rows])),
+    )
+    await conn.execute(
+        insert(db.Event),
+        db.get_records_deleted_events(shard.index, rows),
+    )
+
+
+async def prune(args: argparse.Namespace) -> None:
+    """Delete the oldest records beyond the limit of each user's activity."""
+    ranked = (
+        select(
+            db.Record.id,
+            db.Record.user_id,
+            db.Record.activity_id,
+            db.Record.date,
+            func.row_number()
+            .over(
+                partition_by=(db.Record.user_id, db.Record.activity_id),
+                order_by=(db.Record.date.desc(), db.Record.id.desc()),
+            )
+            .label('position'),
+        )
+        .where(
+            db.Record.user_id.between(
+                bindparam('first_id'),
+                bindparam('last_id'),
+            ),
+        )
+        .subquery()
+    )
+    prune_batch = (
+        select(
+            ranked.c.id,
+            ranked.c.user_id,
+            ranked.c.activity_id,
+            ranked.c.date,
+            db.User.tenant,
+        )
+        .join(db.User, ranked.c.user_id == db.User.id)
+        .where(ranked.c.position > bindparam('limit'))
+        .order_by(
+            ranked.c.user_id,
+            ranked.c.activity_id,
+            ranked.c.date,
+            ranked.c.id,
+        )
+    )
+    for shard in db.shards:
+        started = time.perf_counter()
+        checked = deleted = 0
+        async for user_ids in get_user_batches(shard, args.batch_size):
+            async with shard.engine.begin() as conn:
+                rows = (
+                    await conn.execute(
+                        prune_batch,
+                        {
+                            'first_id': user_ids[0],
+                            'last_id': user_ids[-1],
+                            'limit': args.limit,
+                        },
+                    )
+                ).all()
+                if rows:
+                    await delete_records(shard, conn, rows)
+            checked += len(user_ids)
+            deleted += len(rows)
+            progress(
+                shard,
+                f'{checked} users checked, {deleted} records deleted',
+                started,
+            )
+        if deleted:
+            await rebuild_shard_rollups(shard, args.batch_size)
+
+
+async def orphans(args: argparse.Namespace) -> None:
+    """Delete the records and the activities of the deleted users."""
+    orphan_ids = (
+        select(db.Record.id)
+        .outerjoin(db.User, db.Record.user_id == db.User.id)
+        .outerjoin(db.Activity, db.Record.activity_id == db.Activity.id)
+        .where(
+            (db.User.id.is_(None))
+            | (db.Record.activity_id.is_not(None) & db.Activity.id.is_(None)),
+        )
+        .order_by(db.Record.id)
+        .limit(bindparam('batch_size'))
+        .subquery()
+    )
+    orphan_records = (
+        select(
+            db.Record.id,
+            db.Record.user_id,
+            db.Record.activity_id,
+            db.Record.date,
+            db.User.tenant,
+        )
+        .join(orphan_ids, db.Record.id == orphan_ids.c.id)
+        .outerjoin(db.User, db.Record.user_id == db.User.id)
+        .order_by(
+            db.Record.user_id,
+            db.Record.activity_id,
+            db.Record.date,
+            db.Record.id,
+        )
+    )
+    orphan_activities = delete(db.Activity).where(
+        db.Activity.user_id.not_in(select(db.User.id)),
+    )
+    for shard in db.shards:
+        started = time.perf_counter()
+        deleted = 0
+        while True:
+            async with shard.engine.begin() as conn:
+                rows = (
+                    await conn.execute(
+                        orphan_records,
+                        {'batch_size': args.batch_size},
+                    )
+                ).all()
+                if rows:
+                    await delete_records(shard, conn, rows)
+            if not rows:
+                break
+            deleted += len(rows)
+            progress(shard, f'{deleted} orphan records deleted', started)
+        async with shard.engine.begin() as conn:
+            result = await conn.execute(orphan_activities)
+        progress(
+            shard,
+            f'{deleted} orphan records, {result.rowcount} orphan activities '
+            'deleted',
+            started,
+        )
+        if deleted:
+            await rebuild_shard_rollups(shard, args.batch_size)
+
+
+async def run_maintenance(statements: dict[str, list[str]]) -> None:
+    """Run the dialect maintenance statements on each table of each shard."""
+    for shard in db.shards:
+        dialect_statements = statements.get(shard.engine.dialect.name)
+        if dialect_statements is None:
+            print(f'Shard {shard.index}: not supported, skipped')
+            continue
+        started = time.perf_counter()
+        tables = [table.name for table in db.Base.metadata.sorted_tables]
+        # VACUUM can't run inside a transaction
+        async with shard.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            for statement in dialect_statements:
+                for table in tables if '{table}' in statement else [None]:
+                    sql = statement.format(table=table)
+                    await conn.execute(text(sql))
+                    progress(shard, sql, started)
+
+
+async def vacuum(args: argparse.Namespace) -> None:
+    """Compact the tables and update the query planner statistics."""
+    await run_maintenance(VACUUM)
+
+
+async def reindex(args: argparse.Namespace) -> None:
+    """Rebuild the indexes of all tables."""
+    await run_maintenance(REINDEX)
+
+
+async def export(args: argparse.Namespace) -> None:
+    """Stream all the records of all shards to the CSV file."""
+    records = (
+        select(
+            db.User.name,
+            func.coalesce(db.Activity.name, db.User.activity),
+            db.Record.date,
+        )
+        .join(db.User, db.Record.user_id == db.User.id)
+        .outerjoin(db.Activity, db.Record.activity_id == db.Activity.id)
+        .order_by(db.Record.id)
+        .execution_options(yield_per=args.batch_size)
+    )
+    with args.output.open('w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(['user', 'activity', 'date'])
+        for shard in db.shards:
+            started = time.perf_counter()
+            exported = 0
+            async with shard.replica_engine.connect() as conn:
+                result = await conn.stream(records)
+                async for rows in result.partitions():
+                    writer.writerows(rows)
+                    exported += len(rows)
+                    progress(shard, f'{exported} records exported', started)
+
+
+async def events(args: argparse.Namespace) -> None:
+    """Append the change events after the saved cursor to the JSONL file."""
+    cursor_path: Path = args.cursor or args.output.with_suffix('.cursor')
+    cursor = None
+    if cursor_path.exists():
+        cursor = json.loads(cursor_path.read_text())
+    started = time.perf_counter()
+    exported = 0
+    with args.output.open('a') as output:
+        async for cursor, batch in db.iter_events(cursor, args.batch_size):
+            for event in batch:
+                output.write(json.dumps(event, default=str) + '\n')
+            output.flush()
+            # Saved after the batch is written, a failed export repeats it
+            cursor_path.write_text(json.dumps(cursor))
+            exported += len(batch)
+            print(
+                f'{exported} events exported, cursor {cursor} '
+                f'({time.perf_counter() - started:.1f} sec)',
+                flush=True,
+            )
+
+
+async def rebalance(args: argparse.Namespace) -> None:
+    """Move the users to their shards after adding shards."""
+    started = time.perf_counter()
+    moved = await db.rebalance_shards(
+        args.batch_size,
+        lambda shard, last_id: progress(
+            shard,
+            f'users checked up to ID {last_id}',
+            started,
+        ),
+    )
+    print(f'Moved users: {moved}')
+
+
+async def rebuild_shard_rollups(shard: db.Shard, batch_size: int) -> None:
+    """Count the dashboard rollups of the shard from the records again."""
+    started = time.perf_counter()
+    records = await db.rebuild_rollups(shard, batch_size)
+    progress(shard, f'rollups of {records} records rebuilt', started)
+
+
+async def rollups(args: argparse.Namespace) -> None:
+    """Rebuild the dashboard rollups from the records."""
+    for shard in db.shards:
+        await rebuild_shard_rollups(shard, args.batch_size)
+
+
+async def migrate(args: argparse.Namespace) -> None:
+    """Print the schema version of each shard, migrated on the start."""
+    for shard in db.shards:
+        async with shard.engine.connect() as conn:
+            version = await conn.run_sync(migrations.get_version)
+        applied = args.applied.get(shard.index)
+        print(
+            f'Shard {shard.index}: schema version {version}'
+            + (f', applied {applied}' if applied else ', up to date'),
+        )
+
+
+async def quota(args: argparse.Namespace) -> None:
+    """Set the tenant's users quota counter to the number of users."""
+    print(f'Users: {await db.sync_users_quota()} of {db.USER_LIMIT}')
+
+
+async def run(args: argparse.Namespace) -> None:
+    """Run the command with the database engines."""
+    db.init_engine()
+    db.current_tenant.set(args.tenant)
+    try:
+        args.applied = await db.init_models()
+        await args.command(args)
+    finally:
+        await db.dispose_engine()
+
+
+def main() -> int:
+    """Parse the arguments and run the command."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        '--tenant',
+        default=db.DEFAULT_TENANT,
+        help='bot ID of the hosted bot for the users and quota commands',
+    )
+    commands = parser.add_subparsers(required=True)
+    for command in (
+        users,
+        stats,
+        orphans,
+        vacuum,
+        reindex,
+        rebalance,
+        quota,
+        rollups,
+        migrate,
+    ):
+        commands.add_parser(
+            command.__name__,
+            help=command.__doc__,
+        ).set_defaults(command=command)
+    prune_parser = commands.add_parser('prune', help=prune.__doc__)
+    prune_parser.add_argument(
+        '--limit',
+        type=int,
+        default=db.RECORDS_LIMIT,
+        help='records to keep for each user activity',
+    )
+    prune_parser.set_defaults(command=prune)
+    export_parser = commands.add_parser('export', help=export.__doc__)
+    export_parser.add_argument('output', type=Path)
+    export_parser.set_defaults(command=export)
+    events_parser = commands.add_parser('events', help=events.__doc__)
+    events_parser.add_argument('output', type=Path)
+    events_parser.add_argument(
+        '--cursor',
+        type=Path,
+        help='cursor file, the output with the .cursor suffix by default',
+    )
+    events_parser.set_defaults(command=events)
+    asyncio.run(run(parser.parse_args()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
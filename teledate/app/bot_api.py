@@ -0,0 +1,93 @@
+"""
+Bot API HTTP clients.
+
+The long polling getUpdates call and the outbound calls (replies, reminders)
+use separate connection pools, so a bulk of reminder sends never waits for
+the polling connection and polling never waits for a free connection. The
+bots hosted in one process share the outbound pool.
+"""
+import asyncio
+
+import httpx
+from decouple import config
+from telegram.request import HTTPXRequest
+
+# Outbound calls connections, kept alive up to the pool size
+API_POOL_SIZE = config('API_POOL_SIZE', default=16, cast=int)
+# Seconds an idle connection is kept alive
+API_KEEPALIVE = config('API_KEEPALIVE', default=60.0, cast=float)
+# Seconds to wait for a free connection of the pool
+API_POOL_TIMEOUT = config('API_POOL_TIMEOUT', default=10.0, cast=float)
+API_TIMEOUT = config('API_TIMEOUT', default=10.0, cast=float)
+# Needs `pip install "python-telegram-bot[http2]"`
+API_HTTP2 = config('API_HTTP2', default=False, cast=bool)
+
+
+class PooledRequest(HTTPXRequest):
+    """
+    HTTPX request with the calls in flight limited to the pool size.
+
+    The waiting calls queue on a semaphore instead of the httpcore pool, which
+    scans all its waiting requests on every connection release, so a bulk of
+    sends doesn't slow down quadratically.
+
+    The request can be shared by several bots, the connections are closed on
+    the shutdown of the last one.
+    """
+
+    def __init__(self, connection_pool_size: int, **kwargs) -> None:
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+        self._in_flight = asyncio.Semaphore(connection_pool_size)
+        self._users = 0
+
+    async def initialize(self) -> None:
+        """Open the connection pool for one more bot."""
+        self._users += 1
+        await super().initialize()
+
+    async def shutdown(self) -> None:
+        """Close the connection pool, if no other bot uses it."""
+        self._users = max(self._users - 1, 0)
+        if not self._users:
+            await super().shutdown()
+
+    async def do_request(self, *args, **kwargs) -> tuple[int, bytes]:
+        """Make the call once a pool connection is free."""
+        async with self._in_flight:
+            return await super().do_request(*args, **kwargs)
+
+
+def create_request(
+    pool_size: int = API_POOL_SIZE,
+    keepalive: float = API_KEEPALIVE,
+    pool_timeout: float = API_POOL_TIMEOUT,
+    timeout: float = API_TIMEOUT,
+    http2: bool = API_HTTP2,
+) -> PooledRequest:
+    """Create the Bot API request with the tuned connection pool."""
+    return PooledRequest(
+        connection_pool_size=pool_size,
+        read_timeout=timeout,
+        write_timeout=timeout,
+        connect_timeout=timeout,
+        pool_timeout=pool_timeout,
+        http_version='2' if http2 else '1.1',
+        httpx_kwargs={
+            # httpx keeps only 20 idle connections alive by default
+            'limits': httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive,
+            ),
+        },
+    )
+
+
+def create_updates_request() -> PooledRequest:
+    """
+    Create the getUpdates request.
+
+    One connection is enough for the long polling, the polling timeout is
+    added to the read timeout by the bot.
+    """
+    return create_request(pool_size=1)
@@ -0,0 +1,174 @@
+"""
+Capture of the incoming updates for the replay.
+
+Updates are appended to the capture file as compact JSON lines with the
+seconds since the capture start. User and chat IDs and usernames are replaced
+with keyed hashes, names and other personal fields are dropped. The lines are
+put on a queue and written by the writer thread, so the event loop doesn't
+wait for the disk and the compression.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from pathlib import Path
+from queue import SimpleQueue
+from typing import IO
+
+from decouple import config
+from telegram import Update
+from telegram.ext import ContextTypes
+
+# Capture file path, `.gz` to compress, empty to disable the capture
+CAPTURE_FILE = config('CAPTURE_FILE', default='')
+# Hash key, a random one makes the captures of different runs unlinkable
+CAPTURE_KEY = config('CAPTURE_KEY', default='') or secrets.token_hex(16)
+
+# Keys of the users and the chats, or the lists of them
+PERSON_KEYS = {
+    'from',
+    'chat',
+    'user',
+    'sender_chat',
+    'sender_user',
+    'left_chat_member',
+    'via_bot',
+    'new_chat_members',
+}
+# Fields dropped at any level of the update
+PERSONAL_FIELDS = {
+    'last_name',
+    'title',
+    'bio',
+    'phone_number',
+    'language_code',
+    'photo',
+    'contact',
+}
+
+
+class UpdateRecorder:
+    """Append the anonymized updates to the capture file."""
+
+    def __init__(self, path: Path, key: str = CAPTURE_KEY) -> None:
+        self.path = path
+        self.key = key.encode()
+        self.started = time.monotonic()
+        self._file: IO[str] | None = None
+        # Captured lines, None stops the writer
+        self._lines: SimpleQueue[str | None] = SimpleQueue()
+        self._writer: threading.Thread | None = None
+
+    def open(self) -> None:
+        """Open the capture file for appending and start the writer."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.suffix == '.gz':
+            self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        else:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._writer = threading.Thread(
+            target=self._write,
+            args=(self._file,),
+            name='capture',
+        )
+        self._writer.start()
+
+    def close(self) -> None:
+        """Write the queued lines and close the capture file."""
+        if self._file is None:
+            return
+        self._lines.put(None)
+        self._writer.join()
+        self._file.close()
+        self._file = self._writer = None
+
+    def _write(self, file: IO[str]) -> None:
+        """Write the queued lines to the file until the recorder is closed."""
+        while (line := self._lines.get()) is not None:
+            file.write(line)
+
+    def anonymize_id(self, value: int) -> int:
+        """Get the stable positive integer in place of the ID."""
+        digest = hmac.new(self.key, str(value).encode(), hashlib.sha256)
+        return int.from_bytes(digest.digest()[:6], 'big') or 1
+
+    def anonymize_username(self, value: str) -> str:
+        """Get the stable alphanumeric username in place of the username."""
+        digest = hmac.new(self.key, value.encode(), hashlib.sha256)
+        return f'u{digest.hexdigest()[:15]}'
+
+    def anonymize_person(self, value: object) -> object:
+        """Replace the name, the ID and the username of the user or chat."""
+        if not isinstance(value, dict):
+            return value
+        value = dict(value)
+        if 'first_name' in value:
+            value['first_name'] = 'User'
+        if 'id' in value:
+            value['id'] = self.anonymize_id(value['id'])
+        if value.get('username'):
+            value['username'] = self.anonymize_username(value['username'])
+        return value
+
+    def anonymize(self, data: object) -> object:
+        """Replace the personal data in the update dictionary."""
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for key, value in data.items():
+            if key in PERSONAL_FIELDS:
+                continue
+            if key in PERSON_KEYS:
+                value = (
+                    [self.anonymize_person(item) for item in value]
+                    if isinstance(value, list)
+                    else self.anonymize_person(value)
+                )
+            elif key == 'user_id' and isinstance(value, int):
+                value = self.anonymize_id(value)
+            elif key == 'sender_user_name' and isinstance(value, str):
+                # The name of the user hiding the forwards' origin
+                value = self.anonymize_username(value)
+            result[key] = self.anonymize(value)
+        return result
+
+    def record(self, update: Update) -> None:
+        """Append the anonymized update to the capture file."""
+        if self._file is None:
+            return
+        line = json.dumps(
+            {
+                't': round(time.monotonic() - self.started, 3),
+                'u': self.anonymize(update.to_dict()),
+            },
+            ensure_ascii=False,
+            separators=(',', ':'),
+        )
+        self._lines.put(line + '\n')
+
+
+RECORDER = UpdateRecorder(Path(CAPTURE_FILE)) if CAPTURE_FILE else None
+
+
+async def capture_update(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> None:
+    """Capture the incoming update before it's handled."""
+    if RECORDER is not None:
+        RECORDER.record(update)
+
+
+def read_capture(path: Path):
+    """Iterate the captured seconds since the capture start and updates."""
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8') as capture:
+        for line in capture:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['t'], entry['u']
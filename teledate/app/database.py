@@ -1,65 +1,324 @@
 """Database settings and services."""
 import asyncio
+import bisect
 import datetime
+import hashlib
+import itertools
+import time
+from collections import Counter
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextvars import ContextVar
+from dataclasses import dataclass
 
-from decouple import config
+import migrations
+from decouple import Csv, config
 from sqlalchemy import (
+    BigInteger,
     CheckConstraint,
+    Column,
+    Connection,
+    Date,
     DateTime,
+    JSON,
     ForeignKey,
+    Index,
+    Integer,
     String,
+    Table,
+    bindparam,
+    case,
+    delete,
     engine,
     func,
+    insert,
+    literal,
     select,
+    union_all,
+    update,
 )
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.asyncio import (
     AsyncAttrs,
+    AsyncEngine,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.orm.exc import UnmappedInstanceError
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.elements import Case
+from sqlalchemy.sql.functions import FunctionElement
 
 DB_URL = config(
     'MYSQL_URL',
     default='sqlite+aiosqlite:///teledate/data/sqlite.db',
 )
-USER_LIMIT = 2
+# Database URLs of the shards, users are split between them by the username
+SHARD_URLS = config('SHARD_URLS', default=DB_URL, cast=Csv())
+# Read replica URLs in the order of the shards, empty for no replica
+REPLICA_URLS = config('REPLICA_URLS', default='', cast=Csv())
+# Seconds of reading the user's data from the primary after the user's write
+READ_YOUR_WRITES_WINDOW = config(
+    'READ_YOUR_WRITES_WINDOW',
+    default=5.0,
+    cast=float,
+)
+# Look the users up in all the shards, while the added shards aren't
+# rebalanced yet
+REBALANCING = config('REBALANCING', default=False, cast=bool)
+# Users of each tenant
+USER_LIMIT = config('USER_LIMIT', default=2, cast=int)
+# Quota counter row name of the users number, suffixed by the tenant ID
+USERS_QUOTA = 'users'
+# Tenant ID of the primary bot, the others' IDs are their bot IDs
+DEFAULT_TENANT = ''
+# Activities of a user besides the default one
+ACTIVITY_LIMIT = 10
 RECORDS_LIMIT = 30
+# Global user ID = shard index * offset + shard user ID, so the first shard's
+# user IDs are the same as without sharding
+SHARD_ID_OFFSET = 2**40
+VIRTUAL_NODES = 64
+# Upper bounds in hours of the intervals since the previous record of the
+# timeline, the last bucket is for the longer intervals
+INTERVAL_BUCKETS = (1, 6, 24, 48, 168)
+# Seconds the change events stay unread, so the events of the transactions
+# committed out of the event IDs order aren't skipped by the readers
+EVENTS_SETTLE_SECONDS = config(
+    'EVENTS_SETTLE_SECONDS',
+    default=5.0,
+    cast=float,
+)
+# Compiled statements cached per engine, shared by all sessions
+QUERY_CACHE_SIZE = config('QUERY_CACHE_SIZE', default=500, cast=int)
+
+
+# Sharding
+
+
+class HashRing:
+    """
+    Consistent hash ring of the shard indexes.
+
+    Adding a shard moves only the keys taken by the new shard's points.
+    """
+
+    def __init__(
+        self,
+        shards_number: int,
+        virtual_nodes: int = VIRTUAL_NODES,
+    ) -> None:
+        points = sorted(
+            (key_hash(f'shard-{shard}#{node}'), shard)
+            for shard in range(shards_number)
+            for node in range(virtual_nodes)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get(self, key: str) -> int:
+        """Get the shard index of the key."""
+        index = bisect.bisect(self._hashes, key_hash(key))
+        return self._shards[index % len(self._shards)]
+
+
+def key_hash(key: str) -> int:
+    """Get the stable 64-bit hash of the key."""
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def to_global_id(shard_index: int, local_id: int) -> int:
+    """Get the global user ID from the shard user ID."""
+    return shard_index * SHARD_ID_OFFSET + local_id
 
-async_engine = create_async_engine(DB_URL)
-# async_engine = create_async_engine(DB_URL, echo=True)
 
+@dataclass
+class Shard:
+    """Database shard engines and session factories."""
 
-async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(
-    async_engine,
-    class_=AsyncSession,
-    # autocommit=False,
-    expire_on_commit=False,
+    index: int
+    engine: AsyncEngine
+    session: async_sessionmaker[AsyncSession]
+    # The primary ones if there is no read replica
+    replica_engine: AsyncEngine
+    replica_session: async_sessionmaker[AsyncSession]
+
+    def read_session(self, *keys: int | str) -> AsyncSession:
+        """
+        Get a session for the read-only queries of the users.
+
+        The replica is used unless one of the user IDs or usernames was
+        written recently, so users always read their own writes.
+        """
+        now = time.monotonic()
+        if any(recent_writes.get(key, 0) > now for key in keys):
+            return self.session()
+        return self.replica_session()
+
+
+# Created by `init_engine` on app startup
+shards: list[Shard] = []
+ring: HashRing | None = None
+# The first shard
+async_engine: AsyncEngine | None = None
+async_session: async_sessionmaker[AsyncSession] | None = None
+# Read-your-writes deadlines by user ID and username
+recent_writes: dict[int | str, float] = {}
+# Tenant ID of the bot handling the current update
+current_tenant: ContextVar[str] = ContextVar(
+    'current_tenant',
+    default=DEFAULT_TENANT,
 )
 
 
+def create_session_factory(
+    url: str,
+    **engine_options,
+) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
+    """Create the database engine and its session factory."""
+    engine_options.setdefault('query_cache_size', QUERY_CACHE_SIZE)
+    new_engine = create_async_engine(url, **engine_options)
+    # new_engine = create_async_engine(url, echo=True)
+    return new_engine, async_sessionmaker(
+        new_engine,
+        class_=AsyncSession,
+        # autocommit=False,
+        expire_on_commit=False,
+    )
+
+
+def init_engine(
+    *urls: str,
+    replica_urls: list[str] | None = None,
+    **engine_options,
+) -> None:
+    """Create the engines and the session factories of the shards."""
+    global shards, ring, async_engine, async_session
+    urls = urls or SHARD_URLS
+    replica_urls = REPLICA_URLS if replica_urls is None else replica_urls
+    shards = []
+    for index, url in enumerate(urls):
+        shard_engine, shard_session = create_session_factory(
+            url,
+            **engine_options,
+        )
+        replica_engine, replica_session = shard_engine, shard_session
+        if index < len(replica_urls) and replica_urls[index]:
+            replica_engine, replica_session = create_session_factory(
+                replica_urls[index],
+                **engine_options,
+            )
+        shards.append(
+            Shard(
+                index=index,
+                engine=shard_engine,
+                session=shard_session,
+                replica_engine=replica_engine,
+                replica_session=replica_session,
+            ),
+        )
+    ring = HashRing(len(shards))
+    async_engine, async_session = shards[0].engine, shards[0].session
+    recent_writes.clear()
+
+
+async def dispose_engine() -> None:
+    """Close all the database engines connections on app shutdown."""
+    engines = {shard.engine for shard in shards}
+    engines |= {shard.replica_engine for shard in shards}
+    await asyncio.gather(*(shard_engine.dispose() for shard_engine in engines))
+
+
+def mark_written(*keys: int | str) -> None:
+    """Read the data of the user IDs or usernames from the primary for now."""
+    now = time.monotonic()
+    if len(recent_writes) > 10_000:
+        for key, deadline in list(recent_writes.items()):
+            if deadline <= now:
+                del recent_writes[key]
+    for key in keys:
+        recent_writes[key] = now + READ_YOUR_WRITES_WINDOW
+
+
+def get_user_shard(username: str) -> Shard:
+    """Get the shard of the username."""
+    return shards[ring.get(username)]
+
+
+def locate_user(user_id: int) -> tuple[Shard, int]:
+    """Get the shard and the shard user ID by the global user ID."""
+    shard_index, local_id = divmod(user_id, SHARD_ID_OFFSET)
+    if shard_index >= len(shards):
+        # Unknown shard, nothing will be found by the ID
+        return shards[0], 0
+    return shards[shard_index], local_id
+
+
 class Base(AsyncAttrs, DeclarativeBase):
     """Declarative base."""
 
 
 class User(Base):
-    """User model."""
+    """User model, the usernames are unique within the tenant."""
 
     __tablename__ = 'user_table'
     __table_args__ = (
         CheckConstraint(r"name REGEXP '^([a-zA-Z]|\s|\d){1,50}$'"),
         CheckConstraint(r"activity REGEXP '^([a-zA-Z]|\s|\d){1,50}$'"),
+        Index('ix_user_table_tenant_name', 'tenant', 'name', unique=True),
     )
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    name: Mapped[str] = mapped_column(String(50), unique=True, index=True)
+    tenant: Mapped[str] = mapped_column(
+        String(50),
+        default=DEFAULT_TENANT,
+        server_default=DEFAULT_TENANT,
+    )
+    name: Mapped[str] = mapped_column(String(50))
     activity: Mapped[str] = mapped_column(String(50), default='Default')
     records: Mapped[list['Record']] = relationship(
         back_populates='user',
         cascade='all, delete',
     )
+    activities: Mapped[list['Activity']] = relationship(
+        back_populates='user',
+        cascade='all, delete',
+    )
+    daily_records: Mapped[list['DailyUserRecords']] = relationship(
+        back_populates='user',
+        cascade='all, delete',
+    )
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return self.name
+
+
+class Activity(Base):
+    """User activity timeline model, besides the default user activity."""
+
+    __tablename__ = 'activity_table'
+    __table_args__ = (
+        CheckConstraint(r"name REGEXP '^([a-zA-Z]|\s|\d){1,50}$'"),
+        Index(
+            'ix_activity_table_user_id_name',
+            'user_id',
+            'name',
+            unique=True,
+        ),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    name: Mapped[str] = mapped_column(String(50))
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('user_table.id'))
+    user: Mapped[User] = relationship(back_populates='activities')
+    records: Mapped[list['Record']] = relationship(
+        back_populates='activity',
+        cascade='all, delete',
+    )
 
     def __repr__(self) -> str:
         """To representation."""
@@ -70,6 +329,10 @@ class Record(Base):
     """User record model."""
 
     __tablename__ = 'record_table'
+    __table_args__ = (
+        Index('ix_record_table_user_id_date', 'user_id', 'date'),
+        Index('ix_record_table_activity_id_date', 'activity_id', 'date'),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     date: Mapped[datetime.datetime] = mapped_column(
         DateTime(),
@@ -81,18 +344,474 @@ class Record(Base):
         back_populates='records',
         single_parent=True,
     )
+    # None for the default user activity
+    activity_id: Mapped[int | None] = mapped_column(
+        ForeignKey('activity_table.id'),
+    )
+    activity: Mapped[Activity | None] = relationship(back_populates='records')
 
     def __repr__(self) -> str:
         """To representation."""
         return self.date.strftime('%d.%m.%Y %H:%M:%S')
 
 
-async def init_models() -> None:
-    """Create all tables on app startup."""
-    async with async_engine.begin() as conn:
-        # To clear DB before re-creating it
-        # await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
+# The quota and the waitlist are kept in the first shard
+
+
+class Quota(Base):
+    """Quota counter model, checked and incremented in one statement."""
+
+    __tablename__ = 'quota_table'
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    used: Mapped[int] = mapped_column(Integer(), default=0)
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.name}: {self.used}'
+
+
+class Waitlist(Base):
+    """Sign-ups over the users quota model, in the order of joining."""
+
+    __tablename__ = 'waitlist_table'
+    __table_args__ = (
+        Index(
+            'ix_waitlist_table_tenant_name',
+            'tenant',
+            'name',
+            unique=True,
+        ),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    tenant: Mapped[str] = mapped_column(
+        String(50),
+        default=DEFAULT_TENANT,
+        server_default=DEFAULT_TENANT,
+    )
+    name: Mapped[str] = mapped_column(String(50))
+    activity: Mapped[str] = mapped_column(String(50), default='Default')
+    chat_id: Mapped[int] = mapped_column(BigInteger())
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return self.name
+
+
+# Rollups of the records, kept in the shard of the records and updated in the
+# transaction of the records change
+
+
+class DailyUserRecords(Base):
+    """User's records number per day model."""
+
+    __tablename__ = 'daily_user_records_table'
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey('user_table.id'),
+        primary_key=True,
+    )
+    # Moscow Time (UTC+3)
+    day: Mapped[datetime.date] = mapped_column(Date(), primary_key=True)
+    records: Mapped[int] = mapped_column(Integer(), default=0)
+    user: Mapped[User] = relationship(back_populates='daily_records')
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.day}: {self.records}'
+
+
+class DailyRecords(Base):
+    """Active users and records number per day model."""
+
+    __tablename__ = 'daily_records_table'
+    # Moscow Time (UTC+3)
+    day: Mapped[datetime.date] = mapped_column(Date(), primary_key=True)
+    users: Mapped[int] = mapped_column(Integer(), default=0)
+    records: Mapped[int] = mapped_column(Integer(), default=0)
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.day}: {self.users} users, {self.records} records'
+
+
+class IntervalRecords(Base):
+    """Records number per interval since the previous record model."""
+
+    __tablename__ = 'interval_records_table'
+    # Index of the `INTERVAL_BUCKETS` upper bound
+    bucket: Mapped[int] = mapped_column(Integer(), primary_key=True)
+    records: Mapped[int] = mapped_column(Integer(), default=0)
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.bucket}: {self.records}'
+
+
+class Event(Base):
+    """
+    Change event model, appended in the transaction of the change.
+
+    The events are kept in the shard of the user and read by the event ID.
+    """
+
+    __tablename__ = 'event_table'
+    id: Mapped[int] = mapped_column(
+        BigInteger().with_variant(Integer(), 'sqlite'),
+        primary_key=True,
+    )
+    date: Mapped[datetime.datetime] = mapped_column(DateTime())
+    tenant: Mapped[str] = mapped_column(String(50), default=DEFAULT_TENANT)
+    kind: Mapped[str] = mapped_column(String(50))
+    # The global user ID
+    user_id: Mapped[int] = mapped_column(BigInteger())
+    data: Mapped[dict] = mapped_column(JSON(), default=dict)
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.id}: {self.kind}'
+
+
+# Date buckets (Moscow Time, UTC+3)
+
+
+class day_bucket(FunctionElement):
+    """Record date shifted to Moscow Time and truncated to the day."""
+
+    type = Date()
+    inherit_cache = True
+
+
+class week_bucket(FunctionElement):
+    """Record date shifted to Moscow Time and truncated to the Monday."""
+
+    type = Date()
+    inherit_cache = True
+
+
+@compiles(day_bucket, 'sqlite')
+def _day_bucket_sqlite(element, compiler, **kw) -> str:
+    return "date(%s, '+3 hours')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(day_bucket, 'mysql')
+def _day_bucket_mysql(element, compiler, **kw) -> str:
+    return 'DATE(%s + INTERVAL 3 HOUR)' % compiler.process(
+        element.clauses,
+        **kw,
+    )
+
+
+@compiles(week_bucket, 'sqlite')
+def _week_bucket_sqlite(element, compiler, **kw) -> str:
+    return "date(%s, '+3 hours', 'weekday 0', '-6 days')" % compiler.process(
+        element.clauses,
+        **kw,
+    )
+
+
+@compiles(week_bucket, 'mysql')
+def _week_bucket_mysql(element, compiler, **kw) -> str:
+    date = compiler.process(element.clauses, **kw)
+    return (
+        f'DATE({date} + INTERVAL 3 HOUR) '
+        f'- INTERVAL WEEKDAY({date} + INTERVAL 3 HOUR) DAY'
+    )
+
+
+class weekday_of(FunctionElement):
+    """Moscow Time weekday of the record date, from 0 (Monday) to 6."""
+
+    type = Integer()
+    inherit_cache = True
+
+
+class hour_of(FunctionElement):
+    """Moscow Time hour of the record date, from 0 to 23."""
+
+    type = Integer()
+    inherit_cache = True
+
+
+@compiles(weekday_of, 'sqlite')
+def _weekday_of_sqlite(element, compiler, **kw) -> str:
+    return (
+        "(CAST(strftime('%%w', %s, '+3 hours') AS INTEGER) + 6) %% 7"
+        % compiler.process(element.clauses, **kw)
+    )
+
+
+@compiles(weekday_of, 'mysql')
+def _weekday_of_mysql(element, compiler, **kw) -> str:
+    return 'WEEKDAY(%s + INTERVAL 3 HOUR)' % compiler.process(
+        element.clauses,
+        **kw,
+    )
+
+
+@compiles(hour_of, 'sqlite')
+def _hour_of_sqlite(element, compiler, **kw) -> str:
+    return "CAST(strftime('%%H', %s, '+3 hours') AS INTEGER)" % (
+        compiler.process(element.clauses, **kw)
+    )
+
+
+@compiles(hour_of, 'mysql')
+def _hour_of_mysql(element, compiler, **kw) -> str:
+    return 'HOUR(%s + INTERVAL 3 HOUR)' % compiler.process(
+        element.clauses,
+        **kw,
+    )
+
+
+BUCKETS = {'day': day_bucket, 'week': week_bucket}
+
+
+# Statements of the hot queries, built once with bound parameters, so each
+# call skips building the construct and hits the engine's compiled cache
+
+
+# Records of the activity ID, of the default activity for None
+IN_ACTIVITY = Record.activity_id.is_not_distinct_from(bindparam('activity_id'))
+
+
+def get_buckets_statement(bucket: str):
+    """Create the records number per bucket statement."""
+    bucket_date = BUCKETS[bucket](Record.date).label('bucket')
+    return (
+        select(bucket_date, func.count())
+        .where(
+            Record.user_id == bindparam('user_id'),
+            IN_ACTIVITY,
+            Record.date.between(bindparam('start'), bindparam('end')),
+        )
+        .group_by(bucket_date)
+        .order_by(bucket_date)
+    )
+
+
+USER_BY_NAME = select(User).where(
+    User.tenant == bindparam('tenant'),
+    User.name == bindparam('name'),
+)
+USERS_COUNT = (
+    select(func.count())
+    .select_from(User)
+    .where(User.tenant == bindparam('tenant'))
+)
+LAST_RECORD_DATE = (
+    select(Record.date)
+    .where(Record.user_id == bindparam('user_id'), IN_ACTIVITY)
+    .order_by(Record.id.desc())
+    .limit(1)
+)
+RECORDS_DATES = select(Record.date).where(
+    Record.user_id == bindparam('user_id'),
+    IN_ACTIVITY,
+)
+RECORDS_RANGE = (
+    select(Record.date)
+    .where(
+        Record.user_id == bindparam('user_id'),
+        IN_ACTIVITY,
+        Record.date.between(bindparam('start'), bindparam('end')),
+    )
+    .order_by(Record.date)
+)
+RECORDS_BUCKETS = {bucket: get_buckets_statement(bucket) for bucket in BUCKETS}
+RECORDS_MATRIX = (
+    select(
+        weekday_of(Record.date).label('weekday'),
+        hour_of(Record.date).label('hour'),
+        func.count(),
+    )
+    .where(Record.user_id == bindparam('user_id'), IN_ACTIVITY)
+    .group_by('weekday', 'hour')
+)
+# The last record date of each user's activity, the default one first,
+# each one is found by the (activity ID, date) index
+ACTIVITIES_LAST_RECORDS = union_all(
+    select(
+        User.activity,
+        select(func.max(Record.date))
+        .where(
+            Record.user_id == bindparam('user_id'),
+            Record.activity_id.is_(None),
+        )
+        .scalar_subquery(),
+        literal(0).label('position'),
+    ).where(User.id == bindparam('user_id')),
+    select(
+        Activity.name,
+        select(func.max(Record.date))
+        .where(Record.activity_id == Activity.id)
+        .scalar_subquery(),
+        Activity.id,
+    ).where(Activity.user_id == bindparam('user_id')),
+).order_by('position')
+ACTIVITY_ID = select(Activity.id).where(
+    Activity.user_id == bindparam('user_id'),
+    Activity.name == bindparam('name'),
+)
+ACTIVITIES_COUNT = (
+    select(func.count())
+    .select_from(Activity)
+    .where(Activity.user_id == bindparam('user_id'))
+)
+# The activity found by name with its records number and last record date
+ACTIVITY_TIMELINE = select(
+    Activity.id,
+    select(func.count())
+    .where(Record.activity_id == Activity.id)
+    .scalar_subquery(),
+    select(Record.date)
+    .where(Record.activity_id == Activity.id)
+    .order_by(Record.id.desc())
+    .limit(1)
+    .scalar_subquery(),
+).where(
+    Activity.user_id == bindparam('user_id'),
+    Activity.name == bindparam('name'),
+)
+
+# Atomic quota place reservation, no place is taken over the limit
+RESERVE_PLACE = (
+    update(Quota.__table__)
+    .where(
+        Quota.name == bindparam('quota_name'),
+        Quota.used < bindparam('limit'),
+    )
+    .values(used=Quota.used + 1)
+)
+RELEASE_PLACE = (
+    update(Quota.__table__)
+    .where(Quota.name == bindparam('quota_name'), Quota.used > 0)
+    .values(used=Quota.used - 1)
+)
+QUOTA_USED = select(Quota.used).where(Quota.name == bindparam('quota_name'))
+
+
+def subtract_counter(column: Column, name: str) -> Case:
+    """Get the counter less the bound number, down to zero."""
+    return case(
+        (column > bindparam(name), column - bindparam(name)),
+        else_=0,
+    )
+
+
+def get_counters_upsert(dialect_name: str, table: Table) -> Insert:
+    """Create the statement adding the values to the counters of the row."""
+    counters = [column for column in table.columns if not column.primary_key]
+    if dialect_name == 'mysql':
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(
+            {
+                column: column + statement.inserted[column.name]
+                for column in counters
+            },
+        )
+    statement = sqlite.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={
+            column.name: column + statement.excluded[column.name]
+            for column in counters
+        },
+    )
+
+
+# Rollup counters changes, the shared rows are upserted by the dialect
+DAILY_USER_RECORDS_ADD = (
+    update(DailyUserRecords.__table__)
+    .where(
+        DailyUserRecords.user_id == bindparam('user'),
+        DailyUserRecords.day == bindparam('on_day'),
+    )
+    .values(records=DailyUserRecords.records + bindparam('delta'))
+)
+# The records counted before the rollups were rebuilt aren't subtracted below
+# zero, the rows of the not counted days and buckets are skipped
+DAILY_USER_RECORDS_SUBTRACT = (
+    update(DailyUserRecords.__table__)
+    .where(
+        DailyUserRecords.user_id == bindparam('user'),
+        DailyUserRecords.day == bindparam('on_day'),
+    )
+    .values(records=subtract_counter(DailyUserRecords.records, 'delta'))
+)
+DAILY_RECORDS_SUBTRACT = (
+    update(DailyRecords.__table__)
+    .where(DailyRecords.day == bindparam('on_day'))
+    .values(
+        users=subtract_counter(DailyRecords.users, 'less_users'),
+        records=subtract_counter(DailyRecords.records, 'less_records'),
+    )
+)
+INTERVAL_RECORDS_SUBTRACT = (
+    update(IntervalRecords.__table__)
+    .where(IntervalRecords.bucket == bindparam('on_bucket'))
+    .values(
+        records=subtract_counter(IntervalRecords.records, 'less_records'),
+    )
+)
+DAILY_USER_RECORDS_PRUNE = delete(DailyUserRecords.__table__).where(
+    DailyUserRecords.user_id == bindparam('user'),
+    DailyUserRecords.day == bindparam('on_day'),
+    DailyUserRecords.records <= 0,
+)
+ROLLUP_UPSERTS = {
+    dialect_name: {
+        table.name: get_counters_upsert(dialect_name, table)
+        for table in (DailyRecords.__table__, IntervalRecords.__table__)
+    }
+    for dialect_name in ('sqlite', 'mysql')
+}
+DAILY_RECORDS_RANGE = (
+    select(DailyRecords.day, DailyRecords.users, DailyRecords.records)
+    .where(
+        DailyRecords.day.between(bindparam('start'), bindparam('end')),
+        DailyRecords.records > 0,
+    )
+    .order_by(DailyRecords.day)
+)
+INTERVAL_RECORDS = select(IntervalRecords.bucket, IntervalRecords.records)
+EVENTS_AFTER = (
+    select(
+        Event.id,
+        Event.date,
+        Event.tenant,
+        Event.kind,
+        Event.user_id,
+        Event.data,
+    )
+    .where(
+        Event.id > bindparam('after'),
+        Event.date <= bindparam('settled'),
+    )
+    .order_by(Event.id)
+    .limit(bindparam('batch_size'))
+)
+
+
+async def init_models() -> dict[int, list[int]]:
+    """
+    Migrate the schema of all shards on app startup.
+
+    An up-to-date shard takes one schema version query.
+
+    Returns:
+        The applied migration versions by the shard index.
+    """
+    applied = {}
+    for shard in shards:
+        async with shard.engine.connect() as conn:
+            version = await conn.run_sync(migrations.get_version)
+            if version == migrations.LATEST_VERSION:
+                applied[shard.index] = []
+                continue
+            applied[shard.index] = await conn.run_sync(
+                migrations.upgrade,
+                Base.metadata,
+            )
+    return applied
 
 
 # CRUD
@@ -101,43 +820,87 @@ async def init_models() -> None:
 async def create_user(
     name: str,
     activity: str = 'Default',
+    chat_id: int | None = None,
 ) -> tuple[int, str] | tuple[None, None]:
     """
     Create a user entry in the database.
 
+    A place of the tenant's users quota is reserved first. Over the quota
+    the user is put on the waitlist, if the chat ID is given.
+
     Returns:
         The user ID and the user activity name, None otherwise.
     """
-    async with async_session() as session:
+    if not await reserve_user_place():
+        if chat_id is not None:
+            await join_waitlist(name, activity, chat_id)
+        return None, None
+    shard = get_user_shard(name)
+    async with shard.session() as session:
         try:
             async with session.begin():
                 user = User(
+                    tenant=current_tenant.get(),
                     name=name,
                     activity=activity,
                 )
                 session.add(user)
+                await session.flush()
+                user_id = to_global_id(shard.index, user.id)
+                add_event(
+                    session,
+                    'user_created',
+                    user_id,
+                    name=name,
+                    activity=activity,
+                )
         except (IntegrityError, OperationalError):
+            await release_user_place()
             return None, None
-        return (
-            await user.awaitable_attrs.id,
-            await user.awaitable_attrs.activity,
-        )
+        mark_written(user_id, name)
+        return user_id, await user.awaitable_attrs.activity
 
 
 async def get_user_id(username: str) -> tuple[int, str] | tuple[None, None]:
     """
-    Get the user ID and the user activity from the database.
+    Get the user ID and the user activity of the tenant from the database.
+
+    The user is looked up in the user's shard. While `REBALANCING` is set,
+    the other shards are looked up concurrently too, the user can be not
+    moved to its shard yet.
 
     Returns:
         The user ID and the user activity name, None otherwise.
     """
-    async with async_session() as session:
+    user_shard = get_user_shard(username)
+    found = await get_shard_user(user_shard, username)
+    if found[0] is not None or not REBALANCING:
+        return found
+    for found in await asyncio.gather(
+        *(
+            get_shard_user(shard, username)
+            for shard in shards
+            if shard is not user_shard
+        ),
+    ):
+        if found[0] is not None:
+            return found
+    return None, None
+
+
+async def get_shard_user(
+    shard: Shard,
+    username: str,
+) -> tuple[int, str] | tuple[None, None]:
+    """Get the user ID and the user activity of the tenant from the shard."""
+    async with shard.read_session(username) as session:
         user: User | None = await session.scalar(
-            select(User).where(User.name == username),
+            USER_BY_NAME,
+            {'tenant': current_tenant.get(), 'name': username},
         )
-        if user:
-            return user.id, user.activity
+    if user is None:
         return None, None
+    return to_global_id(shard.index, user.id), user.activity
 
 
 async def get_user_info(user_id: int) -> tuple[str, str] | tuple[None, None]:
@@ -147,29 +910,44 @@ async def get_user_info(user_id: int) -> tuple[str, str] | tuple[None, None]:
     Returns:
         The the user name and the user activity, None otherwise.
     """
-    async with async_session() as session:
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
         try:
-            user = await session.get(User, user_id)
+            user = await session.get(User, local_id)
             return user.name, user.activity
         except (UnmappedInstanceError, AttributeError):
             return None, None
 
 
 async def get_users_list() -> list[tuple[int, str]]:
-    """Get the list of all users."""
-    async with async_session() as session:
-        users: list[User] = await session.scalars(select(User))
-        if users:
-            return [(user.id, user.name) for user in users]
-        return []
+    """Get the list of the tenant's users of all shards."""
+
+    async def get_shard_users(shard: Shard) -> list[tuple[int, str]]:
+        async with shard.read_session() as session:
+            users: list[User] = await session.scalars(
+                select(User).where(User.tenant == current_tenant.get()),
+            )
+            return [
+                (to_global_id(shard.index, user.id), user.name)
+                for user in users
+            ]
+
+    return list(
+        itertools.chain(*await asyncio.gather(*map(get_shard_users, shards))),
+    )
 
 
 async def get_user_count() -> int:
-    """Get the number of users in the database."""
-    async with async_session() as session:
-        return await session.scalar(
-            select(func.count()).select_from(User),
-        )
+    """Get the number of the tenant's users in all shards."""
+
+    async def get_shard_count(shard: Shard) -> int:
+        async with shard.read_session() as session:
+            return await session.scalar(
+                USERS_COUNT,
+                {'tenant': current_tenant.get()},
+            )
+
+    return sum(await asyncio.gather(*map(get_shard_count, shards)))
 
 
 async def create_record(
@@ -177,110 +955,1080 @@ async def create_record(
     date: datetime.datetime | None = None,
 ) -> datetime.datetime | None:
     """
-    Create a user's record in the database.
+    Create a user's record in the database and add it to the rollups.
 
     Returns:
         The user's record info, None otherwise.
     """
-    async with async_session() as session:
+    shard, local_id = locate_user(user_id)
+    async with shard.session() as session:
         if date is not None and not isinstance(date, datetime.datetime):
             return None
+        if date is None:
+            date = datetime.datetime.utcnow().replace(microsecond=0)
         try:
             async with session.begin():
-                if not await session.get(User, user_id):
+                if not await session.get(User, local_id):
                     return None
+                previous_date = await session.scalar(
+                    LAST_RECORD_DATE,
+                    {'user_id': local_id, 'activity_id': None},
+                )
                 record = Record(
-                    user_id=user_id,
+                    user_id=local_id,
                     date=date,
                 )
                 session.add(record)
+                await update_rollups(
+                    session,
+                    local_id,
+                    [date],
+                    count_intervals([previous_date, date]),
+                )
+                add_event(
+                    session,
+                    'record_created',
+                    user_id,
+                    date=date.isoformat(),
+                )
         except (IntegrityError, OperationalError):
             return None
+        mark_written(user_id)
         return await record.awaitable_attrs.date
 
 
-async def get_last_user_record(user_id: int) -> datetime.datetime | None:
+async def track_activity(
+    user_id: int,
+    name: str,
+) -> tuple[datetime.datetime, bool] | None:
+    """
+    Create a record of the user's activity by the activity name.
+
+    The activity timeline is looked up with one statement, the oldest records
+    beyond the records limit are deleted and the record is added in the same
+    transaction, with the rollups.
+
+    Returns:
+        The record date and whether the old records have been deleted, None
+        if there is no such activity.
+    """
+    shard, local_id = locate_user(user_id)
+    date = datetime.datetime.utcnow().replace(microsecond=0)
+    async with shard.session() as session:
+        try:
+            async with session.begin():
+                timeline = (
+                    await session.execute(
+                        ACTIVITY_TIMELINE,
+                        {'user_id': local_id, 'name': name},
+                    )
+                ).one_or_none()
+                if timeline is None:
+                    return None
+                activity_id, records_count, previous_date = timeline
+                cleared = (
+                    records_count > RECORDS_LIMIT
+                    and await delete_oldest_records(
+                        session,
+                        user_id,
+                        RECORDS_LIMIT // 3,
+                        activity_id,
+                    )
+                )
+                session.add(
+                    Record(
+                        user_id=local_id,
+                        activity_id=activity_id,
+                        date=date,
+                    ),
+                )
+                await update_rollups(
+                    session,
+                    local_id,
+                    [date],
+                    count_intervals([previous_date, date]),
+                )
+                add_event(
+                    session,
+                    'record_created',
+                    user_id,
+                    date=date.isoformat(),
+                    activity=name,
+                )
+        except (IntegrityError, OperationalError):
+            return None
+    mark_written(user_id)
+    return date, cleared
+
+
+async def create_activity(user_id: int, name: str) -> int | None:
+    """
+    Create a user's activity besides the default one.
+
+    Returns:
+        The activity ID, None if it exists or the limit is reached.
+    """
+    shard, local_id = locate_user(user_id)
+    async with shard.session() as session:
+        try:
+            async with session.begin():
+                count = await session.scalar(
+                    ACTIVITIES_COUNT,
+                    {'user_id': local_id},
+                )
+                if count >= ACTIVITY_LIMIT:
+                    return None
+                activity = Activity(user_id=local_id, name=name)
+                session.add(activity)
+                add_event(session, 'activity_created', user_id, activity=name)
+        except (IntegrityError, OperationalError):
+            return None
+        mark_written(user_id)
+        return await activity.awaitable_attrs.id
+
+
+async def get_activity_id(user_id: int, name: str) -> int | None:
+    """Get the ID of the user's activity by the name."""
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        return await session.scalar(
+            ACTIVITY_ID,
+            {'user_id': local_id, 'name': name},
+        )
+
+
+async def get_activities_last_records(
+    user_id: int,
+) -> list[tuple[str, datetime.datetime | None]]:
+    """
+    Get the last record date of each user's activity with one query.
+
+    Returns:
+        The activity names with the last record dates, None for no records,
+        the default activity first.
+    """
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        rows: engine.result.Result = await session.execute(
+            ACTIVITIES_LAST_RECORDS,
+            {'user_id': local_id},
+        )
+        return [(name, date) for name, date, _ in rows]
+
+
+async def get_last_user_record(
+    user_id: int,
+    activity_id: int | None = None,
+) -> datetime.datetime | None:
     """Get info on the last user's record in the database."""
-    async with async_session() as session:
-        records: list[Record] = await session.scalars(
-            select(Record)
-            .where(Record.user_id == user_id)
-            .order_by(Record.id.desc()),
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        return await session.scalar(
+            LAST_RECORD_DATE,
+            {'user_id': local_id, 'activity_id': activity_id},
         )
-        record = records.first()
-        if record:
-            return await record.awaitable_attrs.date
-        return None
 
 
-async def get_user_records(user_id: int) -> list[datetime.datetime] | None:
+async def get_user_records(
+    user_id: int,
+    activity_id: int | None = None,
+) -> list[datetime.datetime] | None:
     """Get the dates of the user's records in the database."""
-    async with async_session() as session:
-        records: list[Record] = await session.scalars(
-            select(Record).where(Record.user_id == user_id),
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        dates: engine.result.ScalarResult = await session.scalars(
+            RECORDS_DATES,
+            {'user_id': local_id, 'activity_id': activity_id},
         )
-        if records:
-            return [await record.awaitable_attrs.date for record in records]
-        return None
+        return dates.all()
+
+
+async def get_user_records_range(
+    user_id: int,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    activity_id: int | None = None,
+) -> list[datetime.datetime]:
+    """Get the dates of the user's records within the date range."""
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        dates: engine.result.ScalarResult = await session.scalars(
+            RECORDS_RANGE,
+            {
+                'user_id': local_id,
+                'activity_id': activity_id,
+                'start': start,
+                'end': end,
+            },
+        )
+        return dates.all()
+
+
+async def get_user_records_buckets(
+    user_id: int,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    bucket: str = 'day',
+    activity_id: int | None = None,
+) -> list[tuple[datetime.date, int]]:
+    """
+    Get the number of the user's records per day or week within the range.
+
+    Returns:
+        The Moscow Time bucket dates with the number of records, oldest first.
+    """
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        rows: engine.result.Result = await session.execute(
+            RECORDS_BUCKETS[bucket],
+            {
+                'user_id': local_id,
+                'activity_id': activity_id,
+                'start': start,
+                'end': end,
+            },
+        )
+        return [(bucket_day, count) for bucket_day, count in rows]
+
+
+async def get_user_records_matrix(
+    user_id: int,
+    activity_id: int | None = None,
+) -> list[list[int]]:
+    """
+    Count the user's records per weekday and hour of the day.
+
+    Returns:
+        The 7×24 matrix of records numbers, rows from Monday to Sunday.
+    """
+    matrix = [[0] * 24 for _ in range(7)]
+    shard, local_id = locate_user(user_id)
+    async with shard.read_session(user_id) as session:
+        rows: engine.result.Result = await session.execute(
+            RECORDS_MATRIX,
+            {'user_id': local_id, 'activity_id': activity_id},
+        )
+        for row_weekday, row_hour, count in rows:
+            matrix[row_weekday][row_hour] = count
+    return matrix
 
 
 async def get_all_records() -> list[datetime.datetime] | None:
-    """Get the dates of all records in the database."""
-    async with async_session() as session:
-        records: list[Record] = await session.scalars(select(Record))
-        if records:
-            return [await record.awaitable_attrs.date for record in records]
-        return None
+    """Get the dates of all records in all shards."""
+
+    async def get_shard_records(shard: Shard) -> list[datetime.datetime]:
+        async with shard.read_session() as session:
+            dates: engine.result.ScalarResult = await session.scalars(
+                select(Record.date),
+            )
+            return dates.all()
+
+    shard_records = await asyncio.gather(*map(get_shard_records, shards))
+    return list(itertools.chain(*shard_records)) or None
 
 
 async def delete_user(user_id: int) -> bool:
-    """Delete a user from the database."""
-    async with async_session() as session:
+    """Delete a user from the database and the user's records rollups."""
+    shard, local_id = locate_user(user_id)
+    async with shard.session() as session:
         async with session.begin():
+            rows: engine.result.Result = await session.execute(
+                select(Record.activity_id, Record.date)
+                .where(Record.user_id == local_id)
+                .order_by(Record.activity_id, Record.id),
+            )
+            timelines = [
+                [date for _, date in timeline]
+                for _, timeline in itertools.groupby(
+                    rows,
+                    key=lambda row: row[0],
+                )
+            ]
+            await update_rollups(
+                session,
+                local_id,
+                itertools.chain(*timelines),
+                sum(map(count_intervals, timelines), Counter()),
+                sign=-1,
+            )
             try:
-                user = await session.get(User, user_id)
+                user = await session.get(User, local_id)
                 await session.delete(user)
             except UnmappedInstanceError:
                 return False
-            return True
+            add_event(session, 'user_deleted', user_id, name=user.name)
+        mark_written(user_id, user.name)
+    await release_user_place()
+    return True
 
 
 async def delete_records(
     user_id: int,
     count: int = 15,
+    activity_id: int | None = None,
 ) -> bool:
-    """Delete a number of records from the database."""
-    async with async_session() as session:
+    """Delete a number of the oldest records from the database."""
+    shard, _ = locate_user(user_id)
+    async with shard.session() as session:
         async with session.begin():
-            records_sr: engine.result.ScalarResult = await session.scalars(
-                select(Record).where(Record.user_id == user_id).limit(count),
-            )
-            records: list[Record] = records_sr.all()
-            if not records:
+            if not await delete_oldest_records(
+                session,
+                user_id,
+                count,
+                activity_id,
+            ):
                 return False
-            for record in records:
-                await session.delete(record)
-            return True
+        mark_written(user_id)
+        return True
+
+
+async def delete_oldest_records(
+    session: AsyncSession,
+    user_id: int,
+    count: int,
+    activity_id: int | None = None,
+) -> bool:
+    """
+    Delete a number of the oldest records of the timeline in the transaction.
+
+    Returns:
+        True if there were records to delete, False otherwise.
+    """
+    _, local_id = locate_user(user_id)
+    records_sr: engine.result.ScalarResult = await session.scalars(
+        select(Record)
+        .where(
+            Record.user_id == local_id,
+            Record.activity_id.is_not_distinct_from(activity_id),
+        )
+        .order_by(Record.id)
+        .limit(count),
+    )
+    records: list[Record] = records_sr.all()
+    if not records:
+        return False
+    # The next record loses its interval since the last deleted one
+    next_date = await session.scalar(
+        select(Record.date)
+        .where(
+            Record.user_id == local_id,
+            Record.activity_id.is_not_distinct_from(activity_id),
+            Record.id > records[-1].id,
+        )
+        .order_by(Record.id)
+        .limit(1),
+    )
+    dates = [record.date for record in records]
+    for record in records:
+        await session.delete(record)
+    await update_rollups(
+        session,
+        local_id,
+        dates,
+        count_intervals([*dates, next_date]),
+        sign=-1,
+    )
+    add_event(
+        session,
+        'records_deleted',
+        user_id,
+        dates=[date.isoformat() for date in dates],
+        activity_id=activity_id,
+    )
+    return True
 
 
-async def delete_last_record(user_id: int) -> bool:
+async def delete_last_record(
+    user_id: int,
+    activity_id: int | None = None,
+) -> bool:
     """Delete the last user's record from the database."""
-    async with async_session() as session:
+    shard, local_id = locate_user(user_id)
+    async with shard.session() as session:
         async with session.begin():
-            records: list[Record] = await session.scalars(
-                select(Record)
-                .where(Record.user_id == user_id)
-                .order_by(Record.id.desc()),
+            records: list[Record] = (
+                await session.scalars(
+                    select(Record)
+                    .where(
+                        Record.user_id == local_id,
+                        Record.activity_id.is_not_distinct_from(activity_id),
+                    )
+                    .order_by(Record.id.desc())
+                    .limit(2),
+                )
+            ).all()
+            if not records:
+                return False
+            record = records[0]
+            await session.delete(record)
+            await update_rollups(
+                session,
+                local_id,
+                [record.date],
+                count_intervals([row.date for row in reversed(records)]),
+                sign=-1,
+            )
+            add_event(
+                session,
+                'records_deleted',
+                user_id,
+                dates=[record.date.isoformat()],
+                activity_id=activity_id,
+            )
+        mark_written(user_id)
+        return True
+
+
+# Change events
+
+
+def add_event(
+    session: AsyncSession,
+    kind: str,
+    user_id: int,
+    **data,
+) -> None:
+    """Append the change event of the user to the session transaction."""
+    session.add(
+        Event(
+            date=datetime.datetime.utcnow(),
+            tenant=current_tenant.get(),
+            kind=kind,
+            user_id=user_id,
+            data=data,
+        ),
+    )
+
+
+async def record_event(kind: str, user_id: int, **data) -> None:
+    """Append the change event of the user made outside the database."""
+    shard, _ = locate_user(user_id)
+    async with shard.session() as session:
+        async with session.begin():
+            add_event(session, kind, user_id, **data)
+
+
+def get_records_deleted_events(
+    shard_index: int,
+    rows: Iterable[engine.Row],
+) -> list[dict]:
+    """
+    Get the events of the records deleted in bulk, one per user's timeline.
+
+    Args:
+        shard_index: The shard of the records.
+        rows: The deleted records' user ID, activity ID, date and user tenant,
+            ordered by the date within each timeline.
+
+    Returns:
+        The event table rows.
+    """
+    timelines: dict[tuple, list[str]] = {}
+    for row in rows:
+        timelines.setdefault(
+            (row.user_id, row.activity_id, row.tenant),
+            [],
+        ).append(row.date.isoformat())
+    date = datetime.datetime.utcnow()
+    return [
+        {
+            'date': date,
+            # The tenant of a deleted user is unknown
+            'tenant': DEFAULT_TENANT if tenant is None else tenant,
+            'kind': 'records_deleted',
+            'user_id': to_global_id(shard_index, user_id),
+            'data': {'dates': dates, 'activity_id': activity_id},
+        }
+        for (user_id, activity_id, tenant), dates in timelines.items()
+    ]
+
+
+async def iter_events(
+    cursor: list[int] | None = None,
+    batch_size: int = 1000,
+) -> AsyncIterator[tuple[list[int], list[dict]]]:
+    """
+    Get the change events after the cursor in batches, shard by shard.
+
+    The cursor is the last read event ID of each shard. The events of the
+    last `EVENTS_SETTLE_SECONDS` are left for the next read.
+
+    Yields:
+        The cursor after the batch and the batch events, oldest first.
+    """
+    cursor = list(cursor or [])
+    cursor += [0] * (len(shards) - len(cursor))
+    settled = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=EVENTS_SETTLE_SECONDS,
+    )
+    for shard in shards:
+        while True:
+            async with shard.engine.connect() as conn:
+                rows: engine.result.Result = await conn.execute(
+                    EVENTS_AFTER,
+                    {
+                        'after': cursor[shard.index],
+                        'settled': settled,
+                        'batch_size': batch_size,
+                    },
+                )
+                events = [
+                    {'shard': shard.index, **row}
+                    for row in rows.mappings()
+                ]
+            if not events:
+                break
+            cursor[shard.index] = events[-1]['id']
+            yield list(cursor), events
+
+
+# Rollups
+
+
+def get_day(date: datetime.datetime) -> datetime.date:
+    """Get the day of the record date."""
+    # Moscow Time (UTC+3)
+    return (date + datetime.timedelta(hours=3)).date()
+
+
+def count_intervals(
+    dates: list[datetime.datetime | None],
+) -> Counter[int]:
+    """
+    Count the intervals between the consecutive dates of a timeline.
+
+    Returns:
+        The numbers of intervals by the `INTERVAL_BUCKETS` index, the missing
+        dates are skipped.
+    """
+    dates = [date for date in dates if date is not None]
+    return Counter(
+        bisect.bisect_left(
+            INTERVAL_BUCKETS,
+            (later - earlier).total_seconds() / 3600,
+        )
+        for earlier, later in itertools.pairwise(dates)
+    )
+
+
+async def update_rollups(
+    session: AsyncSession,
+    user_id: int,
+    dates: Iterable[datetime.datetime],
+    intervals: Counter[int],
+    sign: int = 1,
+) -> None:
+    """
+    Add the records to the rollups in the session transaction.
+
+    The records are subtracted with the negative sign. A user is active on a
+    day while the user has records of the day.
+
+    Args:
+        user_id: The shard user ID.
+        dates: The records dates.
+        intervals: The numbers of the records intervals by the bucket.
+    """
+    if sign < 0:
+        await subtract_rollups(session, user_id, dates, intervals)
+        return
+    upserts = ROLLUP_UPSERTS[session.bind.dialect.name]
+    for day, count in Counter(map(get_day, dates)).items():
+        params = {'user': user_id, 'on_day': day, 'delta': count}
+        result: engine.CursorResult = await session.execute(
+            DAILY_USER_RECORDS_ADD,
+            params,
+        )
+        users = 0
+        if not result.rowcount:
+            await session.execute(
+                insert(DailyUserRecords.__table__),
+                {'user_id': user_id, 'day': day, 'records': count},
             )
-            record = records.first()
-            if record:
-                await session.delete(record)
-                return True
+            users = 1
+        await session.execute(
+            upserts[DailyRecords.__tablename__],
+            {'day': day, 'users': users, 'records': count},
+        )
+    for bucket, count in intervals.items():
+        await session.execute(
+            upserts[IntervalRecords.__tablename__],
+            {'bucket': bucket, 'records': count},
+        )
+
+
+async def subtract_rollups(
+    session: AsyncSession,
+    user_id: int,
+    dates: Iterable[datetime.datetime],
+    intervals: Counter[int],
+) -> None:
+    """
+    Subtract the records from the rollups in the session transaction.
+
+    The days and the buckets without the rollup rows weren't counted, so
+    they are skipped, and the counters don't go below zero.
+    """
+    for day, count in Counter(map(get_day, dates)).items():
+        params = {'user': user_id, 'on_day': day, 'delta': count}
+        result: engine.CursorResult = await session.execute(
+            DAILY_USER_RECORDS_SUBTRACT,
+            params,
+        )
+        if not result.rowcount:
+            continue
+        result = await session.execute(DAILY_USER_RECORDS_PRUNE, params)
+        await session.execute(
+            DAILY_RECORDS_SUBTRACT,
+            {
+                'on_day': day,
+                'less_users': result.rowcount,
+                'less_records': count,
+            },
+        )
+    for bucket, count in intervals.items():
+        await session.execute(
+            INTERVAL_RECORDS_SUBTRACT,
+            {'on_bucket': bucket, 'less_records': count},
+        )
+
+
+async def get_daily_records(
+    start: datetime.date,
+    end: datetime.date,
+) -> dict[datetime.date, tuple[int, int]]:
+    """
+    Get the active users and records numbers per day of all shards.
+
+    Returns:
+        The users and records numbers by the day within the range.
+    """
+
+    async def get_shard_days(shard: Shard) -> list[tuple]:
+        async with shard.read_session() as session:
+            rows: engine.result.Result = await session.execute(
+                DAILY_RECORDS_RANGE,
+                {'start': start, 'end': end},
+            )
+            return rows.all()
+
+    days: dict[datetime.date, tuple[int, int]] = {}
+    for shard_days in await asyncio.gather(*map(get_shard_days, shards)):
+        for day, users, records in shard_days:
+            day_users, day_records = days.get(day, (0, 0))
+            days[day] = (day_users + users, day_records + records)
+    return days
+
+
+async def get_interval_records() -> list[int]:
+    """
+    Get the records numbers per interval since the previous record.
+
+    Returns:
+        The records numbers of all shards by the `INTERVAL_BUCKETS` index.
+    """
+
+    async def get_shard_intervals(shard: Shard) -> list[tuple[int, int]]:
+        async with shard.read_session() as session:
+            rows: engine.result.Result = await session.execute(
+                INTERVAL_RECORDS,
+            )
+            return rows.all()
+
+    intervals = [0] * (len(INTERVAL_BUCKETS) + 1)
+    for shard_intervals in await asyncio.gather(
+        *map(get_shard_intervals, shards),
+    ):
+        for bucket, records in shard_intervals:
+            intervals[bucket] += records
+    return intervals
+
+
+def count_rollups(conn: Connection, batch_size: int = 1000) -> int:
+    """
+    Count the rollups from the records again in the connection transaction.
+
+    The users' records are read in batches of users, then the rollups are
+    replaced.
+
+    Returns:
+        The number of records.
+    """
+    daily_user: Counter[tuple[int, datetime.date]] = Counter()
+    intervals: Counter[int] = Counter()
+    last_id = 0
+    while True:
+        user_ids: list[int] = conn.scalars(
+            select(User.id)
+            .where(User.id > last_id)
+            .order_by(User.id)
+            .limit(batch_size),
+        ).all()
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+        rows = conn.execute(
+            select(Record.user_id, Record.activity_id, Record.date)
+            .where(Record.user_id.between(user_ids[0], user_ids[-1]))
+            .order_by(Record.user_id, Record.activity_id, Record.id),
+        )
+        for (user_id, _), timeline in itertools.groupby(
+            rows,
+            key=lambda row: row[:2],
+        ):
+            dates = [date for _, _, date in timeline]
+            daily_user.update((user_id, get_day(date)) for date in dates)
+            intervals += count_intervals(dates)
+    daily: dict[datetime.date, list[int]] = {}
+    for (_, day), records in daily_user.items():
+        day_counts = daily.setdefault(day, [0, 0])
+        day_counts[0] += 1
+        day_counts[1] += records
+    for model in (DailyUserRecords, DailyRecords, IntervalRecords):
+        conn.execute(delete(model))
+    for model, rows in (
+        (
+            DailyUserRecords,
+            [
+                {'user_id': user_id, 'day': day, 'records': records}
+                for (user_id, day), records in daily_user.items()
+            ],
+        ),
+        (
+            DailyRecords,
+            [
+                {'day': day, 'users': users, 'records': records}
+                for day, (users, records) in daily.items()
+            ],
+        ),
+        (
+            IntervalRecords,
+            [
+                {'bucket': bucket, 'records': records}
+                for bucket, records in intervals.items()
+            ],
+        ),
+    ):
+        if rows:
+            conn.execute(insert(model), rows)
+    return daily_user.total()
+
+
+async def rebuild_rollups(shard: Shard, batch_size: int = 1000) -> int:
+    """
+    Count the rollups of the shard from its records again.
+
+    Returns:
+        The number of records.
+    """
+    async with shard.engine.begin() as conn:
+        return await conn.run_sync(count_rollups, batch_size)
+
+
+# Quota and waitlist, each tenant has its own ones
+
+
+def get_users_quota_name() -> str:
+    """Get the users quota counter name of the tenant."""
+    tenant = current_tenant.get()
+    return f'{USERS_QUOTA}:{tenant}' if tenant else USERS_QUOTA
+
+
+async def seed_users_quota() -> bool:
+    """
+    Create the users quota counter with the number of users, if it's missing.
+
+    Returns:
+        True if the counter was missing, False otherwise.
+    """
+    quota_name = get_users_quota_name()
+    async with shards[0].session() as session:
+        if await session.get(Quota, quota_name) is not None:
             return False
+    used = await get_user_count()
+    async with shards[0].session() as session:
+        try:
+            async with session.begin():
+                session.add(Quota(name=quota_name, used=used))
+        except IntegrityError:
+            # Seeded concurrently
+            pass
+    return True
+
+
+async def reserve_user_place() -> bool:
+    """
+    Take a place of the users quota with one conditional update.
+
+    Returns:
+        True if there was a free place, False otherwise.
+    """
+    async with shards[0].session() as session:
+        async with session.begin():
+            result: engine.CursorResult = await session.execute(
+                RESERVE_PLACE,
+                {'quota_name': get_users_quota_name(), 'limit': USER_LIMIT},
+            )
+    if result.rowcount:
+        return True
+    if await seed_users_quota():
+        return await reserve_user_place()
+    return False
+
+
+async def release_user_place() -> None:
+    """Free a place of the users quota."""
+    async with shards[0].session() as session:
+        async with session.begin():
+            await session.execute(
+                RELEASE_PLACE,
+                {'quota_name': get_users_quota_name()},
+            )
+
+
+async def is_quota_over() -> bool:
+    """Check if there are no free places of the users quota."""
+    async with shards[0].session() as session:
+        used = await session.scalar(
+            QUOTA_USED,
+            {'quota_name': get_users_quota_name()},
+        )
+    if used is None:
+        await seed_users_quota()
+        return await is_quota_over()
+    return used >= USER_LIMIT
+
+
+async def sync_users_quota() -> int:
+    """
+    Set the tenant's users quota counter to the number of users of all shards.
+
+    Returns:
+        The number of users.
+    """
+    quota_name = get_users_quota_name()
+    used = await get_user_count()
+    async with shards[0].session() as session:
+        async with session.begin():
+            quota = await session.get(Quota, quota_name)
+            if quota is None:
+                session.add(Quota(name=quota_name, used=used))
+            else:
+                quota.used = used
+    return used
+
+
+async def join_waitlist(name: str, activity: str, chat_id: int) -> int:
+    """
+    Put the user on the waitlist, if it's not there yet.
+
+    Returns:
+        The user's position in the waitlist.
+    """
+    async with shards[0].session() as session:
+        try:
+            async with session.begin():
+                session.add(
+                    Waitlist(
+                        tenant=current_tenant.get(),
+                        name=name,
+                        activity=activity,
+                        chat_id=chat_id,
+                    ),
+                )
+        except IntegrityError:
+            pass
+    return await get_waitlist_position(name)
+
+
+async def get_waitlist_position(name: str) -> int | None:
+    """Get the user's position in the waitlist, None if it's not there."""
+    tenant = current_tenant.get()
+    async with shards[0].session() as session:
+        waitlisted: Waitlist | None = await session.scalar(
+            select(Waitlist).where(
+                Waitlist.tenant == tenant,
+                Waitlist.name == name,
+            ),
+        )
+        if waitlisted is None:
+            return None
+        return await session.scalar(
+            select(func.count())
+            .select_from(Waitlist)
+            .where(Waitlist.tenant == tenant, Waitlist.id <= waitlisted.id),
+        )
 
 
-if __name__ == '__main__':
-    asyncio.run(init_models())
-    print(asyncio.run(get_users_list()))
-    # print(asyncio.run(get_user_info()))
-    # print(asyncio.run(delete_user()))
+async def admit_from_waitlist() -> tuple[int, str, int] | None:
+    """
+    Create the user of the waitlist head, if there is a free place.
+
+    Returns:
+        The user ID, the user activity and the chat ID, None otherwise.
+    """
+    while True:
+        async with shards[0].session() as session:
+            waitlisted: Waitlist | None = await session.scalar(
+                select(Waitlist)
+                .where(Waitlist.tenant == current_tenant.get())
+                .order_by(Waitlist.id)
+                .limit(1),
+            )
+        if waitlisted is None:
+            return None
+        user_id, activity = await create_user(
+            waitlisted.name,
+            waitlisted.activity,
+        )
+        if user_id is None and await is_quota_over():
+            return None
+        async with shards[0].session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(Waitlist).where(Waitlist.id == waitlisted.id),
+                )
+        if user_id is not None:
+            return user_id, activity, waitlisted.chat_id
+
+
+async def rebalance_shards(
+    batch_size: int = 100,
+    on_progress: Callable[[Shard, int], None] | None = None,
+) -> int:
+    """
+    Move the users with their records to their shards by the hash ring.
+
+    Run it with the bot stopped after adding shards, moved users get new IDs.
+    A user is copied before it's deleted, so an interrupted run can be
+    repeated. The users quota counters of the moved users' tenants are
+    recounted from the shards after the move.
+
+    Args:
+        batch_size: The users checked per batch.
+        on_progress: Called with the shard and the last checked user ID
+            after each batch.
+
+    Returns:
+        The number of moved users.
+    """
+    # Create the tables of the new shards
+    await init_models()
+    moved = 0
+    tenants = set()
+    for shard in shards:
+        last_id = 0
+        while True:
+            async with shard.session() as session:
+                users: list[User] = (
+                    await session.scalars(
+                        select(User)
+                        .where(User.id > last_id)
+                        .order_by(User.id)
+                        .limit(batch_size),
+                    )
+                ).all()
+            if not users:
+                break
+            last_id = users[-1].id
+            for user in users:
+                target = get_user_shard(user.name)
+                if target is shard:
+                    continue
+                await move_user(user, shard, target)
+                tenants.add(user.tenant)
+                moved += 1
+            if on_progress is not None:
+                on_progress(shard, last_id)
+    # Recount from the users the shards have after the move
+    for tenant in tenants:
+        token = current_tenant.set(tenant)
+        try:
+            await sync_users_quota()
+        finally:
+            current_tenant.reset(token)
+    return moved
+
+
+async def move_user(user: User, source: Shard, target: Shard) -> None:
+    """
+    Copy the user with the records to the target shard and delete it.
+
+    The user's rollups are moved in the copy and the delete transactions,
+    the copy is recorded as the change event of the new user ID.
+    """
+    token = current_tenant.set(user.tenant)
+    try:
+        async with source.session() as session:
+            records: list[tuple[datetime.datetime, int | None]] = (
+                await session.execute(
+                    select(Record.date, Record.activity_id)
+                    .where(Record.user_id == user.id)
+                    .order_by(Record.id),
+                )
+            ).all()
+            activity_names: dict[int, str] = dict(
+                (
+                    await session.execute(
+                        select(Activity.id, Activity.name).where(
+                            Activity.user_id == user.id,
+                        ),
+                    )
+                ).all(),
+            )
+        dates = [date for date, _ in records]
+        intervals: Counter[int] = Counter()
+        for _, timeline in itertools.groupby(
+            sorted(records, key=lambda row: row[1] or 0),
+            key=lambda row: row[1],
+        ):
+            intervals += count_intervals([date for date, _ in timeline])
+        async with target.session() as session:
+            async with session.begin():
+                copied = await session.scalar(
+                    select(User).where(
+                        User.tenant == user.tenant,
+                        User.name == user.name,
+                    ),
+                )
+                # A copy of an interrupted run has the rollups already
+                if copied is None:
+                    activities = {
+                        activity_id: Activity(name=name)
+                        for activity_id, name in activity_names.items()
+                    }
+                    copied = User(
+                        tenant=user.tenant,
+                        name=user.name,
+                        activity=user.activity,
+                        activities=list(activities.values()),
+                        records=[
+                            Record(
+                                date=date,
+                                activity=activities.get(activity_id),
+                            )
+                            for date, activity_id in records
+                        ],
+                    )
+                    session.add(copied)
+                    await session.flush()
+                    await update_rollups(session, copied.id, dates, intervals)
+                    add_event(
+                        session,
+                        'user_moved',
+                        to_global_id(target.index, copied.id),
+                        name=user.name,
+                        from_user_id=to_global_id(source.index, user.id),
+                    )
+        async with source.session() as session:
+            async with session.begin():
+                await update_rollups(
+                    session,
+                    user.id,
+                    dates,
+                    intervals,
+                    sign=-1,
+                )
+                await session.delete(await session.get(User, user.id))
+    finally:
+        current_tenant.reset(token)
@@ -0,0 +1,103 @@
+"""
+Logging settings.
+
+Log records are put on a queue by the app and written to the rotated log file
+by the listener thread, so the event loop doesn't wait for the disk.
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from queue import SimpleQueue
+
+from decouple import Csv, config
+
+LOG_LEVEL = config('LOG_LEVEL', default='DEBUG')
+# Per logger levels, e.g. `httpx=WARNING,sqlalchemy.engine=INFO`
+LOG_LEVELS = config('LOG_LEVELS', default='', cast=Csv())
+LOG_JSON = config('LOG_JSON', default=False, cast=bool)
+LOG_MAX_BYTES = config('LOG_MAX_BYTES', default=10 * 1024 * 1024, cast=int)
+LOG_BACKUP_COUNT = config('LOG_BACKUP_COUNT', default=5, cast=int)
+
+LOG_FORMAT = '%(asctime)s %(name)s [%(levelname)s] %(message)s'
+LOG_DATEFMT = '%d.%m.%y %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the record as a JSON object."""
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """Rotate the log file by size and compress the rotated files."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: f'{name}.gz'
+        self.rotator = self.compress
+
+    @staticmethod
+    def compress(source: str, dest: str) -> None:
+        """Compress the rotated log file."""
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+def get_formatter(json_format: bool = LOG_JSON) -> logging.Formatter:
+    """Get the log records formatter."""
+    if json_format:
+        return JsonFormatter(datefmt=LOG_DATEFMT)
+    return logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+
+
+def setup_logging(
+    logfile: Path,
+    level: str = LOG_LEVEL,
+    levels: list[str] = LOG_LEVELS,
+    json_format: bool = LOG_JSON,
+) -> QueueListener:
+    """
+    Configure the non-blocking app logging to the log file.
+
+    Returns:
+        The started listener writing the log file, stop it on app exit.
+    """
+    logfile.parent.mkdir(exist_ok=True)
+    file_handler = CompressedRotatingFileHandler(
+        logfile,
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding='utf-8',
+    )
+    file_handler.setFormatter(get_formatter(json_format))
+    log_queue = SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    for logger_level in levels:
+        name, _, name_level = logger_level.partition('=')
+        logging.getLogger(name.strip()).setLevel(name_level.strip().upper())
+    listener = QueueListener(
+        log_queue,
+        file_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    return listener
@@ -4,53 +4,181 @@ Asynchronous Telegram bot for keeping up with activities timelines.
 Bot commands:
     - `/start` - Start the bot
     - `/database` - Manage the database
+    - `/panel` - Get the status panel with inline buttons
     - `/end` - End the conversation
 """
+import asyncio
+import contextlib
 import datetime
-import logging
-import re
+import html
+import signal
+import sys
+from collections import OrderedDict
 from functools import partial
 from pathlib import Path
 
+import bot_api
+import capture
 import database as db
-from decouple import config
+import metrics
+from decouple import Csv, config
 from exceptions import TeledateError
+from logs import setup_logging
+from metrics import timed_handler
+from profiler import PROFILE, PROFILER, ProfilingApplication
+from router import Command, CommandTable
+from session import (
+    CONTEXT_TYPES,
+    SESSION_SWEEP_INTERVAL,
+    Context,
+    UserSession,
+    evict_idle_sessions,
+)
+from supervisor import WORKERS, Supervisor
 from telegram import ReplyKeyboardMarkup, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    CallbackQueryHandler,
     CommandHandler,
-    ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
-from utils import ReplyMarkups, get_graph, get_time_since
+from utils import (
+    GRAPH_EXECUTOR,
+    Graph,
+    InlineMarkups,
+    ReplyMarkups,
+    get_buckets_graph,
+    get_dashboard,
+    get_graph,
+    get_heatmap,
+    get_time_since,
+    load_pyplot,
+)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 LOGFILE = BASE_DIR / 'data' / 'teledate.log'
 
-LOGFILE.touch(exist_ok=True)
-logging.basicConfig(
-    level=logging.DEBUG,
-    filename=LOGFILE,
-    filemode='w',
-    encoding='utf-8',
-    format='%(asctime)s %(name)s [%(levelname)s] %(message)s',
-    datefmt='%d.%m.%y %H:%M:%S',
+TELEGRAM_TOKEN = config('TELEGRAM_TOKEN', default='123')
+# Tokens of the bots hosted along with the primary one in the same process
+TELEGRAM_TOKENS = config('TELEGRAM_TOKENS', default='', cast=Csv())
+TELEGRAM_API_URL = config(
+    'TELEGRAM_API_URL',
+    default='https://api.telegram.org/bot',
 )
+GRAPH_WARMUP = config('GRAPH_WARMUP', default=True, cast=bool)
+# Telegram usernames allowed to use admin commands
+ADMINS = config('ADMINS', default='', cast=Csv())
+# Start with the status panel message edited in place by its inline buttons
+INLINE_KEYBOARD = config('INLINE_KEYBOARD', default=False, cast=bool)
+# Rendered heatmaps kept for the recently active users
+HEATMAP_CACHE_SIZE = config('HEATMAP_CACHE_SIZE', default=1000, cast=int)
 
+DB, DB_MANAGE, DB_ACTIVITY, MAIN, REMINDER = range(5)
 
-TELEGRAM_TOKEN = config('TELEGRAM_TOKEN', default='123')
+# The bot's tenant is set first, then updates are captured, admin and panel
+# commands are checked before the conversation
+TENANT_GROUP, CAPTURE_GROUP, ADMIN_GROUP, PANEL_GROUP = -4, -3, -2, -1
 
-DB, DB_MANAGE, DB_ACTIVITY, MAIN, REMINDER = range(5)
+# Graph period: (time range, date bucket or None for raw records)
+GRAPH_PERIODS = {
+    'week': (datetime.timedelta(days=7), None),
+    'month': (datetime.timedelta(days=30), 'day'),
+    'year': (datetime.timedelta(days=365), 'week'),
+}
+
+# Days of the admin dashboard graph
+DASHBOARD_DAYS = 30
+INTERVAL_LABELS = [
+    *(f'<{hours}h' for hours in db.INTERVAL_BUCKETS),
+    f'{db.INTERVAL_BUCKETS[-1]}h+',
+]
+
+# Activity names and manual record dates
+NAME_PATTERN = r'([a-zA-Z]|\s|\d){1,50}'
+DATE_TIME_PATTERN = r'\d{2}.\d{2}.\d{4}\s\d{2}:\d{2}'
+
+# Commands of the conversation states
+DB_MANAGE_COMMANDS = CommandTable(
+    {
+        'Create database': Command('create'),
+        'Delete database': Command('delete'),
+        'Delete last record': Command('delete_last_record'),
+        'Cancel': Command('cancel'),
+    },
+)
+DB_ACTIVITY_COMMANDS = CommandTable(
+    {
+        'Cancel': Command('cancel'),
+        'Default': Command('activity', 'Default'),
+    },
+    {'': ('activity', NAME_PATTERN)},
+)
+MAIN_COMMANDS = CommandTable(
+    {
+        'Status': Command('status'),
+        'Graph': Command('graph'),
+        **{
+            f'Graph {period}': Command('graph', period)
+            for period in GRAPH_PERIODS
+        },
+        'Heatmap': Command('heatmap'),
+        'Activities': Command('activities'),
+        'Reminder': Command('reminder'),
+        'Reminder: On': Command('reminder'),
+        'Reminder: Off': Command('reminder'),
+        'Add record': Command('add_record'),
+    },
+    {
+        'New activity ': ('new_activity', NAME_PATTERN),
+        'Track ': ('track', NAME_PATTERN),
+        'Add record ': ('add_record', DATE_TIME_PATTERN),
+    },
+)
+REMINDER_COMMANDS = CommandTable(
+    {
+        'Set': Command('set'),
+        'Unset': Command('unset'),
+        'Cancel': Command('cancel'),
+    },
+    {'Set ': ('set', r'\d{1,2}')},
+)
+# Messages handled by the conversation entry points and fallbacks
+DATABASE_MESSAGES = ['Manage database', '/database']
+START_MESSAGES = ['Start', '/start']
+NAVIGATION_MESSAGES = ['/end', *DATABASE_MESSAGES]
+
+# Rendered heatmaps by database user ID, least recently used first, dropped
+# when user's records change
+heatmap_cache: OrderedDict[int, Graph] = OrderedDict()
+
+# Bots running in this process, sharing the database engines, the metrics
+# server and the graph stack
+running_bots = 0
+metrics_server: asyncio.Server | None = None
 
 
 # Handlers
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def set_tenant(
+    update: Update,
+    context: Context,
+) -> None:
+    """Set the bot's tenant for the database queries of the update."""
+    db.current_tenant.set(context.bot_data['tenant'])
+
+
+@timed_handler
+async def start(update: Update, context: Context) -> int:
     """Start the conversation when `/start` command is issued."""
     username = update.effective_user.username
     if not username:
@@ -59,24 +187,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             reply_markup=ReplyMarkups.end,
         )
         return ConversationHandler.END
-    db_user_id = context.user_data.get('db_user_id')
-    db_user_activity = context.user_data.get('db_user_activity')
-    reminder = context.user_data.get('reminder')
-    if not db_user_id:
-        db_user_id, db_user_activity = await db.get_user_id(
-            username,
-        )
-        (
-            context.user_data['db_user_id'],
-            context.user_data['db_user_activity'],
-        ) = (
-            db_user_id,
-            db_user_activity,
-        )
-    if reminder is None:
-        reminder = context.user_data['reminder'] = bool(
-            context.job_queue.get_jobs_by_name(username),
-        )
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    db_user_activity = session.db_user_activity
+    reminder = session.reminder
+    if db_user_id and INLINE_KEYBOARD:
+        await send_panel(update, db_user_id, db_user_activity, reminder)
+        return MAIN
     if db_user_id:
         await update.effective_message.reply_text(
             fr'*Hello, {username}\!*'
@@ -97,7 +214,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return DB
 
 
-async def database(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@timed_handler
+async def database(update: Update, context: Context) -> int:
     """Get database options when `/database` command is issued."""
     username = update.effective_user.username
     if not username:
@@ -106,41 +224,34 @@ async def database(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             reply_markup=ReplyMarkups.end,
         )
         return ConversationHandler.END
-    db_user_id = context.user_data.get('db_user_id')
-    db_user_activity = context.user_data.get('db_user_activity')
-    if not db_user_id:
-        db_user_id, db_user_activity = await db.get_user_id(
-            update.effective_user.username,
-        )
-        (
-            context.user_data['db_user_id'],
-            context.user_data['db_user_activity'],
-        ) = (
-            db_user_id,
-            db_user_activity,
-        )
-    if db_user_id:
+    session = await get_session(update, context)
+    if session.db_user_id:
         await update.effective_message.reply_text(
             'Database exists. What do you wanna do?',
             reply_markup=ReplyMarkups.db_exists,
         )
         return DB_MANAGE
-    if await db.get_user_count() >= db.USER_LIMIT:
+    position = await db.get_waitlist_position(username)
+    if position:
         await update.effective_message.reply_text(
-            "Can't create the database because the quota is over.",
+            f'You are number {position} in the waitlist. The database will be '
+            'created when a place is free.',
             reply_markup=ReplyMarkups.end,
         )
         return ConversationHandler.END
     await update.effective_message.reply_text(
-        'Create the database?',
+        'The quota is over. Create the database to join the waitlist?'
+        if await db.is_quota_over()
+        else 'Create the database?',
         reply_markup=ReplyMarkups.db_create,
     )
     return DB_MANAGE
 
 
+@timed_handler
 async def database_manage(
     update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
+    context: Context,
 ) -> int:
     """
     Handle the database management with messages.
@@ -151,15 +262,14 @@ async def database_manage(
         - Delete last record - stays in the database management upon deletion
         - Cancel - cancel the operation and gets back to previous state
     """
-    db_user_id = context.user_data.get('db_user_id')
-    message = update.effective_message.text
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    command: Command = context.command
     username = update.effective_user.username
-    current_jobs = context.user_data[
-        'reminder'
-    ] = context.job_queue.get_jobs_by_name(username)
-    reminder = bool(current_jobs)
+    current_jobs = context.job_queue.get_jobs_by_name(username)
+    reminder = session.reminder = bool(current_jobs)
     # Database exists
-    if message == 'Cancel' and db_user_id:
+    if command.name == 'cancel' and db_user_id:
         await update.effective_message.reply_text(
             'Deletion was canceled',
             reply_markup=ReplyMarkups.main_reminder
@@ -167,7 +277,7 @@ async def database_manage(
             else ReplyMarkups.main,
         )
         return MAIN
-    if db_user_id and message == 'Delete database':
+    if db_user_id and command.name == 'delete':
         db_del = await db.delete_user(db_user_id)
         if not db_del:
             await update.effective_message.reply_text(
@@ -175,18 +285,27 @@ async def database_manage(
                 reply_markup=ReplyMarkups.end,
             )
             return ConversationHandler.END
-        del context.user_data['db_user_id']
-        del context.user_data['db_user_activity']
-        if reminder:
-            for job in current_jobs:
-                job.schedule_removal()
-        context.user_data['reminder'] = False
+        heatmap_cache.pop(db_user_id, None)
+        session.clear()
+        for job in current_jobs:
+            job.schedule_removal()
         await update.effective_message.reply_text(
             'Database has been deleted',
             reply_markup=ReplyMarkups.end,
         )
+        admitted = await db.admit_from_waitlist()
+        # The admitted user could block the bot or delete the chat, the
+        # database is found by their next /start anyway
+        if admitted:
+            with contextlib.suppress(BadRequest, Forbidden):
+                await context.bot.send_message(
+                    admitted[2],
+                    '*Database has been created*\n\n'
+                    'A place of the quota is free, use /start to begin',
+                    parse_mode=ParseMode.MARKDOWN_V2,
+                )
         return ConversationHandler.END
-    if db_user_id and message == 'Delete last record':
+    if db_user_id and command.name == 'delete_last_record':
         last_record_del = await db.delete_last_record(db_user_id)
         if not last_record_del:
             await update.effective_message.reply_text(
@@ -194,10 +313,8 @@ async def database_manage(
                 reply_markup=ReplyMarkups.db_exists,
             )
             return None
-        if reminder:
-            for job in current_jobs:
-                job.schedule_removal()
-        context.user_data['reminder'] = False
+        heatmap_cache.pop(db_user_id, None)
+        await unset_reminder(context, username)
         await update.effective_message.reply_text(
             'The last record has been deleted',
             reply_markup=ReplyMarkups.db_exists,
@@ -205,7 +322,7 @@ async def database_manage(
         return None
 
     # Database doesn't exists
-    if not db_user_id and message == 'Create database':
+    if not db_user_id and command.name == 'create':
         await update.effective_message.reply_text(
             'What is your activity?',
             reply_markup=ReplyMarkups.db_activity,
@@ -218,9 +335,10 @@ async def database_manage(
     return ConversationHandler.END
 
 
+@timed_handler
 async def database_activity(
     update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
+    context: Context,
 ) -> int | None:
     """
     Set up the database activity name with messages.
@@ -230,22 +348,31 @@ async def database_activity(
         - Default - set Default name for the activity
         - Cancel - cancel the operation and gets back to the previous state
     """
-    message = update.effective_message.text
+    command: Command = context.command
     username = update.effective_user.username
-    if message == 'Cancel':
+    if command.name == 'cancel':
         await update.effective_message.reply_text(
             'Database was not created',
             reply_markup=ReplyMarkups.end,
         )
         return ConversationHandler.END
     try:
-        activity = message.capitalize() if message else 'Default'
-        if not re.match(
-            r'^([a-zA-Z]|\s|\d){1,50}$',
+        activity = command.argument.capitalize()
+        db_user_id, activity = await db.create_user(
+            username,
             activity,
-        ):
-            raise TeledateError
-        db_user_id, activity = await db.create_user(username, activity)
+            update.effective_chat.id,
+        )
+        if not db_user_id:
+            position = await db.get_waitlist_position(username)
+            if not position:
+                raise TeledateError
+            await update.effective_message.reply_text(
+                f'The quota is over. You are number {position} in the '
+                'waitlist, the database will be created when a place is free.',
+                reply_markup=ReplyMarkups.end,
+            )
+            return ConversationHandler.END
         await update.effective_message.reply_text(
             '*Database has been created*\n\n'
             + r'To create manual record use this format\:'
@@ -254,8 +381,8 @@ async def database_activity(
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=ReplyMarkups.main,
         )
-        context.user_data['db_user_id'] = db_user_id
-        context.user_data['db_user_activity'] = activity
+        context.user_data.db_user_id = db_user_id
+        context.user_data.db_user_activity = activity
         return MAIN
     except TeledateError:
         await update.effective_message.reply_text(
@@ -264,28 +391,31 @@ async def database_activity(
         return None
 
 
+@timed_handler
 async def main_messages(
     update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
+    context: Context,
 ) -> int | None:
     """
     Handle bot main menu with messages.
 
     Messages:
         - Status - get the current record info
-        - Graph - get a graph of user's records
+        - Graph [week|month|year] - get a graph of user's records
+        - Heatmap - get user's records per weekday and hour of the day
+        - Activities - get the last records of all user's activities
+        - New activity <name> - create one more user's activity
+        - Track <name> - add a new record of the user's activity
         - Reminder - proceed to the reminder settings
         - Add record [params] - add a new user's record
     """
     username = update.effective_user.username
-    db_user_id = context.user_data.get('db_user_id')
-    db_user_activity = context.user_data.get('db_user_activity')
-    reminder = context.user_data.get('reminder')
-    add_record_msg = re.compile(
-        r'^Add record(\s\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})?$',
-    )
-    match update.effective_message.text:
-        case 'Status':
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    db_user_activity = session.db_user_activity
+    reminder = session.reminder
+    match context.command:
+        case Command('status'):
             status = await get_status(db_user_id)
             if not status:
                 await update.effective_message.reply_text(
@@ -294,22 +424,72 @@ async def main_messages(
                 return None
             record_date, time_since = status
             text = f'*{db_user_activity}*\n\n`{record_date}`\n{time_since} ago'
-        case 'Graph':
-            records_dt = await db.get_user_records(db_user_id)
+        case Command('graph', period):
+            text = 'No records have been created'
+            try:
+                graph = await get_period_graph(
+                    db_user_id,
+                    db_user_activity,
+                    period,
+                )
+                if graph:
+                    metrics.REGISTRY.observe(
+                        metrics.GRAPH_UPLOAD_BYTES,
+                        len(graph.data),
+                        graph=f'graph_{period}' if period else 'graph',
+                    )
+                    await update.effective_message.reply_photo(
+                        graph.data,
+                        filename=graph.filename,
+                        reply_markup=ReplyMarkups.main_reminder
+                        if reminder
+                        else ReplyMarkups.main,
+                    )
+                    return None
+            except TeledateError:
+                text = "Can't load the graph"
+        case Command('heatmap'):
             text = 'No records have been created'
-            if records_dt:
-                try:
-                    graph = await get_graph(records_dt, db_user_activity)
+            try:
+                graph = await get_heatmap_graph(db_user_id, db_user_activity)
+                if graph:
+                    metrics.REGISTRY.observe(
+                        metrics.GRAPH_UPLOAD_BYTES,
+                        len(graph.data),
+                        graph='heatmap',
+                    )
                     await update.effective_message.reply_photo(
-                        graph,
+                        graph.data,
+                        filename=graph.filename,
                         reply_markup=ReplyMarkups.main_reminder
                         if reminder
                         else ReplyMarkups.main,
                     )
                     return None
-                except TeledateError:
-                    text = "Can't load the graph"
-        case 'Reminder' | 'Reminder: On' | 'Reminder: Off':
+            except TeledateError:
+                text = "Can't load the graph"
+        case Command('activities'):
+            text = await get_activities_text(db_user_id)
+        case Command('new_activity', name):
+            name = name.strip().capitalize()
+            text = (
+                f'*{name}* activity has been created\n\n`Track {name}`'
+                if await db.create_activity(db_user_id, name)
+                else "Can't create the activity, it exists or the limit "
+                f'of {db.ACTIVITY_LIMIT} activities is reached'
+            )
+        case Command('track', name):
+            name = name.strip().capitalize()
+            text = 'No such activity, create it with\n`New activity <name>`'
+            tracked = await db.track_activity(db_user_id, name)
+            if tracked:
+                record_date, cleared = tracked
+                # Moscow Time (UTC+3)
+                record_date += datetime.timedelta(hours=3)
+                text = f'*{name}*\n\n`{record_date:%d.%m.%Y %H:%M}`\n'
+                if cleared:
+                    text += 'Old records have been deleted'
+        case Command('reminder'):
             if not await db.get_last_user_record(db_user_id):
                 await update.effective_message.reply_text(
                     'You have no records',
@@ -332,22 +512,15 @@ async def main_messages(
                 else ReplyMarkups.set,
             )
             return REMINDER
-        case add_record_msg:
-            year_time: list | None = re.findall(
-                r'(\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})',
-                add_record_msg,
-            )
-            created = await add_record(db_user_id, *year_time)
+        case Command('add_record', year_time):
+            created = await add_record(db_user_id, year_time)
             if not created:
                 await update.effective_message.reply_text(
                     "Can't create a record",
                 )
                 return None
             if reminder:
-                current_jobs = context.job_queue.get_jobs_by_name(username)
-                for job in current_jobs:
-                    job.schedule_removal()
-                context.user_data['reminder'] = False
+                await unset_reminder(context, username)
             text = f'*{db_user_activity}*\n\n{created}'
     await update.effective_message.reply_text(
         text,
@@ -359,9 +532,10 @@ async def main_messages(
     return None
 
 
+@timed_handler
 async def reminder_manage(
     update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
+    context: Context,
 ) -> int | None:
     """
     Schedule or unschedule the reminder task with messages.
@@ -372,8 +546,8 @@ async def reminder_manage(
         - Unset - unschedule the reminder task and proceed to the main menu
         - Cancel - cancel the operation and get back to the main menu
     """
-    command = update.effective_message.text
-    if command == 'Cancel':
+    command: Command = context.command
+    if command.name == 'cancel':
         await update.effective_message.reply_text(
             'Operation was canceled',
             reply_markup=ReplyMarkups.main_reminder,
@@ -381,49 +555,30 @@ async def reminder_manage(
         return MAIN
     chat_id = update.effective_message.chat_id
     username = update.effective_user.username
-    db_user_id = context.user_data.get('db_user_id')
-    db_user_activity = context.user_data.get('db_user_activity')
-    reminder = context.user_data.get('reminder')
-    unset: list | None = re.findall(r'^Unset$', command)
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    db_user_activity = session.db_user_activity
+    reminder = session.reminder
+    unset = command.name == 'unset'
     try:
         if reminder:
-            current_jobs = context.job_queue.get_jobs_by_name(username)
-            for job in current_jobs:
-                job.schedule_removal()
+            await unset_reminder(context, username)
             if unset:
-                context.user_data['reminder'] = False
                 await update.effective_message.reply_text(
                     'Reminder has been disabled',
                     reply_markup=ReplyMarkups.main,
                 )
                 return MAIN
         if not unset:
-            params: list | None = re.findall(r'(\d{1,2})', command)
-            interval = datetime.timedelta(hours=48)
-            every_hours = 48
-            if params:
-                interval = datetime.timedelta(hours=int(params[0]))
-                every_hours = int(params[0])
-            record_date: datetime.datetime = await db.get_last_user_record(
+            every_hours = int(command.argument or 48)
+            message = await set_reminder(
+                context,
+                chat_id,
+                username,
                 db_user_id,
+                db_user_activity,
+                every_hours,
             )
-            # Moscow Time (UTC+3)
-            start = record_date + datetime.timedelta(hours=3)
-            # interval = 5  # For 5 sec inteval tests
-            message = (
-                f'{db_user_activity}\n\n'
-                f'The reminder has been set on {start.strftime("%H:%M")} '
-                f'for every {every_hours} hours'
-            )
-            context.job_queue.run_repeating(
-                alarm,
-                interval,
-                first=record_date,
-                chat_id=chat_id,
-                name=username,
-                data=(db_user_id, db_user_activity, message),
-            )
-            context.user_data['reminder'] = True
             await update.effective_message.reply_text(
                 message,
                 reply_markup=ReplyMarkups.main_reminder,
@@ -436,9 +591,10 @@ async def reminder_manage(
         )
 
 
+@timed_handler
 async def invalid_input(
     update: Update,
-    context: ContextTypes.DEFAULT_TYPE,
+    context: Context,
     keyboard_markup: ReplyKeyboardMarkup = None,
     extra_message: str = None,
 ) -> None:
@@ -450,7 +606,8 @@ async def invalid_input(
     )
 
 
-async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@timed_handler
+async def end(update: Update, context: Context) -> int:
     """End the conversation when `/end` command is issued."""
     username = update.effective_user.username
     message = (
@@ -465,6 +622,174 @@ async def end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed_handler
+async def panel(update: Update, context: Context) -> None:
+    """Send the status panel message when `/panel` command is issued."""
+    username = update.effective_user.username
+    if not username:
+        await update.effective_message.reply_text(
+            'To work with me you need to set up your Telegram username',
+            reply_markup=ReplyMarkups.end,
+        )
+        raise ApplicationHandlerStop
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    db_user_activity = session.db_user_activity
+    if not db_user_id:
+        await update.effective_message.reply_text(
+            'Database does not exists. Try to set up one?',
+            reply_markup=ReplyMarkups.start,
+        )
+        raise ApplicationHandlerStop
+    reminder = session.reminder = bool(
+        context.job_queue.get_jobs_by_name(username),
+    )
+    await send_panel(update, db_user_id, db_user_activity, reminder)
+    raise ApplicationHandlerStop
+
+
+@timed_handler
+async def panel_button(
+    update: Update,
+    context: Context,
+) -> None:
+    """
+    Handle the status panel buttons by editing the panel message in place.
+
+    Buttons:
+        - Status - refresh the current record info
+        - Add record - add a new user's record
+        - Reminder - switch the reminder with the default interval
+    """
+    query = update.callback_query
+    await query.answer()
+    username = update.effective_user.username
+    session = await get_session(update, context)
+    db_user_id = session.db_user_id
+    db_user_activity = session.db_user_activity
+    if not username or not db_user_id:
+        await query.edit_message_text('Database does not exists')
+        raise ApplicationHandlerStop
+    reminder = bool(context.job_queue.get_jobs_by_name(username))
+    match query.data:
+        case 'panel:add':
+            created = await add_record(db_user_id)
+            text = "Can't create a record"
+            if created:
+                text = f'*{db_user_activity}*\n\n{created}'
+                if reminder:
+                    await unset_reminder(context, username)
+                    reminder = False
+        case 'panel:reminder' if reminder:
+            await unset_reminder(context, username)
+            reminder = False
+            text = f'*{db_user_activity}*\n\nReminder has been disabled'
+        case 'panel:reminder':
+            text = 'You have no records'
+            if await db.get_last_user_record(db_user_id):
+                text = escape_markdown(
+                    await set_reminder(
+                        context,
+                        query.message.chat_id,
+                        username,
+                        db_user_id,
+                        db_user_activity,
+                    ),
+                    version=2,
+                )
+                reminder = True
+        case _:
+            text = await get_panel_text(db_user_id, db_user_activity)
+    try:
+        await query.edit_message_text(
+            text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+            reply_markup=InlineMarkups.panel_reminder
+            if reminder
+            else InlineMarkups.panel,
+        )
+    except BadRequest as error:
+        # The refreshed status can be the same as the shown one
+        if 'not modified' not in error.message:
+            raise
+    raise ApplicationHandlerStop
+
+
+@timed_handler
+async def metrics_report(
+    update: Update,
+    context: Context,
+) -> None:
+    """Send the app metrics when `/metrics` command is issued by an admin."""
+    report = html.escape(metrics.REGISTRY.report()[:4000])
+    await update.effective_message.reply_text(
+        f'<pre>{report}</pre>',
+        parse_mode=ParseMode.HTML,
+    )
+    raise ApplicationHandlerStop
+
+
+@timed_handler
+async def profile(update: Update, context: Context) -> None:
+    """Switch the profiler when `/profile on|off` is issued by an admin."""
+    match context.args:
+        case ['on']:
+            PROFILER.start()
+        case ['off']:
+            PROFILER.stop()
+    await update.effective_message.reply_text(
+        f'Profiler is {"on" if PROFILER.enabled else "off"}\n'
+        f'Threshold: {PROFILER.threshold} sec\n\n'
+        'Usage: /profile on|off',
+    )
+    raise ApplicationHandlerStop
+
+
+@timed_handler
+async def slowest(update: Update, context: Context) -> None:
+    """Send the slowest profiled updates when `/slowest` is issued."""
+    report = html.escape(PROFILER.report()[:4000])
+    await update.effective_message.reply_text(
+        f'<pre>{report}</pre>',
+        parse_mode=ParseMode.HTML,
+    )
+    raise ApplicationHandlerStop
+
+
+@timed_handler
+async def dashboard(
+    update: Update,
+    context: Context,
+) -> None:
+    """Send the rollups graphs when `/dashboard` is issued by an admin."""
+    last_day = db.get_day(datetime.datetime.utcnow())
+    day = last_day - datetime.timedelta(days=DASHBOARD_DAYS - 1)
+    daily = await db.get_daily_records(day, last_day)
+    days = []
+    while day <= last_day:
+        days.append((day, *daily.get(day, (0, 0))))
+        day += datetime.timedelta(days=1)
+    graph = await get_dashboard(
+        days,
+        await db.get_interval_records(),
+        INTERVAL_LABELS,
+    )
+    metrics.REGISTRY.observe(
+        metrics.GRAPH_UPLOAD_BYTES,
+        len(graph.data),
+        graph='dashboard',
+    )
+    users, records = daily.get(last_day, (0, 0))
+    await update.effective_message.reply_photo(
+        graph.data,
+        filename=graph.filename,
+        caption=f'Today: {users} active users, {records} records\n'
+        f'Last {DASHBOARD_DAYS} days: '
+        f'{sum(records for _, _, records in days)} records',
+    )
+    raise ApplicationHandlerStop
+
+
 # Helpers
 
 
@@ -487,6 +812,205 @@ async def get_status(db_user_id: int) -> tuple[str] | None:
     )
 
 
+async def get_session(update: Update, context: Context) -> UserSession:
+    """
+    Get the user's session, loaded from the database after its eviction.
+
+    The database user is looked up again until the user has one, so the
+    users admitted from the waitlist are found.
+
+    Returns:
+        The user's session.
+    """
+    session: UserSession = context.user_data
+    session.touch()
+    username = update.effective_user.username
+    if not username:
+        return session
+    if not session.db_user_id:
+        (
+            session.db_user_id,
+            session.db_user_activity,
+        ) = await db.get_user_id(username)
+    if session.reminder is None:
+        session.reminder = bool(context.job_queue.get_jobs_by_name(username))
+    return session
+
+
+async def get_panel_text(db_user_id: int, db_user_activity: str) -> str:
+    """Get the status panel text with the current record info."""
+    status = await get_status(db_user_id)
+    if not status:
+        return f'*{db_user_activity}*\n\nNo records have been created'
+    record_date, time_since = status
+    return f'*{db_user_activity}*\n\n`{record_date}`\n{time_since} ago'
+
+
+async def send_panel(
+    update: Update,
+    db_user_id: int,
+    db_user_activity: str,
+    reminder: bool,
+) -> None:
+    """Send the status panel message with the inline buttons."""
+    await update.effective_message.reply_text(
+        await get_panel_text(db_user_id, db_user_activity),
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=InlineMarkups.panel_reminder
+        if reminder
+        else InlineMarkups.panel,
+    )
+
+
+async def set_reminder(
+    context: Context,
+    chat_id: int,
+    username: str,
+    db_user_id: int,
+    db_user_activity: str,
+    every_hours: int = 48,
+) -> str:
+    """
+    Schedule the reminder task for the current user's record.
+
+    Returns:
+        The reminder info message.
+    """
+    record_date: datetime.datetime = await db.get_last_user_record(
+        db_user_id,
+    )
+    # Moscow Time (UTC+3)
+    start = record_date + datetime.timedelta(hours=3)
+    # interval = 5  # For 5 sec inteval tests
+    message = (
+        f'{db_user_activity}\n\n'
+        f'The reminder has been set on {start.strftime("%H:%M")} '
+        f'for every {every_hours} hours'
+    )
+    context.job_queue.run_repeating(
+        alarm,
+        datetime.timedelta(hours=every_hours),
+        first=record_date,
+        chat_id=chat_id,
+        name=username,
+        data=(db_user_id, db_user_activity, message),
+    )
+    context.user_data.reminder = True
+    await db.record_event(
+        'reminder_set',
+        db_user_id,
+        every_hours=every_hours,
+        first=record_date.isoformat(),
+    )
+    return message
+
+
+async def unset_reminder(
+    context: Context,
+    username: str,
+) -> None:
+    """Unschedule the user's reminder tasks."""
+    current_jobs = context.job_queue.get_jobs_by_name(username)
+    for job in current_jobs:
+        job.schedule_removal()
+    context.user_data.reminder = False
+    if current_jobs:
+        # The job data starts with the database user ID
+        await db.record_event('reminder_unset', current_jobs[0].data[0])
+
+
+async def get_activities_text(db_user_id: int) -> str:
+    """Get the last record info of each user's activity."""
+    lines = []
+    for name, record_dt in await db.get_activities_last_records(db_user_id):
+        if not record_dt:
+            lines.append(f'*{name}*\nNo records')
+            continue
+        time_since = get_time_since(record_dt)
+        # Moscow Time (UTC+3)
+        record_dt += datetime.timedelta(hours=3)
+        lines.append(
+            f'*{name}*\n`{record_dt:%d.%m.%Y %H:%M:%S}`\n{time_since} ago',
+        )
+    return '\n\n'.join(lines)
+
+
+async def get_period_graph(
+    db_user_id: int,
+    db_user_activity: str,
+    period: str | None = None,
+) -> Graph | None:
+    """
+    Get a graph of user's records for the period.
+
+    Records of a month or a year are counted per day or per week on the
+    database side, so only one point per bar is loaded.
+
+    Returns:
+        The graph image, None if there are no records for the period.
+    """
+    if period is None:
+        records_dt = await db.get_user_records(db_user_id)
+        if not records_dt:
+            return None
+        return await get_graph(records_dt, db_user_activity)
+    time_range, bucket = GRAPH_PERIODS[period]
+    end = datetime.datetime.utcnow()
+    start = end - time_range
+    if bucket is None:
+        records_dt = await db.get_user_records_range(db_user_id, start, end)
+        if not records_dt:
+            return None
+        return await get_graph(records_dt, f'{db_user_activity} ({period})')
+    counts = dict(
+        await db.get_user_records_buckets(db_user_id, start, end, bucket),
+    )
+    if not counts:
+        return None
+    # Moscow Time (UTC+3)
+    bucket_date = (start + datetime.timedelta(hours=3)).date()
+    last_date = (end + datetime.timedelta(hours=3)).date()
+    step = datetime.timedelta(days=1)
+    if bucket == 'week':
+        bucket_date -= datetime.timedelta(days=bucket_date.weekday())
+        step = datetime.timedelta(weeks=1)
+    buckets = []
+    while bucket_date <= last_date:
+        buckets.append((bucket_date, counts.get(bucket_date, 0)))
+        bucket_date += step
+    return await get_buckets_graph(
+        buckets,
+        f'{db_user_activity} ({period})',
+        xlabel='Week' if bucket == 'week' else 'Date',
+    )
+
+
+async def get_heatmap_graph(
+    db_user_id: int,
+    db_user_activity: str,
+) -> Graph | None:
+    """
+    Get the cached heatmap of user's records or render a new one.
+
+    Returns:
+        The heatmap image, None if there are no records.
+    """
+    graph = heatmap_cache.get(db_user_id)
+    if graph is not None:
+        heatmap_cache.move_to_end(db_user_id)
+        return graph
+    matrix = await db.get_user_records_matrix(db_user_id)
+    if not any(map(any, matrix)):
+        return None
+    graph = heatmap_cache[db_user_id] = await get_heatmap(
+        matrix,
+        db_user_activity,
+    )
+    if len(heatmap_cache) > HEATMAP_CACHE_SIZE:
+        heatmap_cache.popitem(last=False)
+    return graph
+
+
 async def add_record(
     db_user_id: int,
     year_time: str | None = None,
@@ -534,6 +1058,7 @@ async def add_record(
             record_date = (record_date + datetime.timedelta(hours=3)).strftime(
                 '%d.%m.%Y %H:%M',
             )
+        heatmap_cache.pop(db_user_id, None)
         return f'`{record_date}`\n{extra_message}'
     except TeledateError:
         return None
@@ -552,7 +1077,8 @@ async def clear_old_record(db_user_id: str) -> bool:
     return False
 
 
-async def alarm(context: ContextTypes.DEFAULT_TYPE) -> None:
+@timed_handler
+async def alarm(context: Context) -> None:
     """Send the alarm message to a user."""
     db_user_id, db_user_activity, starting_hour = context.job.data
     record_info, time_since = await get_status(db_user_id)
@@ -566,43 +1092,127 @@ async def alarm(context: ContextTypes.DEFAULT_TYPE) -> None:
 # Main bot cycle
 
 
-def main() -> None:
-    """Start the main bot cycle."""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def start_services() -> None:
+    """Set up the database, the metrics and the graph stack of the bots."""
+    global metrics_server
+    if db.async_engine is None:
+        db.init_engine()
+    for shard in db.shards:
+        metrics.instrument_engine(shard.engine)
+        metrics.instrument_engine(shard.replica_engine)
+    await db.init_models()
+    metrics_server = await metrics.start_server()
+    if PROFILE:
+        PROFILER.start()
+    if capture.RECORDER is not None:
+        capture.RECORDER.open()
+    if GRAPH_WARMUP:
+        # Import matplotlib off the event loop, so updates aren't delayed
+        asyncio.get_running_loop().run_in_executor(GRAPH_EXECUTOR, load_pyplot)
+
+
+async def stop_services() -> None:
+    """Release the database connections and stop the metrics server."""
+    global metrics_server
+    PROFILER.stop()
+    if capture.RECORDER is not None:
+        capture.RECORDER.close()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+    await db.dispose_engine()
+
+
+async def migrate_database() -> None:
+    """Migrate the schema of the database shards."""
+    db.init_engine()
+    try:
+        await db.init_models()
+    finally:
+        await db.dispose_engine()
+
+
+async def post_init(application: Application) -> None:
+    """Set up the shared services for the first bot on app startup."""
+    global running_bots
+    running_bots += 1
+    if running_bots == 1:
+        await start_services()
+    if application.job_queue:
+        metrics.instrument_job_queue(application.job_queue)
+        application.job_queue.run_repeating(
+            evict_idle_sessions,
+            SESSION_SWEEP_INTERVAL,
+            first=SESSION_SWEEP_INTERVAL,
+        )
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop the shared services after the last bot on app shutdown."""
+    global running_bots
+    running_bots -= 1
+    if not running_bots:
+        await stop_services()
+
+
+def get_tenant(token: str) -> str:
+    """Get the tenant ID of the bot, its bot ID."""
+    return token.split(':', 1)[0]
+
+
+def build_application(
+    token: str = TELEGRAM_TOKEN,
+    request: BaseRequest | None = None,
+    base_url: str = TELEGRAM_API_URL,
+    updates_request: BaseRequest | None = None,
+    tenant: str = db.DEFAULT_TENANT,
+) -> Application:
+    """
+    Build the bot application with all the handlers.
+
+    The custom request, if given, is used for all the Bot API calls unless
+    the updates request is given too, otherwise the polling and the outbound
+    calls use separate tuned pools. The users of the bot are kept apart from
+    the other bots' ones by the tenant ID.
+    """
+    builder = (
+        Application.builder()
+        .application_class(ProfilingApplication)
+        .token(token)
+        .base_url(base_url)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .context_types(CONTEXT_TYPES)
+    )
+    if request is None:
+        request = bot_api.create_request()
+        updates_request = updates_request or bot_api.create_updates_request()
+    builder = builder.request(request).get_updates_request(
+        updates_request or request,
+    )
+    application = builder.build()
+    application.bot_data['tenant'] = tenant
     conv_handler = ConversationHandler(
         entry_points=[
-            MessageHandler(
-                filters.Regex(r'^(Manage database|/database)$'),
-                database,
-            ),
-            MessageHandler(filters.Regex(r'^(Start|/start)$'), start),
+            MessageHandler(filters.Text(DATABASE_MESSAGES), database),
+            MessageHandler(filters.Text(START_MESSAGES), start),
         ],
         states={
             DB: [
                 MessageHandler(
-                    ~filters.Regex(r'^(/end|Manage database|/database)$'),
+                    ~filters.Text(NAVIGATION_MESSAGES),
                     invalid_input,
                 ),
             ],
             DB_MANAGE: [
-                MessageHandler(
-                    filters.Regex(
-                        r'^(Create database|Delete database|Delete last record'
-                        r'|Cancel)$',
-                    ),
-                    database_manage,
-                ),
-                MessageHandler(~filters.Regex('^(/end)$'), invalid_input),
+                MessageHandler(DB_MANAGE_COMMANDS, database_manage),
+                MessageHandler(~filters.Text(['/end']), invalid_input),
             ],
             DB_ACTIVITY: [
+                MessageHandler(DB_ACTIVITY_COMMANDS, database_activity),
                 MessageHandler(
-                    filters.Regex(
-                        r'^(Default|Cancel|([a-zA-Z]|\s|\d){1,50})$',
-                    ),
-                    database_activity,
-                ),
-                MessageHandler(
-                    ~filters.Regex('^(/end)$'),
+                    ~filters.Text(['/end']),
                     partial(
                         invalid_input,
                         extra_message=(
@@ -612,15 +1222,9 @@ def main() -> None:
                 ),
             ],
             MAIN: [
+                MessageHandler(MAIN_COMMANDS, main_messages),
                 MessageHandler(
-                    filters.Regex(
-                        r'^(Status|Reminder(:\s(On|Off))?|Graph|'
-                        r'Add record(\s\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})?)$',
-                    ),
-                    main_messages,
-                ),
-                MessageHandler(
-                    ~filters.Regex(r'^(/end|Manage database|/database)$'),
+                    ~filters.Text(NAVIGATION_MESSAGES),
                     partial(
                         invalid_input,
                         extra_message=(
@@ -631,25 +1235,44 @@ def main() -> None:
                 ),
             ],
             REMINDER: [
+                MessageHandler(REMINDER_COMMANDS, reminder_manage),
                 MessageHandler(
-                    filters.Regex(r'^(Set(\s\d{1,2})?|Unset|Cancel)$'),
-                    reminder_manage,
-                ),
-                MessageHandler(
-                    ~filters.Regex(r'^(/end|Manage database|/database)$'),
+                    ~filters.Text(NAVIGATION_MESSAGES),
                     invalid_input,
                 ),
             ],
         },
         fallbacks=[
             CommandHandler('end', end),
-            MessageHandler(
-                filters.Regex(r'^(Manage database|/database)$'),
-                database,
-            ),
+            MessageHandler(filters.Text(DATABASE_MESSAGES), database),
         ],
     )
 
+    application.add_handler(
+        TypeHandler(Update, set_tenant),
+        group=TENANT_GROUP,
+    )
+    if capture.RECORDER is not None:
+        application.add_handler(
+            TypeHandler(Update, capture.capture_update),
+            group=CAPTURE_GROUP,
+        )
+    admin_filter = filters.User(username=ADMINS)
+    for command, callback in (
+        ('metrics', metrics_report),
+        ('profile', profile),
+        ('slowest', slowest),
+        ('dashboard', dashboard),
+    ):
+        application.add_handler(
+            CommandHandler(command, callback, filters=admin_filter),
+            group=ADMIN_GROUP,
+        )
+    application.add_handler(CommandHandler('panel', panel), group=PANEL_GROUP)
+    application.add_handler(
+        CallbackQueryHandler(panel_button, pattern=r'^panel:'),
+        group=PANEL_GROUP,
+    )
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('end', end))
     application.add_handler(
@@ -658,7 +1281,71 @@ def main() -> None:
             partial(invalid_input, keyboard_markup=ReplyMarkups.end),
         ),
     )
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
+
+
+async def run_bots(tokens: list[str]) -> None:
+    """
+    Run the bots in one event loop until interrupted.
+
+    The bots share the database engines, the graph stack and the outbound
+    connection pool, each one polls the updates with its own connection. The
+    first bot is the primary one, the others' tenants are their bot IDs.
+    """
+    request = bot_api.create_request()
+    applications = [
+        build_application(
+            token,
+            request=request,
+            updates_request=bot_api.create_updates_request(),
+            tenant=get_tenant(token) if index else db.DEFAULT_TENANT,
+        )
+        for index, token in enumerate(tokens)
+    ]
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    async with contextlib.AsyncExitStack() as stack:
+        for application in applications:
+            await stack.enter_async_context(application)
+            await post_init(application)
+            stack.push_async_callback(post_shutdown, application)
+            await application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await application.start()
+            stack.push_async_callback(stop_application, application)
+        await stopped.wait()
+
+
+async def stop_application(application: Application) -> None:
+    """Stop polling and handling the updates of the bot."""
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+
+
+def main() -> None:
+    """Start the main bot cycle."""
+    if WORKERS > 1 and TELEGRAM_TOKENS:
+        # The workers serve the updates of the primary bot only
+        sys.exit('TELEGRAM_TOKENS bots are not supported with WORKERS > 1')
+    log_listener = setup_logging(LOGFILE)
+    try:
+        if WORKERS > 1:
+            # The workers start with the schema version check only
+            asyncio.run(migrate_database())
+            Supervisor(TELEGRAM_TOKEN, TELEGRAM_API_URL, WORKERS).run()
+            return
+        if TELEGRAM_TOKENS:
+            asyncio.run(run_bots([TELEGRAM_TOKEN, *TELEGRAM_TOKENS]))
+            return
+        application = build_application()
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,318 @@
+"""
+App metrics.
+
+Latency summaries keep a sliding window of the latest samples for quantiles
+and the total count and sum since the app start. All metrics are exported in
+the Prometheus text format.
+"""
+import asyncio
+import datetime
+import logging
+import re
+import statistics
+import time
+from collections import deque
+from collections.abc import Callable
+from functools import wraps
+
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
+from decouple import config
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from telegram.ext import JobQueue
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = config('METRICS_HOST', default='127.0.0.1')
+# Set 0 to disable the metrics endpoint
+METRICS_PORT = config('METRICS_PORT', default=9464, cast=int)
+
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW_SIZE = 1024
+
+HANDLER_SECONDS = 'teledate_handler_seconds'
+DB_STATEMENT_SECONDS = 'teledate_db_statement_seconds'
+DB_POOL_CHECKOUT_SECONDS = 'teledate_db_pool_checkout_seconds'
+DB_POOL_CONNECT_SECONDS = 'teledate_db_pool_connect_seconds'
+GRAPH_RENDER_SECONDS = 'teledate_graph_render_seconds'
+GRAPH_UPLOAD_BYTES = 'teledate_graph_upload_bytes'
+JOB_QUEUE_LAG_SECONDS = 'teledate_job_queue_lag_seconds'
+SESSIONS_EVICTED = 'teledate_sessions_evicted_total'
+
+STATEMENT_TABLE = re.compile(
+    r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+`?(\w+)',
+    re.IGNORECASE,
+)
+
+
+class Summary:
+    """Samples of a metric."""
+
+    def __init__(self, window_size: int = WINDOW_SIZE) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.samples: deque[float] = deque(maxlen=window_size)
+
+    def observe(self, value: float) -> None:
+        """Add the sample."""
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantiles(self) -> dict[float, float]:
+        """Get the quantiles of the latest samples."""
+        if len(self.samples) < 2:
+            value = self.samples[0] if self.samples else 0.0
+            return dict.fromkeys(QUANTILES, value)
+        cut_points = statistics.quantiles(
+            self.samples,
+            n=100,
+            method='inclusive',
+        )
+        return {q: cut_points[round(q * 100) - 1] for q in QUANTILES}
+
+
+class Registry:
+    """Storage of the app metrics by name and labels."""
+
+    def __init__(self) -> None:
+        self.summaries: dict[str, dict[tuple, Summary]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Add the sample to the summary metric."""
+        summaries = self.summaries.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in summaries:
+            summaries[key] = Summary()
+        summaries[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increase the counter metric."""
+        counters = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def render(self) -> str:
+        """Get all the metrics in the Prometheus text format."""
+        lines = []
+        for name, summaries in sorted(self.summaries.items()):
+            lines.append(f'# TYPE {name} summary')
+            for key, summary in sorted(summaries.items()):
+                for q, value in summary.quantiles().items():
+                    labels = format_labels(key + (('quantile', str(q)),))
+                    lines.append(f'{name}{labels} {value:.6f}')
+                labels = format_labels(key)
+                lines.append(f'{name}_sum{labels} {summary.total:.6f}')
+                lines.append(f'{name}_count{labels} {summary.count}')
+        for name, counters in sorted(self.counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(counters.items()):
+                lines.append(f'{name}{format_labels(key)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def report(self) -> str:
+        """Get the summaries in a human-readable format."""
+        lines = []
+        for name, summaries in sorted(self.summaries.items()):
+            lines.append(name.removeprefix('teledate_'))
+            for key, summary in sorted(summaries.items()):
+                label = ' '.join(value for _, value in key) or '-'
+                if name.endswith('_bytes'):
+                    p50, p95, p99 = summary.quantiles().values()
+                    lines.append(
+                        f'  {label}: {summary.count}x '
+                        f'{p50:.0f}/{p95:.0f}/{p99:.0f} B',
+                    )
+                    continue
+                p50, p95, p99 = (
+                    value * 1000 for value in summary.quantiles().values()
+                )
+                lines.append(
+                    f'  {label}: {summary.count}x '
+                    f'{p50:.1f}/{p95:.1f}/{p99:.1f} ms',
+                )
+        return '\n'.join(lines) or 'No metrics yet'
+
+    def clear(self) -> None:
+        """Remove all the metrics."""
+        self.summaries.clear()
+        self.counters.clear()
+
+
+REGISTRY = Registry()
+
+
+def format_labels(key: tuple) -> str:
+    """Format the metric labels."""
+    if not key:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(
+            name,
+            value.replace('\\', r'\\').replace('"', r'\"'),
+        )
+        for name, value in key
+    )
+    return f'{{{labels}}}'
+
+
+def timed(name: str, **labels: str) -> Callable:
+    """Record the duration of the coroutine function calls."""
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                REGISTRY.observe(
+                    name,
+                    time.perf_counter() - started,
+                    **labels,
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def timed_handler(func: Callable) -> Callable:
+    """Record the latency of the bot handler."""
+    return timed(HANDLER_SECONDS, handler=func.__name__)(func)
+
+
+# SQLAlchemy
+
+
+def statement_label(statement: str) -> str:
+    """Get the statement kind and the first table, e.g. `SELECT user_table`."""
+    kind = statement.split(None, 1)[0].upper() if statement else ''
+    table = STATEMENT_TABLE.search(statement)
+    return f'{kind} {table.group(1)}' if table else kind
+
+
+def _before_cursor_execute(conn, cursor, statement, *args) -> None:
+    # One start per connection, the one of a failed statement is overwritten
+    conn.info['statement_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, *args) -> None:
+    started = conn.info.pop('statement_started', None)
+    if started is None:
+        return
+    REGISTRY.observe(
+        DB_STATEMENT_SECONDS,
+        time.perf_counter() - started,
+        statement=statement_label(statement),
+    )
+
+
+def _do_connect(dialect, connection_record, *args) -> None:
+    connection_record.info['connect_started'] = time.perf_counter()
+
+
+def _pool_connect(dbapi_connection, connection_record) -> None:
+    started = connection_record.info.pop('connect_started', None)
+    if started is None:
+        return
+    REGISTRY.observe(DB_POOL_CONNECT_SECONDS, time.perf_counter() - started)
+
+
+def instrument_engine(async_engine: AsyncEngine) -> None:
+    """Record the statements execution and the pool checkout durations."""
+    sync_engine = async_engine.sync_engine
+    if event.contains(
+        sync_engine,
+        'before_cursor_execute',
+        _before_cursor_execute,
+    ):
+        return
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'do_connect', _do_connect)
+    event.listen(sync_engine.pool, 'connect', _pool_connect)
+    # There is no pool event before the checkout, so the wait for a free
+    # connection is timed around the call
+    pool = sync_engine.pool
+    pool_connect = pool.connect
+
+    @wraps(pool_connect)
+    def connect():
+        started = time.perf_counter()
+        try:
+            return pool_connect()
+        finally:
+            REGISTRY.observe(
+                DB_POOL_CHECKOUT_SECONDS,
+                time.perf_counter() - started,
+            )
+
+    pool.connect = connect
+
+
+# Job queue
+
+
+def instrument_job_queue(job_queue: JobQueue) -> None:
+    """Record the delay between the scheduled and the actual job runs."""
+
+    def job_submitted(submission: JobSubmissionEvent) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for run_time in submission.scheduled_run_times:
+            REGISTRY.observe(
+                JOB_QUEUE_LAG_SECONDS,
+                max((now - run_time).total_seconds(), 0.0),
+            )
+
+    job_queue.scheduler.add_listener(job_submitted, EVENT_JOB_SUBMITTED)
+
+
+# Endpoint
+
+
+async def _handle_request(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        _, path, *_ = request_line.decode('latin-1').split() + ['', '']
+        if path.split('?')[0] == '/metrics':
+            status, body = '200 OK', REGISTRY.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + body,
+        )
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(
+    host: str = METRICS_HOST,
+    port: int = METRICS_PORT,
+) -> asyncio.Server | None:
+    """
+    Start the Prometheus metrics endpoint at `/metrics`.
+
+    Returns:
+        The started server, None if the endpoint is disabled or the address
+        can't be bound.
+    """
+    if not port:
+        return None
+    try:
+        return await asyncio.start_server(_handle_request, host, port)
+    except OSError as error:
+        logger.warning("Can't start the metrics endpoint: %s", error)
+        return None
@@ -0,0 +1,257 @@
+"""
+Database schema migrations.
+
+The versions of the applied migrations are kept in the schema version table
+of each shard, the migrations newer than the shard's version are applied in
+order. Each migration checks the schema before changing it, so it brings a
+database created by any older version of the models to the current one. The
+first one creates the missing tables, with their indexes, of a new database.
+"""
+import datetime
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version',
+    version_metadata,
+    Column('version', Integer(), primary_key=True, autoincrement=False),
+    Column('name', String(100)),
+    Column('applied', DateTime()),
+)
+
+# Schema statements by the dialect name, the first one for the other dialects
+DROP_INDEX = {
+    'sqlite': 'DROP INDEX {index}',
+    'mysql': 'DROP INDEX {index} ON {table}',
+}
+ADD_FOREIGN_KEY_COLUMN = {
+    'sqlite': (
+        'ALTER TABLE {table} ADD COLUMN {column} INTEGER '
+        'REFERENCES {target}'
+    ),
+    'mysql': (
+        'ALTER TABLE {table} ADD COLUMN {column} INTEGER, '
+        'ADD FOREIGN KEY ({column}) REFERENCES {target}'
+    ),
+}
+ADD_TENANT_COLUMN = (
+    "ALTER TABLE {table} ADD COLUMN tenant VARCHAR(50) NOT NULL DEFAULT ''"
+)
+# MySQL builds the index while the table is read and written
+ONLINE_INDEX = {'mysql': ' ALGORITHM=INPLACE LOCK=NONE'}
+
+
+@dataclass(frozen=True)
+class Migration:
+    """Schema change of the version."""
+
+    version: int
+    upgrade: Callable[[Connection, MetaData], None]
+
+
+def get_dialect_statement(
+    statements: dict[str, str],
+    conn: Connection,
+) -> str:
+    """Get the statement of the connection dialect."""
+    return statements.get(conn.dialect.name, next(iter(statements.values())))
+
+
+def get_column_names(conn: Connection, table: str) -> set[str]:
+    """Get the column names of the table."""
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+
+def get_index_names(conn: Connection, table: str) -> set[str]:
+    """Get the index names of the table."""
+    return {index['name'] for index in inspect(conn).get_indexes(table)}
+
+
+def create_index(
+    conn: Connection,
+    metadata: MetaData,
+    table: str,
+    name: str,
+) -> None:
+    """Create the model's index if the table doesn't have it."""
+    if name in get_index_names(conn, table):
+        return
+    index = next(
+        index for index in metadata.tables[table].indexes if index.name == name
+    )
+    statement = str(CreateIndex(index).compile(dialect=conn.dialect))
+    conn.execute(
+        text(statement + ONLINE_INDEX.get(conn.dialect.name, '')),
+    )
+
+
+def drop_index(conn: Connection, table: str, name: str) -> None:
+    """Drop the index if the table has it."""
+    if name not in get_index_names(conn, table):
+        return
+    conn.execute(
+        text(
+            get_dialect_statement(DROP_INDEX, conn).format(
+                index=name,
+                table=table,
+            ),
+        ),
+    )
+
+
+# Migrations
+
+
+def create_tables(conn: Connection, metadata: MetaData) -> None:
+    """Create the missing tables of the models."""
+    metadata.create_all(conn)
+
+
+def add_record_date_index(conn: Connection, metadata: MetaData) -> None:
+    """Index the records by the user and the date."""
+    create_index(
+        conn,
+        metadata,
+        'record_table',
+        'ix_record_table_user_id_date',
+    )
+
+
+def add_record_activity(conn: Connection, metadata: MetaData) -> None:
+    """Link the records to the additional activities."""
+    if 'activity_id' not in get_column_names(conn, 'record_table'):
+        conn.execute(
+            text(
+                get_dialect_statement(ADD_FOREIGN_KEY_COLUMN, conn).format(
+                    table='record_table',
+                    column='activity_id',
+                    target='activity_table (id)',
+                ),
+            ),
+        )
+    create_index(
+        conn,
+        metadata,
+        'record_table',
+        'ix_record_table_activity_id_date',
+    )
+
+
+def add_user_tenant(conn: Connection, metadata: MetaData) -> None:
+    """Make the usernames unique within the tenant."""
+    if 'tenant' not in get_column_names(conn, 'user_table'):
+        conn.execute(text(ADD_TENANT_COLUMN.format(table='user_table')))
+    create_index(conn, metadata, 'user_table', 'ix_user_table_tenant_name')
+    drop_index(conn, 'user_table', 'ix_user_table_name')
+
+
+def add_waitlist_tenant(conn: Connection, metadata: MetaData) -> None:
+    """
+    Make the waitlist usernames unique within the tenant.
+
+    The old table is re-created, its usernames are unique by the column
+    constraint SQLite can't drop.
+    """
+    if 'tenant' in get_column_names(conn, 'waitlist_table'):
+        return
+    conn.execute(text('ALTER TABLE waitlist_table RENAME TO waitlist_old'))
+    metadata.tables['waitlist_table'].create(conn)
+    conn.execute(
+        text(
+            'INSERT INTO waitlist_table (id, name, activity, chat_id) '
+            'SELECT id, name, activity, chat_id FROM waitlist_old',
+        ),
+    )
+    conn.execute(text('DROP TABLE waitlist_old'))
+
+
+def backfill_rollups(conn: Connection, metadata: MetaData) -> None:
+    """Count the rollups of the records added before the rollup tables."""
+    import database as db
+
+    if conn.scalar(select(db.Record.id).limit(1)) is None:
+        return
+    for model in (db.DailyRecords, db.IntervalRecords):
+        if conn.scalar(select(func.count()).select_from(model)):
+            return
+    db.count_rollups(conn)
+
+
+MIGRATIONS = [
+    Migration(1, create_tables),
+    Migration(2, add_record_date_index),
+    Migration(3, add_record_activity),
+    Migration(4, add_user_tenant),
+    Migration(5, add_waitlist_tenant),
+    Migration(6, backfill_rollups),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+# Runner
+
+
+def get_version(conn: Connection) -> int:
+    """
+    Get the schema version of the database.
+
+    Returns:
+        The last applied migration version, 0 without the version table.
+    """
+    try:
+        version = conn.scalar(select(func.max(schema_version.c.version)))
+    except (OperationalError, ProgrammingError):
+        conn.rollback()
+        return 0
+    return version or 0
+
+
+def upgrade(conn: Connection, metadata: MetaData) -> list[int]:
+    """
+    Apply the migrations newer than the schema version in order.
+
+    Each migration is committed with its version, so a failed upgrade is
+    resumed from the failed migration.
+
+    Returns:
+        The applied migration versions.
+    """
+    schema_version.create(conn, checkfirst=True)
+    conn.commit()
+    version = get_version(conn)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        migration.upgrade(conn, metadata)
+        conn.execute(
+            insert(schema_version).values(
+                version=migration.version,
+                name=migration.upgrade.__name__,
+                # Naive UTC as the other dates of the database
+                applied=datetime.datetime.now(datetime.UTC).replace(
+                    tzinfo=None,
+                ),
+            ),
+        )
+        conn.commit()
+        applied.append(migration.version)
+    return applied
@@ -0,0 +1,224 @@
+"""
+Sampling profiler of the update handling.
+
+The event loop thread stack is sampled by a background thread while updates
+are handled. Updates slower than the threshold are dumped with their
+profiles, and the slowest ones are kept for the `/slowest` admin command.
+Samples of concurrently handled updates are attributed to all of them.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Awaitable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from decouple import config
+from telegram import Update
+from telegram.ext import Application
+
+PROFILE = config('PROFILE', default=False, cast=bool)
+# Seconds of handling after which the update profile is dumped
+PROFILE_THRESHOLD = config('PROFILE_THRESHOLD', default=1.0, cast=float)
+PROFILE_INTERVAL = config('PROFILE_INTERVAL', default=0.005, cast=float)
+SLOWEST_SIZE = 20
+
+PROFILES_DIR = Path(__file__).resolve().parent.parent / 'data' / 'profiles'
+
+
+@dataclass(order=True)
+class SlowUpdate:
+    """Handled update info."""
+
+    duration: float
+    seq: int
+    update_id: int | None = field(compare=False)
+    command: str = field(compare=False)
+    handled_at: datetime.datetime = field(compare=False)
+    dump: Path | None = field(default=None, compare=False)
+
+    def __str__(self) -> str:
+        """To string."""
+        dump = f' {self.dump.name}' if self.dump else ''
+        return (
+            f'{self.duration * 1000:.0f} ms '
+            f'{self.handled_at:%d.%m %H:%M:%S} '
+            f'#{self.update_id} {self.command}{dump}'
+        )
+
+
+class UpdateProfiler:
+    """Sample the event loop stacks while updates are handled."""
+
+    def __init__(
+        self,
+        threshold: float = PROFILE_THRESHOLD,
+        interval: float = PROFILE_INTERVAL,
+        slowest_size: int = SLOWEST_SIZE,
+        profiles_dir: Path = PROFILES_DIR,
+    ) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.slowest_size = slowest_size
+        self.profiles_dir = profiles_dir
+        self.slowest: list[SlowUpdate] = []
+        self._seq = itertools.count()
+        self._active: list[Counter] = []
+        self._thread: threading.Thread | None = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the sampling thread is running."""
+        return self._thread is not None
+
+    def start(self) -> None:
+        """Start sampling the current thread, which runs the event loop."""
+        if self.enabled:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._sample,
+            name='update-profiler',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        if not self.enabled:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            if not self._active:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = fold_stack(frame)
+            for samples in list(self._active):
+                samples[stack] += 1
+
+    async def profile(self, handling: Awaitable, update: object) -> None:
+        """Await the update handling and keep its profile if it's slow."""
+        samples = Counter()
+        self._active.append(samples)
+        started = time.perf_counter()
+        try:
+            await handling
+        finally:
+            duration = time.perf_counter() - started
+            self._active.remove(samples)
+            await self.record(update, duration, samples)
+
+    async def record(
+        self,
+        update: object,
+        duration: float,
+        samples: Counter,
+    ) -> None:
+        """Keep the handled update info and dump the slow one."""
+        slow_update = SlowUpdate(
+            duration=duration,
+            seq=next(self._seq),
+            update_id=getattr(update, 'update_id', None),
+            command=get_command(update),
+            handled_at=datetime.datetime.now(),
+        )
+        if duration >= self.threshold:
+            loop = asyncio.get_running_loop()
+            slow_update.dump = await loop.run_in_executor(
+                None,
+                self.dump,
+                slow_update,
+                update,
+                samples,
+            )
+        if len(self.slowest) < self.slowest_size:
+            heapq.heappush(self.slowest, slow_update)
+        elif slow_update > self.slowest[0]:
+            heapq.heapreplace(self.slowest, slow_update)
+
+    def dump(
+        self,
+        slow_update: SlowUpdate,
+        update: object,
+        samples: Counter,
+    ) -> Path:
+        """
+        Write the update profile in the folded stacks format.
+
+        The update payload is written next to the profile as JSON.
+
+        Returns:
+            The profile file path.
+        """
+        self.profiles_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profiles_dir / (
+            f'{slow_update.handled_at:%Y%m%d-%H%M%S}-{slow_update.update_id}'
+        )
+        profile = path.with_suffix('.folded')
+        profile.write_text(
+            ''.join(
+                f'{stack} {count}\n'
+                for stack, count in samples.most_common()
+            ),
+            encoding='utf-8',
+        )
+        if isinstance(update, Update):
+            path.with_suffix('.json').write_text(
+                json.dumps(update.to_dict(), ensure_ascii=False, indent=2),
+                encoding='utf-8',
+            )
+        return profile
+
+    def report(self) -> str:
+        """Get the slowest handled updates, the slowest first."""
+        if not self.slowest:
+            return 'No profiled updates yet'
+        return '\n'.join(map(str, sorted(self.slowest, reverse=True)))
+
+
+PROFILER = UpdateProfiler()
+
+
+class ProfilingApplication(Application):
+    """Bot application profiling the update handling when enabled."""
+
+    async def process_update(self, update: object) -> None:
+        """Process the update with the profiler if it's enabled."""
+        if not PROFILER.enabled:
+            return await super().process_update(update)
+        return await PROFILER.profile(super().process_update(update), update)
+
+
+def fold_stack(frame) -> str:
+    """Get the frame stack in the folded format, the outermost call first."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f'{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})',
+        )
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def get_command(update: object) -> str:
+    """Get the first word of the update message text."""
+    message = getattr(update, 'effective_message', None)
+    if message is None or not message.text:
+        return '-'
+    return message.text.split(maxsplit=1)[0][:32]
@@ -0,0 +1,69 @@
+"""
+Conversation state commands router.
+
+Each conversation state has a table of its commands. The exact command texts
+are looked up in a dictionary first, then the commands with an argument are
+matched by the text prefix and the precompiled argument pattern. A message
+is parsed once by the state's table and the handler gets the parsed command
+from the callback context as `context.command`.
+"""
+import re
+from dataclasses import dataclass
+
+from telegram import Message
+from telegram.ext.filters import MessageFilter
+
+
+@dataclass(frozen=True, slots=True)
+class Command:
+    """Parsed message command."""
+
+    name: str
+    argument: str | None = None
+
+
+class CommandTable(MessageFilter):
+    """Message filter parsing the text with the state's commands."""
+
+    def __init__(
+        self,
+        exact: dict[str, Command],
+        prefixed: dict[str, tuple[str, str]] | None = None,
+        name: str | None = None,
+    ) -> None:
+        """
+        Create the commands table.
+
+        Args:
+            exact: The commands by the whole message text.
+            prefixed: The command names and the argument patterns by the
+                prefix of the message text, checked in the order given.
+        """
+        super().__init__(name=name, data_filter=True)
+        self.exact = exact
+        self.prefixed = [
+            (prefix, command_name, re.compile(pattern))
+            for prefix, (command_name, pattern) in (prefixed or {}).items()
+        ]
+
+    def parse(self, text: str) -> Command | None:
+        """Get the command of the message text, None if there is no such."""
+        command = self.exact.get(text)
+        if command is not None:
+            return command
+        for prefix, command_name, pattern in self.prefixed:
+            if text.startswith(prefix) and pattern.fullmatch(
+                text,
+                len(prefix),
+            ):
+                return Command(command_name, text[len(prefix):])
+        return None
+
+    def filter(self, message: Message) -> dict[str, Command] | None:
+        """Pass the parsed command to the handler's callback context."""
+        if not message.text:
+            return None
+        command = self.parse(message.text)
+        if command is None:
+            return None
+        return {'command': command}
@@ -0,0 +1,66 @@
+"""
+Per-user conversation session.
+
+The session keeps only the primitives the handlers need between updates and
+is dropped after `SESSION_TTL` seconds without updates from the user, then
+loaded again from the database by the next update of the user.
+"""
+import time
+
+import metrics
+from decouple import config
+from telegram.ext import CallbackContext, ContextTypes, ExtBot
+
+# Seconds without updates before the user's session is dropped
+SESSION_TTL = config('SESSION_TTL', default=3600, cast=int)
+# Seconds between the idle sessions sweeps
+SESSION_SWEEP_INTERVAL = config(
+    'SESSION_SWEEP_INTERVAL',
+    default=300,
+    cast=int,
+)
+
+
+class UserSession:
+    """User data of the conversation, set as the `context.user_data`."""
+
+    __slots__ = ('db_user_id', 'db_user_activity', 'reminder', 'last_seen')
+
+    def __init__(self) -> None:
+        self.db_user_id: int | None = None
+        self.db_user_activity: str | None = None
+        # None until the user's reminder jobs are checked
+        self.reminder: bool | None = None
+        self.last_seen = time.monotonic()
+
+    def __repr__(self) -> str:
+        """To representation."""
+        return f'{self.db_user_id}: {self.db_user_activity}'
+
+    def touch(self) -> None:
+        """Mark the session as used now."""
+        self.last_seen = time.monotonic()
+
+    def clear(self) -> None:
+        """Forget the user's database user."""
+        self.db_user_id = self.db_user_activity = None
+        self.reminder = False
+
+
+Context = CallbackContext[ExtBot, UserSession, dict, dict]
+CONTEXT_TYPES = ContextTypes(user_data=UserSession)
+
+
+async def evict_idle_sessions(context: Context) -> None:
+    """Drop the sessions of the users idle for longer than the TTL."""
+    application = context.application
+    expired = time.monotonic() - SESSION_TTL
+    idle = [
+        user_id
+        for user_id, session in application.user_data.items()
+        if session.last_seen < expired
+    ]
+    for user_id in idle:
+        application.drop_user_data(user_id)
+    if idle:
+        metrics.REGISTRY.inc(metrics.SESSIONS_EVICTED, len(idle))
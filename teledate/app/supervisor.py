@@ -0,0 +1,156 @@
+"""
+Multi-process bot mode.
+
+The supervisor process receives the updates and dispatches each one to the
+worker process owning the hash partition of the update user ID. A user's
+conversation state and reminder jobs always stay on the same worker.
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+
+from bot_api import create_updates_request
+from decouple import config
+from telegram import Bot, Update
+from telegram.error import NetworkError, TelegramError
+
+WORKERS = config('WORKERS', default=1, cast=int)
+POLL_TIMEOUT = 10
+RETRY_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+def get_partition(update: Update, workers: int) -> int:
+    """Get the worker index by the hash of the update user or chat ID."""
+    owner = update.effective_user or update.effective_chat
+    if owner is None:
+        return 0
+    digest = hashlib.blake2b(str(owner.id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % workers
+
+
+def run_worker(index: int, updates: Queue) -> None:
+    """Handle the dispatched updates in the worker process."""
+    import main
+    from logs import setup_logging
+
+    log_listener = setup_logging(
+        main.LOGFILE.with_name(f'{main.LOGFILE.stem}.{index}.log'),
+    )
+    try:
+        asyncio.run(handle_updates(main.build_application(), updates))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+
+async def handle_updates(application, updates: Queue) -> None:
+    """Put the dispatched updates to the application queue until `None`."""
+    import main
+
+    loop = asyncio.get_running_loop()
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        while (data := await loop.run_in_executor(None, updates.get)):
+            await application.update_queue.put(
+                Update.de_json(data, application.bot),
+            )
+        await application.stop()
+        await main.post_shutdown(application)
+
+
+class Supervisor:
+    """Poll the updates and dispatch them to the worker processes."""
+
+    def __init__(self, token: str, base_url: str, workers: int) -> None:
+        self.token = token
+        self.base_url = base_url
+        self.context = multiprocessing.get_context('spawn')
+        self.queues: list[Queue] = [
+            self.context.Queue() for _ in range(workers)
+        ]
+        self.processes: list[BaseProcess | None] = [None] * workers
+
+    def start_worker(self, index: int) -> None:
+        """Start or restart the worker process."""
+        metrics_port = config('METRICS_PORT', default=9464, cast=int)
+        if metrics_port:
+            # Each worker serves its metrics on the next port
+            os.environ['METRICS_PORT'] = str(metrics_port + index + 1)
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.queues[index]),
+            name=f'teledate-worker-{index}',
+            daemon=True,
+        )
+        process.start()
+        if metrics_port:
+            os.environ['METRICS_PORT'] = str(metrics_port)
+        self.processes[index] = process
+
+    def check_workers(self) -> None:
+        """Restart the exited worker processes."""
+        for index, process in enumerate(self.processes):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.error(
+                        'Worker %d exited with code %s, restarting',
+                        index,
+                        process.exitcode,
+                    )
+                self.start_worker(index)
+
+    async def poll(self) -> None:
+        """Receive the updates once and dispatch them to the workers."""
+        bot = Bot(
+            self.token,
+            base_url=self.base_url,
+            get_updates_request=create_updates_request(),
+        )
+        offset = None
+        async with bot:
+            while True:
+                self.check_workers()
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset,
+                        timeout=POLL_TIMEOUT,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+                except NetworkError as error:
+                    logger.warning('Polling failed: %s', error)
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                except TelegramError:
+                    logger.exception('Polling failed')
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    self.queues[
+                        get_partition(update, len(self.queues))
+                    ].put(update.to_dict())
+
+    def stop(self) -> None:
+        """Stop the worker processes after their queued updates."""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+    def run(self) -> None:
+        """Run the supervisor until interrupted."""
+        try:
+            asyncio.run(self.poll())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
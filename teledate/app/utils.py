@@ -1,11 +1,76 @@
 """Utilities and presets for Teledate bot."""
+import asyncio
 import datetime
 import io
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import cache
 from math import floor
+from types import ModuleType
+from typing import TYPE_CHECKING
 
-import matplotlib.pyplot as plt
-from telegram import KeyboardButton, ReplyKeyboardMarkup
+from decouple import config
+from metrics import GRAPH_RENDER_SECONDS, timed
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+)
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
+    from PIL.Image import Image
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """Graph image output settings."""
+
+    dpi: int
+    # Bytes the image should fit in
+    budget: int
+    # Formats in the order of the encoding cost, the first fitting one is used
+    formats: tuple[str, ...] = ('png8', 'png', 'jpeg')
+    # Figure size multiplier
+    scale: float = 1.0
+    # Colors of the palette PNG
+    colors: int = 64
+    # JPEG and WebP quality
+    quality: int = 80
+
+
+RENDER_PROFILES = {
+    'small': RenderProfile(
+        dpi=72,
+        budget=30_000,
+        formats=('png8', 'webp', 'jpeg'),
+        scale=0.9,
+        colors=32,
+        quality=70,
+    ),
+    'default': RenderProfile(dpi=100, budget=60_000),
+    'hd': RenderProfile(dpi=150, budget=200_000, colors=128, quality=90),
+}
+GRAPH_PROFILE = config('GRAPH_PROFILE', default='default')
+# File extensions by the image format
+IMAGE_EXTENSIONS = {'png8': 'png', 'png': 'png', 'webp': 'webp', 'jpeg': 'jpg'}
+# Pyplot isn't thread-safe, so the figures are drawn by one thread
+GRAPH_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='graph')
+
+
+@dataclass(frozen=True)
+class Graph:
+    """Rendered graph image."""
+
+    data: bytes
+    image_format: str
+
+    @property
+    def filename(self) -> str:
+        """Get the file name with the image format extension."""
+        return f'graph.{IMAGE_EXTENSIONS[self.image_format]}'
 
 
 @dataclass
@@ -75,6 +140,40 @@ class ReplyMarkups:
     )
 
 
+@dataclass
+class InlineMarkups:
+    """Inline markups presets of the status panel message."""
+
+    panel = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton('Status', callback_data='panel:status'),
+                InlineKeyboardButton('Add record', callback_data='panel:add'),
+            ],
+            [
+                InlineKeyboardButton(
+                    'Reminder: Off',
+                    callback_data='panel:reminder',
+                ),
+            ],
+        ],
+    )
+    panel_reminder = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton('Status', callback_data='panel:status'),
+                InlineKeyboardButton('Add record', callback_data='panel:add'),
+            ],
+            [
+                InlineKeyboardButton(
+                    'Reminder: On',
+                    callback_data='panel:reminder',
+                ),
+            ],
+        ],
+    )
+
+
 def get_time_since(record_dt: datetime.datetime) -> str:
     """Get the time passed since the date in human-readable format."""
     diff_dt = datetime.datetime.today() - record_dt
@@ -92,11 +191,34 @@ def get_time_since(record_dt: datetime.datetime) -> str:
     return f'{sec_diff} sec'
 
 
+@cache
+def load_pyplot() -> ModuleType:
+    """
+    Import `matplotlib.pyplot` with the non-interactive backend.
+
+    Matplotlib is slow to import, so it is loaded on the first graph request
+    or by the warm-up task on app startup.
+    """
+    import matplotlib
+
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+@timed(GRAPH_RENDER_SECONDS, graph='line')
 async def get_graph(
     records_dt: list[datetime.datetime],
     title: str = 'Default',
-) -> bytes | None:
+    profile: str | None = None,
+) -> Graph:
     """Get a graph of the user's records."""
+    return await render_graph(draw_graph, profile, records_dt, title)
+
+
+def draw_graph(records_dt: list[datetime.datetime], title: str) -> 'Figure':
+    """Draw a graph of the user's records."""
     x = []
     y = []
     for record in records_dt:
@@ -106,7 +228,7 @@ async def get_graph(
             prev_date = conv_record - datetime.timedelta(hours=48)
         y.append(floor((conv_record - prev_date).total_seconds() / 60 / 60))
         prev_date = conv_record
-    fig, ax = plt.subplots()
+    fig, ax = load_pyplot().subplots()
     ax.plot(
         x,
         y,
@@ -115,6 +237,211 @@ async def get_graph(
     ax.set_title(title)
     ax.set_ylabel('Hours')
     ax.set_xlabel('Date')
+    return fig
+
+
+@timed(GRAPH_RENDER_SECONDS, graph='buckets')
+async def get_buckets_graph(
+    buckets: list[tuple[datetime.date, int]],
+    title: str = 'Default',
+    xlabel: str = 'Date',
+    profile: str | None = None,
+) -> Graph:
+    """Get a bar graph of the user's records number per date bucket."""
+    return await render_graph(
+        draw_buckets_graph,
+        profile,
+        buckets,
+        title,
+        xlabel,
+    )
+
+
+def draw_buckets_graph(
+    buckets: list[tuple[datetime.date, int]],
+    title: str,
+    xlabel: str,
+) -> 'Figure':
+    """Draw a bar graph of the user's records number per date bucket."""
+    fig, ax = load_pyplot().subplots()
+    ax.bar(
+        [bucket_date.strftime('%d.%m') for bucket_date, _ in buckets],
+        [count for _, count in buckets],
+    )
+    ax.set_title(title)
+    ax.set_ylabel('Records')
+    ax.set_xlabel(xlabel)
+    ax.tick_params(axis='x', labelrotation=90, labelsize='small')
+    fig.tight_layout()
+    return fig
+
+
+@timed(GRAPH_RENDER_SECONDS, graph='heatmap')
+async def get_heatmap(
+    matrix: list[list[int]],
+    title: str = 'Default',
+    profile: str | None = None,
+) -> Graph:
+    """Get a heatmap of the user's records per weekday and hour."""
+    return await render_graph(draw_heatmap, profile, matrix, title)
+
+
+def draw_heatmap(matrix: list[list[int]], title: str) -> 'Figure':
+    """Draw a heatmap of the user's records per weekday and hour."""
+    fig, ax = load_pyplot().subplots(figsize=(9, 3.6))
+    image = ax.imshow(matrix, cmap='Blues', aspect='auto')
+    ax.set_yticks(
+        range(7),
+        labels=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+    )
+    ax.set_xticks(range(24))
+    ax.tick_params(axis='x', labelsize='small')
+    fig.colorbar(image, ax=ax, label='Records')
+    ax.set_title(title)
+    ax.set_xlabel('Hour')
+    fig.tight_layout()
+    return fig
+
+
+@timed(GRAPH_RENDER_SECONDS, graph='dashboard')
+async def get_dashboard(
+    days: list[tuple[datetime.date, int, int]],
+    intervals: list[int],
+    interval_labels: list[str],
+    profile: str | None = None,
+) -> Graph:
+    """Get the graphs of the records and active users per day and intervals."""
+    return await render_graph(
+        draw_dashboard,
+        profile,
+        days,
+        intervals,
+        interval_labels,
+    )
+
+
+def draw_dashboard(
+    days: list[tuple[datetime.date, int, int]],
+    intervals: list[int],
+    interval_labels: list[str],
+) -> 'Figure':
+    """Draw the records and active users per day and the intervals graphs."""
+    fig, (days_ax, intervals_ax) = load_pyplot().subplots(
+        2,
+        figsize=(8, 6.4),
+    )
+    labels = [day.strftime('%d.%m') for day, _, _ in days]
+    days_ax.bar(labels, [records for _, _, records in days], label='Records')
+    days_ax.plot(
+        labels,
+        [users for _, users, _ in days],
+        color='tab:orange',
+        marker='.',
+        label='Active users',
+    )
+    days_ax.set_title('Records and active users per day')
+    days_ax.legend()
+    days_ax.tick_params(axis='x', labelrotation=90, labelsize='small')
+    intervals_ax.bar(interval_labels, intervals)
+    intervals_ax.set_title('Intervals since the previous record')
+    intervals_ax.set_ylabel('Records')
+    fig.tight_layout()
+    return fig
+
+
+async def render_graph(
+    draw: Callable[..., 'Figure'],
+    profile: str | None,
+    *args,
+) -> Graph:
+    """Draw the figure and render it in the graph thread."""
+    return await asyncio.get_running_loop().run_in_executor(
+        GRAPH_EXECUTOR,
+        lambda: render_figure(draw(*args), profile),
+    )
+
+
+def render_figure(
+    fig: 'Figure',
+    profile: str | None = None,
+) -> Graph:
+    """
+    Render the figure with the profile settings and release it.
+
+    The `GRAPH_PROFILE` profile is used by default.
+
+    The figure is drawn once, then encoded in the profile formats, cheapest
+    first, until one fits the byte budget.
+
+    Returns:
+        The first image fitting the budget, the smallest one if none fits.
+    """
+    # Pillow is loaded with matplotlib
+    from PIL import Image
+
+    settings = RENDER_PROFILES[profile or GRAPH_PROFILE]
+    try:
+        if settings.scale != 1:
+            width, height = fig.get_size_inches()
+            fig.set_size_inches(
+                width * settings.scale,
+                height * settings.scale,
+            )
+        fig.set_dpi(settings.dpi)
+        fig.canvas.draw()
+        image = Image.frombuffer(
+            'RGBA',
+            fig.canvas.get_width_height(),
+            fig.canvas.buffer_rgba(),
+        ).convert('RGB')
+    finally:
+        load_pyplot().close(fig)
+    encoded = []
+    for image_format in settings.formats:
+        if image_format == 'webp' and not has_webp():
+            continue
+        data = encode_image(image, image_format, settings)
+        graph = Graph(data, image_format)
+        if len(graph.data) <= settings.budget:
+            return graph
+        encoded.append(graph)
+    return min(encoded, key=lambda graph: len(graph.data))
+
+
+def encode_image(
+    image: 'Image',
+    image_format: str,
+    settings: RenderProfile,
+) -> bytes:
+    """Encode the RGB image to the format bytes."""
+    from PIL import Image
+
     with io.BytesIO() as buf:
-        fig.savefig(buf)
+        match image_format:
+            case 'png8':
+                image.quantize(
+                    colors=settings.colors,
+                    method=Image.Quantize.FASTOCTREE,
+                ).save(buf, 'PNG', optimize=True)
+            case 'png':
+                image.save(buf, 'PNG', optimize=True)
+            case 'webp':
+                image.save(buf, 'WEBP', quality=settings.quality)
+            case 'jpeg':
+                image.save(
+                    buf,
+                    'JPEG',
+                    quality=settings.quality,
+                    optimize=True,
+                )
+            case _:
+                raise ValueError(f'Unknown image format: {image_format}')
         return buf.getvalue()
+
+
+@cache
+def has_webp() -> bool:
+    """Check if Pillow is built with WebP support."""
+    from PIL import features
+
+    return bool(features.check('webp'))
@@ -0,0 +1,13 @@
+# flake8: noqa
+"""
+Teledate benchmarks.
+
+The app modules use top-level imports, so the app folder is added to the path.
+"""
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / 'app'
+
+if str(APP_DIR) not in sys.path:
+    sys.path.insert(0, str(APP_DIR))
@@ -0,0 +1,145 @@
+"""
+Benchmark of the outbound Bot API throughput for bulk reminder sends.
+
+Reminder messages are sent at once, like the reminders of many users set to
+the same hour, to the local fake Bot API server through the default request
+and the tuned one of `bot_api`. The server runs in its own process, so its
+work doesn't slow down the measured client.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.bulk_send --messages 1000 --api-delay 0.05
+"""
+import argparse
+import asyncio
+import multiprocessing
+import statistics
+import sys
+import time
+from multiprocessing.connection import Connection
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import bot_api  # noqa: E402
+from telegram import Bot  # noqa: E402
+from telegram.constants import ParseMode  # noqa: E402
+from telegram.error import TelegramError  # noqa: E402
+from telegram.request import BaseRequest, HTTPXRequest  # noqa: E402
+
+from teledate.benchmarks.fake_api import FakeBotApi  # noqa: E402
+
+REQUESTS = {
+    'default': HTTPXRequest,
+    'tuned': bot_api.create_request,
+}
+
+
+def serve_api(delay: float, pipe: Connection) -> None:
+    """
+    Run the fake Bot API server until `None` is received.
+
+    Sends the base URL once started and the number of the accepted
+    connections on each `'connections'` received.
+    """
+
+    async def serve() -> None:
+        api = FakeBotApi(delay=delay)
+        await api.start()
+        pipe.send(api.base_url)
+        loop = asyncio.get_running_loop()
+        while await loop.run_in_executor(None, pipe.recv):
+            pipe.send(api.connections)
+        await api.stop()
+
+    asyncio.run(serve())
+
+
+async def send_reminder(bot: Bot, chat_id: int) -> float | None:
+    """
+    Send a reminder message like the alarm job does.
+
+    Returns:
+        The call time in seconds, None on errors.
+    """
+    started = time.perf_counter()
+    try:
+        await bot.send_message(
+            chat_id,
+            text='*Default*\n\n`1 day, 2:03:04`\nSince the last record',
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+    except TelegramError:
+        return None
+    return time.perf_counter() - started
+
+
+async def run_request(
+    base_url: str,
+    request: BaseRequest,
+    messages: int,
+) -> dict[str, float]:
+    """Send the reminders at once through the request."""
+    async with Bot('123:bench', base_url=base_url, request=request) as bot:
+        started = time.perf_counter()
+        times = await asyncio.gather(
+            *(send_reminder(bot, chat_id) for chat_id in range(messages)),
+        )
+        elapsed = time.perf_counter() - started
+    sent = sorted(call for call in times if call is not None)
+    return {
+        'sent': len(sent),
+        'per_second': len(sent) / elapsed,
+        'p50': statistics.median(sent) if sent else 0,
+        'p95': sent[int(len(sent) * 0.95)] if sent else 0,
+    }
+
+
+def run(args: argparse.Namespace, base_url: str, pipe: Connection) -> None:
+    """Benchmark the requests one after another."""
+    print(
+        f'{"request":<10}{"sent":>8}{"msg/s":>10}{"p50 ms":>10}'
+        f'{"p95 ms":>10}{"conns":>8}',
+    )
+    pipe.send('connections')
+    connections = pipe.recv()
+    for name, create_request in REQUESTS.items():
+        result = asyncio.run(
+            run_request(base_url, create_request(), args.messages),
+        )
+        pipe.send('connections')
+        total = pipe.recv()
+        opened, connections = total - connections, total
+        print(
+            f'{name:<10}{result["sent"]:>8}{result["per_second"]:>10.0f}'
+            f'{result["p50"] * 1e3:>10.1f}{result["p95"] * 1e3:>10.1f}'
+            f'{opened:>8}',
+        )
+
+
+def main() -> int:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument(
+        '--api-delay',
+        type=float,
+        default=0.05,
+        help='seconds the fake Bot API takes to answer a call',
+    )
+    args = parser.parse_args()
+    pipe, api_pipe = multiprocessing.Pipe()
+    api_process = multiprocessing.get_context('spawn').Process(
+        target=serve_api,
+        args=(args.api_delay, api_pipe),
+    )
+    api_process.start()
+    try:
+        run(args, pipe.recv(), pipe)
+    finally:
+        pipe.send(None)
+        api_process.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
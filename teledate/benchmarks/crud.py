@@ -0,0 +1,211 @@
+"""
+Microbenchmarks of the database CRUD functions.
+
+Each function is called on the tables of the given number of records, 100
+records per user. Median call times are compared with the stored baseline,
+regressions above the threshold fail the run.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.crud --sizes 1k,10k,100k --save-baseline
+    python -m teledate.benchmarks.crud --sizes 1k,10k,100k --threshold 0.25
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+RECORDS_PER_USER = 100
+BATCH_SIZE = 10_000
+BASELINE_FILE = Path(__file__).resolve().parent / 'crud_baseline.json'
+SUFFIXES = {'k': 1_000, 'm': 1_000_000}
+
+
+def parse_size(size: str) -> int:
+    """Get the number of records from the size like `10k` or `1M`."""
+    size = size.strip().lower()
+    if size[-1] in SUFFIXES:
+        return int(float(size[:-1]) * SUFFIXES[size[-1]])
+    return int(size)
+
+
+async def populate(records: int) -> int:
+    """
+    Fill the empty tables with users and their records.
+
+    Returns:
+        The number of users.
+    """
+    users = max(records // RECORDS_PER_USER, 1)
+    started = datetime.datetime(2000, 1, 1)
+    async with db.async_engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+        await conn.run_sync(db.Base.metadata.create_all)
+        for first in range(1, users + 1, BATCH_SIZE):
+            await conn.execute(
+                insert(db.User),
+                [
+                    {'id': user_id, 'name': f'user{user_id}'}
+                    for user_id in range(
+                        first,
+                        min(first + BATCH_SIZE, users + 1),
+                    )
+                ],
+            )
+        for first in range(0, records, BATCH_SIZE):
+            await conn.execute(
+                insert(db.Record),
+                [
+                    {
+                        'user_id': index % users + 1,
+                        'date': started
+                        + datetime.timedelta(hours=index // users),
+                    }
+                    for index in range(
+                        first,
+                        min(first + BATCH_SIZE, records),
+                    )
+                ],
+            )
+    return users
+
+
+def get_cases(users: int) -> dict[str, Callable[[int], Awaitable]]:
+    """Get the CRUD calls by the function name, the argument is the call."""
+    user_ids = list(range(1, users + 1))
+    random.shuffle(user_ids)
+    return {
+        'create_user': lambda call: db.create_user(f'bench{call}'),
+        'get_user_id': lambda call: db.get_user_id(
+            f'user{user_ids[call % users]}',
+        ),
+        'create_record': lambda call: db.create_record(
+            user_ids[call % users],
+        ),
+        'get_last_user_record': lambda call: db.get_last_user_record(
+            user_ids[call % users],
+        ),
+        'get_user_records': lambda call: db.get_user_records(
+            user_ids[call % users],
+        ),
+        'delete_records': lambda call: db.delete_records(
+            user_ids[call % users],
+            count=2,
+        ),
+        'delete_last_record': lambda call: db.delete_last_record(
+            user_ids[call % users],
+        ),
+        # Each user is deleted once, the last ones are left for other cases
+        'delete_user': lambda call: db.delete_user(
+            user_ids[-1 - call % users],
+        ),
+    }
+
+
+async def run_size(records: int, calls: int, db_url: str) -> dict[str, float]:
+    """Get the median call times in seconds by the function name."""
+    db.init_engine(db_url)
+    db.USER_LIMIT = sys.maxsize
+    users = await populate(records)
+    results = {}
+    for name, case in get_cases(users).items():
+        await case(0)
+        times = []
+        # Users can be deleted only once
+        case_calls = min(calls, users - 1) if name == 'delete_user' else calls
+        for call in range(1, case_calls + 1):
+            started = time.perf_counter()
+            await case(call)
+            times.append(time.perf_counter() - started)
+        if times:
+            results[name] = statistics.median(times)
+    await db.dispose_engine()
+    return results
+
+
+def compare(
+    results: dict[str, float],
+    baseline: dict[str, float],
+    threshold: float,
+) -> list[str]:
+    """Get the regressions above the threshold compared to the baseline."""
+    return [
+        f'{key}: {baseline[key] * 1e6:.0f} -> {value * 1e6:.0f} us '
+        f'(+{(value / baseline[key] - 1) * 100:.0f}%)'
+        for key, value in results.items()
+        if key in baseline and value > baseline[key] * (1 + threshold)
+    ]
+
+
+async def run(args: argparse.Namespace, tmp_dir: Path) -> dict[str, float]:
+    """Benchmark all the sizes."""
+    results = {}
+    for size in args.sizes.split(','):
+        records = parse_size(size)
+        db_url = args.db_url or f'sqlite+aiosqlite:///{tmp_dir / f"{size}.db"}'
+        for name, median in (
+            await run_size(records, args.calls, db_url)
+        ).items():
+            results[f'{name}@{records}'] = median
+            print(f'{name:<22}{records:>10} {median * 1e6:>10.0f} us')
+    return results
+
+
+def main() -> int:
+    """Run the benchmarks and check them against the baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1k,10k,100k')
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='allowed slowdown compared to the baseline, 0.25 is 25%%',
+    )
+    parser.add_argument(
+        '--db-url',
+        help='scratch database URL, temporary SQLite files by default',
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = asyncio.run(run(args, Path(tmp_dir)))
+    if args.save_baseline:
+        baseline = (
+            json.loads(args.baseline.read_text())
+            if args.baseline.exists()
+            else {}
+        )
+        args.baseline.write_text(
+            json.dumps(baseline | results, indent=2, sort_keys=True) + '\n',
+        )
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    if not args.baseline.exists():
+        print(f'No baseline at {args.baseline}, use --save-baseline')
+        return 0
+    regressions = compare(
+        results,
+        json.loads(args.baseline.read_text()),
+        args.threshold,
+    )
+    for regression in regressions:
+        print(f'Regression {regression}')
+    return int(bool(regressions))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Microbenchmark of the per-update dispatch cost of the conversation states.
+
+The messages of each state are checked against the state's handlers in the
+order the conversation checks them, as the cascaded `filters.Regex` handlers
+with the text parsed again by the callback (the old way) and as the command
+tables parsing the text once. The callbacks aren't run.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.dispatch --rounds 20000
+"""
+import argparse
+import re
+import statistics
+import time
+from collections.abc import Callable
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+from teledate.benchmarks.fake_api import FakeRequest, make_update
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import (  # noqa: E402
+    BaseHandler,
+    ConversationHandler,
+    MessageHandler,
+    filters,
+)
+
+MESSAGES = {
+    main.DB_MANAGE: ['Create database', 'Delete last record', 'Cancel', '?'],
+    main.DB_ACTIVITY: ['Default', 'Running', 'Cancel', 'bad!name'],
+    main.MAIN: [
+        'Status',
+        'Graph month',
+        'Heatmap',
+        'Reminder: On',
+        'Track Running',
+        'New activity Swimming',
+        'Add record',
+        'Add record 01.01.2000 10:00',
+        'Add record later',
+        '/database',
+    ],
+    main.REMINDER: ['Set', 'Set 12', 'Unset', 'Cancel', 'Later'],
+}
+
+
+def reparse_main(text: str) -> None:
+    """Parse the text again as the old main menu callback did."""
+    add_record_msg = re.compile(
+        r'^Add record(\s\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})?$',
+    )
+    if text.startswith('Add record') and add_record_msg.match(text):
+        re.findall(r'(\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})', text)
+
+
+def reparse_reminder(text: str) -> None:
+    """Parse the text again as the old reminder callback did."""
+    if not re.findall(r'^Unset$', text):
+        re.findall(r'(\d{1,2})', text)
+
+
+def reparse_activity(text: str) -> None:
+    """Check the activity name again as the old activity callback did."""
+    re.match(r'^([a-zA-Z]|\s|\d){1,50}$', text.capitalize())
+
+
+def get_regex_states() -> dict[int, tuple[list[BaseHandler], Callable]]:
+    """Get the old cascaded Regex handlers and callback parsing by state."""
+    callback = main.invalid_input
+    navigation = ~filters.Regex(r'^(/end|Manage database|/database)$')
+    return {
+        main.DB_MANAGE: (
+            [
+                MessageHandler(
+                    filters.Regex(
+                        r'^(Create database|Delete database|Delete last record'
+                        r'|Cancel)$',
+                    ),
+                    callback,
+                ),
+                MessageHandler(~filters.Regex('^(/end)$'), callback),
+            ],
+            lambda text: None,
+        ),
+        main.DB_ACTIVITY: (
+            [
+                MessageHandler(
+                    filters.Regex(
+                        r'^(Default|Cancel|([a-zA-Z]|\s|\d){1,50})$',
+                    ),
+                    callback,
+                ),
+                MessageHandler(~filters.Regex('^(/end)$'), callback),
+            ],
+            reparse_activity,
+        ),
+        main.MAIN: (
+            [
+                MessageHandler(
+                    filters.Regex(
+                        r'^(Status|Reminder(:\s(On|Off))?|'
+                        r'Graph(\s(week|month|year))?|Heatmap|Activities|'
+                        r'(New activity|Track)\s([a-zA-Z]|\s|\d){1,50}|'
+                        r'Add record(\s\d{2}.\d{2}.\d{4}\s\d{2}:\d{2})?)$',
+                    ),
+                    callback,
+                ),
+                MessageHandler(navigation, callback),
+            ],
+            reparse_main,
+        ),
+        main.REMINDER: (
+            [
+                MessageHandler(
+                    filters.Regex(r'^(Set(\s\d{1,2})?|Unset|Cancel)$'),
+                    callback,
+                ),
+                MessageHandler(navigation, callback),
+            ],
+            reparse_reminder,
+        ),
+    }
+
+
+def get_table_states() -> dict[int, tuple[list[BaseHandler], Callable]]:
+    """Get the command table handlers of the built application by state."""
+    application = main.build_application(request=FakeRequest())
+    conversation = next(
+        handler
+        for handler in application.handlers[0]
+        if isinstance(handler, ConversationHandler)
+    )
+    return {
+        state: (conversation.states[state], lambda text: None)
+        for state in MESSAGES
+    }
+
+
+def dispatch(
+    handlers: list[BaseHandler],
+    reparse: Callable[[str], None],
+    update: Update,
+) -> None:
+    """Find the handler of the update as the conversation does."""
+    for handler in handlers:
+        if handler.check_update(update):
+            if handler is handlers[0]:
+                reparse(update.effective_message.text)
+            return
+
+
+def run_state(
+    handlers: list[BaseHandler],
+    reparse: Callable[[str], None],
+    updates: list[Update],
+    rounds: int,
+) -> float:
+    """Get the median dispatch time in seconds per update."""
+    times = []
+    for _ in range(rounds):
+        for update in updates:
+            started = time.perf_counter()
+            dispatch(handlers, reparse, update)
+            times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main_cli() -> None:
+    """Parse the arguments and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rounds', type=int, default=5000)
+    args = parser.parse_args()
+    bot = main.build_application(request=FakeRequest()).bot
+    modes = {'regex': get_regex_states(), 'table': get_table_states()}
+    state_names = {
+        main.DB_MANAGE: 'DB_MANAGE',
+        main.DB_ACTIVITY: 'DB_ACTIVITY',
+        main.MAIN: 'MAIN',
+        main.REMINDER: 'REMINDER',
+    }
+    print(f'{"state":<14}{"regex us":>10}{"table us":>10}{"speedup":>9}')
+    for state, texts in MESSAGES.items():
+        updates = [
+            Update.de_json(make_update(number, 1, text), bot)
+            for number, text in enumerate(texts, 1)
+        ]
+        regex_time, table_time = (
+            run_state(*modes[mode][state], updates, args.rounds)
+            for mode in ('regex', 'table')
+        )
+        print(
+            f'{state_names[state]:<14}{regex_time * 1e6:>10.2f}'
+            f'{table_time * 1e6:>10.2f}{regex_time / table_time:>8.1f}x',
+        )
+
+
+if __name__ == '__main__':
+    main_cli()
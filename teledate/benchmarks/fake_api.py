@@ -0,0 +1,193 @@
+"""
+Stand-ins for the Telegram Bot API.
+
+`FakeRequest` answers the Bot API calls in-process, `FakeBotApi` is a local
+HTTP server for benchmarks that need the real HTTP client.
+"""
+import asyncio
+import itertools
+import json
+import re
+import time
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Teledate',
+    'username': 'teledate_bot',
+}
+
+
+class FakeRequest(BaseRequest):
+    """Answer the Bot API calls without the network."""
+
+    def __init__(self) -> None:
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> float | None:
+        """Read timeout is not used."""
+        return None
+
+    async def initialize(self) -> None:
+        """Nothing to initialize."""
+
+    async def shutdown(self) -> None:
+        """Nothing to shut down."""
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        *args,
+        **kwargs,
+    ) -> tuple[int, bytes]:
+        """Get the Bot API method result."""
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+        result = api_result(endpoint, params, next(self._message_ids))
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class FakeBotApi:
+    """Local HTTP server answering the Bot API calls."""
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.calls: dict[str, int] = {}
+        self.connections = 0
+        self.updates: asyncio.Queue[dict] = asyncio.Queue()
+        self.server: asyncio.Server | None = None
+        self._message_ids = itertools.count(1)
+
+    @property
+    def base_url(self) -> str:
+        """Bot API base URL to use with the application builder."""
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}/bot'
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Start the server, on a free port by default."""
+        self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self) -> None:
+        """Stop the server."""
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self.connections += 1
+        try:
+            while request_line := await reader.readline():
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)),
+                )
+                endpoint = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+                params = parse_params(headers.get('content-type', ''), body)
+                if endpoint == 'getUpdates':
+                    result = await self._get_updates(params)
+                else:
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    result = api_result(
+                        endpoint,
+                        params,
+                        next(self._message_ids),
+                    )
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Content-Length: %d\r\n\r\n%s' % (len(payload), payload),
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        """Wait for the pushed updates up to the long polling timeout."""
+        updates = []
+        try:
+            updates.append(
+                await asyncio.wait_for(
+                    self.updates.get(),
+                    float(params.get('timeout') or 0) or 0.01,
+                ),
+            )
+        except asyncio.TimeoutError:
+            return updates
+        limit = int(params.get('limit') or 100)
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    """Get the Bot API call parameters from the request body."""
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(parse_qsl(body.decode()))
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        # Files are skipped, only the chat is needed for the answer
+        chat_id = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+        return {'chat_id': chat_id.group(1).decode()} if chat_id else {}
+    return {}
+
+
+def api_result(endpoint: str, params: dict, message_id: int) -> object:
+    """Get a plausible result of the Bot API method."""
+    if endpoint == 'getMe':
+        return BOT_USER
+    if endpoint == 'getUpdates':
+        return []
+    if endpoint.startswith('send') or endpoint.startswith('edit'):
+        return {
+            'message_id': params.get('message_id', message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 1)), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+    return True
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    """Get the Bot API update with a private text message."""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {
+            'id': user_id,
+            'is_bot': False,
+            'first_name': 'User',
+            'username': f'user{user_id}',
+        },
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [
+            {
+                'type': 'bot_command',
+                'offset': 0,
+                'length': len(text.split()[0]),
+            },
+        ]
+    return {'update_id': update_id, 'message': message}
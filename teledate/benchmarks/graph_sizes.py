@@ -0,0 +1,83 @@
+"""
+Benchmark of the graph image sizes and render times of the render profiles.
+
+Each graph kind is rendered from synthetic records with every profile, the
+output shows the median render time, the image bytes, the chosen format and
+whether the image fits the profile budget.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.graph_sizes --runs 5
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import statistics
+import sys
+import time
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import utils  # noqa: E402
+
+START = datetime.datetime(2000, 1, 1)
+
+
+def get_figures(records: int) -> dict:
+    """Get the figure builders by the graph kind."""
+    rng = random.Random(0)
+    records_dt = sorted(
+        START + datetime.timedelta(minutes=rng.randrange(60 * 24 * 90))
+        for _ in range(records)
+    )
+    buckets = [
+        (START.date() + datetime.timedelta(days=day), rng.randrange(10))
+        for day in range(30)
+    ]
+    matrix = [[rng.randrange(20) for _ in range(24)] for _ in range(7)]
+    return {
+        'line': lambda profile: utils.get_graph(records_dt, profile=profile),
+        'buckets': lambda profile: utils.get_buckets_graph(
+            buckets,
+            profile=profile,
+        ),
+        'heatmap': lambda profile: utils.get_heatmap(matrix, profile=profile),
+    }
+
+
+async def run(args: argparse.Namespace) -> None:
+    """Render each graph kind with each profile."""
+    print(
+        f'{"graph":<10}{"profile":<10}{"ms":>8}{"bytes":>9}'
+        f'{"budget":>9}  format',
+    )
+    for kind, render in get_figures(args.records).items():
+        for name, settings in utils.RENDER_PROFILES.items():
+            times = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                graph = await render(name)
+                times.append(time.perf_counter() - started)
+            size = len(graph.data)
+            print(
+                f'{kind:<10}{name:<10}'
+                f'{statistics.median(times) * 1000:>8.1f}'
+                f'{size:>9}{settings.budget:>9}  {graph.image_format}'
+                f'{"" if size <= settings.budget else " (over)"}',
+            )
+
+
+def main() -> int:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--records', type=int, default=500)
+    args = parser.parse_args()
+    utils.load_pyplot()
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Synthetic load test of the bot conversation.
+
+Virtual users walk the conversation states (DB -> DB_ACTIVITY -> MAIN ->
+REMINDER) through the application built by `main.build_application`, which
+calls the local fake Bot API server over HTTP.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.load --users 2000 --concurrency 200
+    python -m teledate.benchmarks.load --db-url mysql+asyncmy://u:p@host/db
+
+The database at `--db-url` is dropped and re-created, use a scratch one.
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from teledate.benchmarks.fake_api import FakeBotApi, make_update  # noqa
+
+SCENARIO = (
+    '/database',
+    'Create database',
+    'Default',
+    'Status',
+    'Add record',
+    'Status',
+    'Reminder: Off',
+    'Set 24',
+    'Reminder: On',
+    'Unset',
+    '/end',
+)
+GRAPH_STEP = 'Graph'
+
+
+class LoadStats:
+    """Latencies of the handled updates by the message text."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors = 0
+
+    def report(self, elapsed: float) -> str:
+        """Get the throughput and the latency percentiles."""
+        total = sum(map(len, self.latencies.values()))
+        lines = [
+            f'{total} updates in {elapsed:.2f} s: '
+            f'{total / elapsed:.1f} updates/s, {self.errors} errors',
+            f'{"step":<16}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}'
+            f'{"p99 ms":>10}',
+        ]
+        every_step = list(itertools.chain(*self.latencies.values()))
+        for step, latencies in [*self.latencies.items(), ('all', every_step)]:
+            if len(latencies) < 2:
+                continue
+            cut_points = statistics.quantiles(latencies, n=100)
+            lines.append(
+                f'{step:<16}{len(latencies):>8}'
+                f'{cut_points[49] * 1000:>10.1f}'
+                f'{cut_points[94] * 1000:>10.1f}'
+                f'{cut_points[98] * 1000:>10.1f}',
+            )
+        return '\n'.join(lines)
+
+
+def user_steps(user_id: int, graph_every: int) -> tuple[str, ...]:
+    """Get the user scenario, every Nth user also requests a graph."""
+    if graph_every and user_id % graph_every == 0:
+        return SCENARIO[:4] + (GRAPH_STEP,) + SCENARIO[4:]
+    return SCENARIO
+
+
+async def virtual_user(
+    application: Application,
+    user_id: int,
+    steps: tuple[str, ...],
+    update_ids: itertools.count,
+    stats: LoadStats,
+    limit: asyncio.Semaphore,
+) -> None:
+    """Walk the conversation as the user, one update at a time."""
+    async with limit:
+        for text in steps:
+            update = Update.de_json(
+                make_update(next(update_ids), user_id, text),
+                application.bot,
+            )
+            started = time.perf_counter()
+            await application.process_update(update)
+            stats.latencies[text].append(
+                time.perf_counter() - started,
+            )
+
+
+async def run_load(args: argparse.Namespace, db_url: str) -> None:
+    """Run the virtual users against the scratch database."""
+    api = FakeBotApi(delay=args.api_delay)
+    await api.start()
+    db.init_engine(db_url)
+    db.USER_LIMIT = args.users
+    async with db.async_engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    application = main.build_application(base_url=api.base_url)
+    stats = LoadStats()
+
+    async def count_error(update: object, context) -> None:
+        stats.errors += 1
+
+    application.add_error_handler(count_error)
+    limit = asyncio.Semaphore(args.concurrency)
+    update_ids = itertools.count(1)
+    async with application:
+        await main.post_init(application)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                virtual_user(
+                    application,
+                    user_id,
+                    user_steps(user_id, args.graph_every),
+                    update_ids,
+                    stats,
+                    limit,
+                )
+                for user_id in range(1, args.users + 1)
+            ),
+        )
+        elapsed = time.perf_counter() - started
+        await main.post_shutdown(application)
+    await api.stop()
+    print(f'Backend: {db_url.split(":", 1)[0]}')
+    print(stats.report(elapsed))
+
+
+def main_cli() -> None:
+    """Parse the arguments and run the load test."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument(
+        '--graph-every',
+        type=int,
+        default=50,
+        help='every Nth user also requests a graph, 0 to skip graphs',
+    )
+    parser.add_argument(
+        '--api-delay',
+        type=float,
+        default=0.0,
+        help='seconds of the simulated Bot API latency',
+    )
+    parser.add_argument(
+        '--db-url',
+        help='scratch database URL, a temporary SQLite file by default',
+    )
+    args = parser.parse_args()
+    if args.db_url:
+        asyncio.run(run_load(args, args.db_url))
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(
+            run_load(args, f'sqlite+aiosqlite:///{Path(tmp_dir) / "load.db"}'),
+        )
+
+
+if __name__ == '__main__':
+    main_cli()
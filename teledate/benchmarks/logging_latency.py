@@ -0,0 +1,129 @@
+"""
+Handler latency benchmark with logging enabled.
+
+Handles `Status` updates with DEBUG logging written to a file directly from
+the event loop (`sync`), through the queue listener (`queue`) and without
+logging (`off`). Each run handles the warm-up updates unmeasured first, the
+runs are repeated with the modes in a shuffled order, so the drift of the
+process doesn't favor the mode run last.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.logging_latency --updates 2000 --repeats 5
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+import main  # noqa: E402
+from logs import LOG_DATEFMT, LOG_FORMAT, setup_logging  # noqa: E402
+from telegram import Update  # noqa: E402
+
+from teledate.benchmarks.fake_api import FakeRequest, make_update  # noqa
+
+MODES = ('off', 'sync', 'queue')
+
+
+def reset_logging() -> None:
+    """Remove all the root logger handlers."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+async def handle_updates(
+    mode: str,
+    updates: int,
+    warmup: int,
+    tmp_dir: Path,
+    run: int,
+) -> list:
+    """Get the latencies of handled `Status` updates in seconds."""
+    logfile = tmp_dir / f'{mode}.log'
+    listener = None
+    if mode == 'sync':
+        logging.basicConfig(
+            level=logging.DEBUG,
+            filename=logfile,
+            format=LOG_FORMAT,
+            datefmt=LOG_DATEFMT,
+        )
+    elif mode == 'queue':
+        listener = setup_logging(logfile, level='DEBUG', levels=[])
+    else:
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    db.init_engine(f'sqlite+aiosqlite:///{tmp_dir / f"{mode}.{run}.db"}')
+    application = main.build_application(request=FakeRequest())
+    latencies = []
+    try:
+        async with application:
+            await main.post_init(application)
+            user_id, _ = await db.create_user('user1')
+            await db.create_record(user_id)
+            texts = ['/start'] + ['Status'] * (warmup + updates)
+            for update_id, text in enumerate(texts, 1):
+                update = Update.de_json(
+                    make_update(update_id, 1, text),
+                    application.bot,
+                )
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+            await main.post_shutdown(application)
+    finally:
+        db.async_engine = None
+        reset_logging()
+        if listener is not None:
+            listener.stop()
+    return latencies[1 + warmup:]
+
+
+def main_cli() -> None:
+    """Run the benchmark and print latency percentiles."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=200,
+        help='unmeasured updates handled first in each run',
+    )
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    latencies = {mode: [] for mode in MODES}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for run in range(args.repeats):
+            for mode in rng.sample(MODES, len(MODES)):
+                latencies[mode] += asyncio.run(
+                    handle_updates(
+                        mode,
+                        args.updates,
+                        args.warmup,
+                        Path(tmp_dir),
+                        run,
+                    ),
+                )
+        for mode in MODES:
+            quantiles = statistics.quantiles(latencies[mode], n=100)
+            print(
+                f'{mode:>5}: '
+                f'p50 {quantiles[49] * 1000:.3f} ms, '
+                f'p95 {quantiles[94] * 1000:.3f} ms, '
+                f'p99 {quantiles[98] * 1000:.3f} ms',
+            )
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,150 @@
+"""
+Replay of the captured updates.
+
+Feeds the updates captured with `CAPTURE_FILE` to the handlers against a
+scratch database and the local fake Bot API server, keeping the order of
+each user's updates. Prints the handlers and database latencies.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.replay teledate/data/capture.gz --speed 10
+"""
+import argparse
+import asyncio
+import datetime
+import tempfile
+import time
+from pathlib import Path
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+from capture import read_capture  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from teledate.benchmarks.fake_api import FakeBotApi  # noqa: E402
+
+
+def get_username(update: dict) -> str | None:
+    """Get the username of the update sender."""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            return update[kind].get('from', {}).get('username')
+    return None
+
+
+async def seed_users(usernames: set[str], records: int) -> None:
+    """Create the captured users with records, as in the live database."""
+    now = datetime.datetime.utcnow()
+    for username in sorted(usernames):
+        user_id, _ = await db.create_user(username)
+        for days_ago in range(records, 0, -1):
+            await db.create_record(
+                user_id,
+                now - datetime.timedelta(days=days_ago),
+            )
+
+
+async def replay(
+    application: Application,
+    entries: list[tuple[float, dict]],
+    speed: float,
+) -> None:
+    """Handle the updates at their captured times divided by the speed."""
+    user_tasks: dict[str | None, asyncio.Task] = {}
+
+    async def handle(previous: asyncio.Task | None, update: Update) -> None:
+        if previous is not None:
+            await previous
+        await application.process_update(update)
+
+    started = time.monotonic()
+    first_t = entries[0][0] if entries else 0.0
+    for t, data in entries:
+        if speed:
+            delay = (t - first_t) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        username = get_username(data)
+        user_tasks[username] = asyncio.create_task(
+            handle(
+                user_tasks.get(username),
+                Update.de_json(data, application.bot),
+            ),
+        )
+    await asyncio.gather(*user_tasks.values())
+
+
+async def run_replay(args: argparse.Namespace, db_url: str) -> None:
+    """Replay the capture against the scratch database."""
+    entries = list(read_capture(args.capture))
+    usernames = {get_username(data) for _, data in entries} - {None}
+    api = FakeBotApi(delay=args.api_delay)
+    await api.start()
+    db.init_engine(db_url)
+    db.USER_LIMIT = len(usernames) + args.extra_users
+    async with db.async_engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    application = main.build_application(base_url=api.base_url)
+    async with application:
+        await main.post_init(application)
+        if args.seed_records >= 0:
+            await seed_users(usernames, args.seed_records)
+        metrics.REGISTRY.clear()
+        started = time.perf_counter()
+        await replay(application, entries, args.speed)
+        elapsed = time.perf_counter() - started
+        await main.post_shutdown(application)
+    await api.stop()
+    print(
+        f'{len(entries)} updates of {len(usernames)} users '
+        f'replayed in {elapsed:.2f} s',
+    )
+    print(metrics.REGISTRY.report())
+
+
+def main_cli() -> None:
+    """Parse the arguments and replay the capture."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('capture', type=Path)
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=1.0,
+        help='time compression factor, 0 for the max speed',
+    )
+    parser.add_argument(
+        '--seed-records',
+        type=int,
+        default=10,
+        help='records per pre-created user, -1 to not pre-create users',
+    )
+    parser.add_argument(
+        '--extra-users',
+        type=int,
+        default=100,
+        help='users quota above the captured users number',
+    )
+    parser.add_argument('--api-delay', type=float, default=0.0)
+    parser.add_argument(
+        '--db-url',
+        help='scratch database URL, a temporary SQLite file by default',
+    )
+    args = parser.parse_args()
+    if args.db_url:
+        asyncio.run(run_replay(args, args.db_url))
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(
+            run_replay(
+                args,
+                f'sqlite+aiosqlite:///{Path(tmp_dir) / "replay.db"}',
+            ),
+        )
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,100 @@
+"""
+Benchmark of the user sessions memory and the idle sessions sweep time.
+
+The user data of the distinct users is filled as the dictionaries the
+handlers used to keep and as the slotted user sessions, the output shows the
+traced memory of each. Then the idle half of the sessions is dropped by the
+sweep job.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.sessions --users 1000000
+"""
+import argparse
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Callable
+from types import SimpleNamespace
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import session as user_session  # noqa: E402
+
+
+def fill_dicts(user_data: defaultdict, user_id: int) -> None:
+    """Set the user data as the dictionary of the old handlers."""
+    data = user_data[user_id]
+    data['db_user_id'] = user_id
+    data['db_user_activity'] = f'Activity {user_id % 100}'
+    data['reminder'] = False
+
+
+def fill_sessions(user_data: defaultdict, user_id: int) -> None:
+    """Set the user data as the user session."""
+    data = user_data[user_id]
+    data.db_user_id = user_id
+    data.db_user_activity = f'Activity {user_id % 100}'
+    data.reminder = False
+
+
+def measure(factory: Callable, fill: Callable, users: int) -> tuple:
+    """Get the user data and its traced memory in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    user_data = defaultdict(factory)
+    for user_id in range(1, users + 1):
+        fill(user_data, user_id)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return user_data, size
+
+
+class FakeApplication:
+    """Application with the user data and its dropping only."""
+
+    def __init__(self, user_data: defaultdict) -> None:
+        self.user_data = user_data
+
+    def drop_user_data(self, user_id: int) -> None:
+        """Drop the user data as the application does."""
+        self.user_data.pop(user_id, None)
+
+
+def main() -> int:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=1_000_000)
+    args = parser.parse_args()
+    print(f'{"user data":<12}{"MB":>9}{"bytes/user":>12}')
+    for name, factory, fill in (
+        ('dict', dict, fill_dicts),
+        ('slots', user_session.UserSession, fill_sessions),
+    ):
+        user_data, size = measure(factory, fill, args.users)
+        print(f'{name:<12}{size / 2**20:>9.1f}{size / args.users:>12.1f}')
+        del user_data
+    user_data, _ = measure(
+        user_session.UserSession,
+        fill_sessions,
+        args.users,
+    )
+    # The odd users are idle for longer than the TTL
+    idle_since = time.monotonic() - user_session.SESSION_TTL - 1
+    for user_id in range(1, args.users + 1, 2):
+        user_data[user_id].last_seen = idle_since
+    context = SimpleNamespace(application=FakeApplication(user_data))
+    started = time.perf_counter()
+    asyncio.run(user_session.evict_idle_sessions(context))
+    print(
+        f'sweep: {args.users - len(user_data)} of {args.users} sessions '
+        f'dropped in {time.perf_counter() - started:.2f} sec',
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
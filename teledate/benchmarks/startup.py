@@ -0,0 +1,107 @@
+"""
+Bot startup time benchmark.
+
+Measures the cold import time of the bot module and the time from the
+interpreter start to the first handled update. Each run is a new process.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.startup --runs 5 --max-import 1.5
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+from teledate.benchmarks import APP_DIR  # noqa: E402
+
+IMPORT_CODE = (
+    'import time; started = time.perf_counter(); import sys; '
+    f'sys.path.insert(0, {str(APP_DIR)!r}); import main; '
+    'print(time.perf_counter() - started, "matplotlib" in sys.modules)'
+)
+
+
+async def first_update() -> float:
+    """Get the seconds from the interpreter start to the handled `/start`."""
+    import main
+    from telegram import Update
+
+    from teledate.benchmarks.fake_api import FakeRequest, make_update
+
+    request = FakeRequest()
+    application = main.build_application(request=request)
+    async with application:
+        await main.post_init(application)
+        await application.process_update(
+            Update.de_json(make_update(1, 1, '/start'), application.bot),
+        )
+        elapsed = time.perf_counter() - STARTED
+        await main.post_shutdown(application)
+    assert request.calls.get('sendMessage'), 'The update was not answered'
+    return elapsed
+
+
+def run(code_args: list[str], env: dict | None = None) -> str:
+    """Run the Python code in a new interpreter and get its output."""
+    return subprocess.run(
+        [sys.executable, *code_args],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    ).stdout.strip()
+
+
+def main() -> int:
+    """Run the benchmark and check the time budgets."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import', type=float, default=None)
+    parser.add_argument('--max-first-update', type=float, default=None)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(asyncio.run(first_update()))
+        return 0
+
+    import_times, first_update_times = [], []
+    matplotlib_loaded = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = os.environ | {
+            'MYSQL_URL': f'sqlite+aiosqlite:///{Path(tmp_dir) / "bench.db"}',
+            'PYTHONPATH': os.pathsep.join(sys.path),
+        }
+        for _ in range(args.runs):
+            import_time, loaded = run(['-c', IMPORT_CODE]).split()
+            import_times.append(float(import_time))
+            matplotlib_loaded |= loaded == 'True'
+            first_update_times.append(
+                float(run(['-m', __spec__.name, '--child'], env)),
+            )
+
+    results = {
+        'import_median_s': statistics.median(import_times),
+        'first_update_median_s': statistics.median(first_update_times),
+        'matplotlib_imported_eagerly': matplotlib_loaded,
+    }
+    print(json.dumps(results, indent=2))
+    failed = matplotlib_loaded
+    if args.max_import is not None:
+        failed |= results['import_median_s'] > args.max_import
+    if args.max_first_update is not None:
+        failed |= results['first_update_median_s'] > args.max_first_update
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+"""
+Microbenchmark of the Python overhead of the hot database queries.
+
+Each query is run as a construct built on every call (the old way) and as the
+prebuilt bound statement, with and without the engine's compiled cache. The
+time spent in the database driver is measured by the cursor execute events,
+the rest of the call time is the Python overhead of building, compiling and
+processing the results.
+
+Run from the repository root:
+
+    python -m teledate.benchmarks.statements --calls 2000
+"""
+import argparse
+import asyncio
+import datetime
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from teledate.benchmarks import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+from sqlalchemy import event, func, insert, select  # noqa: E402
+from sqlalchemy.sql import Executable  # noqa: E402
+
+USERS = 100
+RECORDS_PER_USER = 100
+START = datetime.datetime(2000, 1, 1)
+END = START + datetime.timedelta(days=30)
+
+
+def get_cases() -> dict[str, tuple[Callable[[int], Executable], Executable]]:
+    """Get the built per call and the prebuilt statements by the query."""
+    return {
+        'user_by_name': (
+            lambda user_id: select(db.User).where(
+                db.User.tenant == db.DEFAULT_TENANT,
+                db.User.name == f'user{user_id}',
+            ),
+            db.USER_BY_NAME,
+        ),
+        'last_record_date': (
+            lambda user_id: select(db.Record.date)
+            .where(
+                db.Record.user_id == user_id,
+                db.Record.activity_id.is_(None),
+            )
+            .order_by(db.Record.id.desc())
+            .limit(1),
+            db.LAST_RECORD_DATE,
+        ),
+        'records_range': (
+            lambda user_id: select(db.Record.date)
+            .where(
+                db.Record.user_id == user_id,
+                db.Record.activity_id.is_(None),
+                db.Record.date.between(START, END),
+            )
+            .order_by(db.Record.date),
+            db.RECORDS_RANGE,
+        ),
+        'records_buckets': (
+            lambda user_id: (
+                select(
+                    db.day_bucket(db.Record.date).label('bucket'),
+                    func.count(),
+                )
+                .where(
+                    db.Record.user_id == user_id,
+                    db.Record.activity_id.is_(None),
+                    db.Record.date.between(START, END),
+                )
+                .group_by('bucket')
+                .order_by('bucket')
+            ),
+            db.RECORDS_BUCKETS['day'],
+        ),
+    }
+
+
+def get_params(user_id: int) -> dict:
+    """Get the bound parameters of all the prebuilt statements."""
+    return {
+        'tenant': db.DEFAULT_TENANT,
+        'name': f'user{user_id}',
+        'user_id': user_id,
+        'activity_id': None,
+        'start': START,
+        'end': END,
+    }
+
+
+async def populate() -> None:
+    """Fill the empty tables with users and their records."""
+    async with db.async_engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+        await conn.run_sync(db.Base.metadata.create_all)
+        await conn.execute(
+            insert(db.User),
+            [
+                {'id': user_id, 'name': f'user{user_id}'}
+                for user_id in range(1, USERS + 1)
+            ],
+        )
+        await conn.execute(
+            insert(db.Record),
+            [
+                {
+                    'user_id': index % USERS + 1,
+                    'date': START + datetime.timedelta(hours=index // USERS),
+                }
+                for index in range(USERS * RECORDS_PER_USER)
+            ],
+        )
+
+
+def track_db_time(async_engine) -> list[float]:
+    """
+    Add up the cursor execute times of the engine.
+
+    Returns:
+        The list with the total seconds, reset it with `[0] = 0`.
+    """
+    db_time = [0.0]
+
+    @event.listens_for(async_engine.sync_engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, many):
+        context._bench_started = time.perf_counter()
+
+    @event.listens_for(async_engine.sync_engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, many):
+        db_time[0] += time.perf_counter() - context._bench_started
+
+    return db_time
+
+
+async def run_mode(
+    db_url: str,
+    calls: int,
+    cache_size: int,
+) -> dict[str, tuple[float, float]]:
+    """Get the median call and database times in seconds by the case."""
+    db.init_engine(db_url, query_cache_size=cache_size)
+    db_time = track_db_time(db.async_engine)
+    results = {}
+    for name, (build, prebuilt) in get_cases().items():
+        for kind in ('built', 'prebuilt'):
+            totals, db_times = [], []
+            for call in range(calls):
+                user_id = call % USERS + 1
+                db_time[0] = 0
+                started = time.perf_counter()
+                async with db.async_session() as session:
+                    if kind == 'built':
+                        result = await session.execute(build(user_id))
+                    else:
+                        result = await session.execute(
+                            prebuilt,
+                            get_params(user_id),
+                        )
+                    result.all()
+                totals.append(time.perf_counter() - started)
+                db_times.append(db_time[0])
+            results[f'{name}/{kind}'] = (
+                statistics.median(totals),
+                statistics.median(db_times),
+            )
+    await db.dispose_engine()
+    return results
+
+
+async def run(args: argparse.Namespace, tmp_dir: Path) -> None:
+    """Benchmark the statements with and without the compiled cache."""
+    db_url = args.db_url or f'sqlite+aiosqlite:///{tmp_dir / "bench.db"}'
+    db.init_engine(db_url)
+    await populate()
+    await db.dispose_engine()
+    print(
+        f'{"query":<28}{"cache":>6}{"call us":>10}'
+        f'{"db us":>10}{"python us":>11}',
+    )
+    for cache_size in (0, db.QUERY_CACHE_SIZE):
+        for name, (total, db_time) in (
+            await run_mode(db_url, args.calls, cache_size)
+        ).items():
+            print(
+                f'{name:<28}{"on" if cache_size else "off":>6}'
+                f'{total * 1e6:>10.0f}{db_time * 1e6:>10.0f}'
+                f'{(total - db_time) * 1e6:>11.0f}',
+            )
+
+
+def main() -> int:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument(
+        '--db-url',
+        help='scratch database URL, a temporary SQLite file by default',
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(run(args, Path(tmp_dir)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
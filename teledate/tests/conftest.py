@@ -0,0 +1,18 @@
+"""Shared test fixtures."""
+import pytest
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture()
+async def tmp_database(tmp_path):
+    """Fixture for the migrated database in the test's directory."""
+    db.init_engine(f'sqlite+aiosqlite:///{tmp_path / "teledate.db"}')
+    try:
+        await db.init_models()
+        yield
+    finally:
+        await db.dispose_engine()
+        db.init_engine()
@@ -0,0 +1,135 @@
+"""Update capture tests."""
+import json
+from pathlib import Path
+
+from telegram import Update
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+import capture  # noqa: E402
+
+USER = {
+    'id': 1001,
+    'is_bot': False,
+    'first_name': 'Jane',
+    'last_name': 'Doe',
+    'username': 'janedoe',
+    'language_code': 'en',
+}
+FORWARDED_USER = {
+    'id': 2002,
+    'is_bot': False,
+    'first_name': 'John',
+    'last_name': 'Smith',
+    'username': 'johnsmith',
+}
+CHAT = {
+    'id': 1001,
+    'type': 'private',
+    'first_name': 'Jane',
+    'last_name': 'Doe',
+    'username': 'janedoe',
+}
+
+
+def get_message_update(update_id: int, **message) -> dict:
+    """Get the update dictionary of the user's private message."""
+    return Update.de_json(
+        {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': 1700000000,
+                'chat': CHAT,
+                'from': USER,
+                **message,
+            },
+        },
+        None,
+    ).to_dict()
+
+
+def get_dump(recorder: capture.UpdateRecorder, update: dict) -> str:
+    """Get the anonymized update as its captured JSON."""
+    return json.dumps(recorder.anonymize(update), ensure_ascii=False)
+
+
+def test_anonymize_forwarded_message():
+    """Test the forward origin user is anonymized as the sender."""
+    recorder = capture.UpdateRecorder(Path('unused'), key='test')
+    update = get_message_update(
+        1,
+        text='Status',
+        forward_origin={
+            'type': 'user',
+            'date': 1690000000,
+            'sender_user': FORWARDED_USER,
+        },
+    )
+    dump = get_dump(recorder, update)
+    for value in ('Jane', 'Doe', 'janedoe', 'John', 'Smith', 'johnsmith'):
+        assert value not in dump
+    for user_id in ('1001', '2002'):
+        assert user_id not in dump
+    message = recorder.anonymize(update)['message']
+    origin = message['forward_origin']['sender_user']
+    assert origin['id'] == recorder.anonymize_id(2002)
+    assert origin['first_name'] == 'User'
+    assert message['from']['id'] == recorder.anonymize_id(1001)
+    assert message['text'] == 'Status'
+
+
+def test_anonymize_hidden_forward_and_contact():
+    """Test the hidden sender name is hashed and the contact is dropped."""
+    recorder = capture.UpdateRecorder(Path('unused'), key='test')
+    update = get_message_update(
+        2,
+        contact={
+            'phone_number': '+15550100',
+            'first_name': 'John',
+            'last_name': 'Smith',
+            'user_id': 2002,
+        },
+        forward_origin={
+            'type': 'hidden_user',
+            'date': 1690000000,
+            'sender_user_name': 'John Smith',
+        },
+    )
+    dump = get_dump(recorder, update)
+    for value in ('+15550100', 'John', 'Smith', '2002'):
+        assert value not in dump
+    message = recorder.anonymize(update)['message']
+    assert 'contact' not in message
+    assert message['forward_origin']['sender_user_name'] == (
+        recorder.anonymize_username('John Smith')
+    )
+
+
+def test_anonymize_new_chat_members_and_user_id():
+    """Test the lists of users and the user IDs are anonymized."""
+    recorder = capture.UpdateRecorder(Path('unused'), key='test')
+    data = {
+        'new_chat_members': [FORWARDED_USER],
+        'left_chat_member': USER,
+        'users_shared': {'users': [{'user_id': 2002}]},
+    }
+    dump = get_dump(recorder, data)
+    for value in ('John', 'Jane', 'johnsmith', 'janedoe', '2002', '1001'):
+        assert value not in dump
+
+
+def test_recorder_writes_in_background(tmp_path):
+    """Test the recorded updates are written by the closing of the file."""
+    path = tmp_path / 'capture.gz'
+    recorder = capture.UpdateRecorder(path, key='test')
+    update = Update.de_json(get_message_update(1, text='Status'), None)
+    recorder.record(update)
+    recorder.open()
+    for _ in range(3):
+        recorder.record(update)
+    recorder.close()
+    recorder.close()
+    entries = list(capture.read_capture(path))
+    assert len(entries) == 3
+    assert entries[0][1] == recorder.anonymize(update.to_dict())
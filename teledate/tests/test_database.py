@@ -1,10 +1,16 @@
 """Database tests."""
+import argparse
 import asyncio
 import datetime
 
 import pytest
+from sqlalchemy import inspect, select, text
 
-from teledate.app import database as db
+from teledate.tests import APP_DIR  # noqa: F401
+
+import admin  # noqa: E402
+import database as db  # noqa: E402
+import migrations  # noqa: E402
 
 
 @pytest.fixture(scope='module')
@@ -15,8 +21,14 @@ def event_loop():
     loop.close()
 
 
+@pytest.fixture(scope='module', autouse=True)
+def db_engine():
+    """Fixture for creating the database engine."""
+    db.init_engine()
+
+
 @pytest.fixture(autouse=True)
-async def db_init():
+async def db_init(db_engine):
     """Fixture for creating database."""
     async with db.async_engine.begin() as conn:
         await conn.run_sync(db.Base.metadata.drop_all)
@@ -153,6 +165,55 @@ async def test_get_user_records(record: dict):
     assert not records_dates
 
 
+async def test_get_user_records_range(user: dict):
+    """Test getting user records within the date range."""
+    for day in (1, 10, 20):
+        await db.create_record(user['id'], datetime.datetime(2000, 1, day))
+    records_dates: list = await db.get_user_records_range(
+        user['id'],
+        datetime.datetime(2000, 1, 5),
+        datetime.datetime(2000, 1, 25),
+    )
+    assert records_dates == [
+        datetime.datetime(2000, 1, 10),
+        datetime.datetime(2000, 1, 20),
+    ]
+
+
+async def test_get_user_records_buckets(user: dict):
+    """Test counting user records per Moscow Time day and week."""
+    for dt in (
+        datetime.datetime(2000, 1, 3, 10),
+        datetime.datetime(2000, 1, 3, 22),
+        datetime.datetime(2000, 1, 4, 12),
+    ):
+        await db.create_record(user['id'], dt)
+    start, end = datetime.datetime(2000, 1, 1), datetime.datetime(2000, 2, 1)
+    assert await db.get_user_records_buckets(user['id'], start, end) == [
+        (datetime.date(2000, 1, 3), 1),
+        (datetime.date(2000, 1, 4), 2),
+    ]
+    assert await db.get_user_records_buckets(
+        user['id'],
+        start,
+        end,
+        'week',
+    ) == [(datetime.date(2000, 1, 3), 3)]
+
+
+async def test_get_user_records_matrix(user: dict):
+    """Test counting user records per Moscow Time weekday and hour."""
+    # Sunday 22:30 UTC is Monday 01:30 MSK
+    await db.create_record(user['id'], datetime.datetime(2000, 1, 2, 22, 30))
+    await db.create_record(user['id'], datetime.datetime(2000, 1, 8, 12))
+    matrix = await db.get_user_records_matrix(user['id'])
+    assert len(matrix) == 7
+    assert all(len(row) == 24 for row in matrix)
+    assert matrix[0][1] == 1
+    assert matrix[5][15] == 1
+    assert sum(map(sum, matrix)) == 2
+
+
 async def test_get_last_user_record(record: dict):
     """Test getting the last user record."""
     record_date = await db.get_last_user_record(record['user_id'])
@@ -197,3 +258,378 @@ async def test_delete_user_nonexistent():
 async def test_delete_records_nonexistent_user():
     """Test deleting records of nonexistent user."""
     assert await db.delete_records(1) is False
+
+
+async def test_activities_last_records():
+    """Test the activities records are apart from the default ones."""
+    user_id, _ = await db.create_user('tester')
+    assert await db.create_activity(user_id, 'Running')
+    assert await db.create_activity(user_id, 'Running') is None
+    assert await db.track_activity(user_id, 'Swimming') is None
+    date, cleared = await db.track_activity(user_id, 'Running')
+    assert cleared is False
+    assert await db.get_last_user_record(user_id) is None
+    assert await db.get_activities_last_records(user_id) == [
+        ('Default', None),
+        ('Running', date),
+    ]
+
+
+async def test_track_activity_records_limit(monkeypatch):
+    """Test the oldest activity records beyond the limit are deleted."""
+    monkeypatch.setattr(db, 'RECORDS_LIMIT', 3)
+    user_id, _ = await db.create_user('tester')
+    await db.create_record(user_id, datetime.datetime(2000, 1, 1))
+    activity_id = await db.create_activity(user_id, 'Running')
+    cleared = [
+        (await db.track_activity(user_id, 'Running'))[1] for _ in range(5)
+    ]
+    assert cleared == [False, False, False, False, True]
+    assert len(await db.get_user_records(user_id, activity_id)) == 4
+    assert len(await db.get_user_records(user_id)) == 1
+    await db.delete_user(user_id)
+    assert await db.track_activity(user_id, 'Running') is None
+
+
+async def test_create_user_concurrent_quota(monkeypatch):
+    """Test concurrent sign-ups don't overshoot the users quota."""
+    monkeypatch.setattr(db, 'USER_LIMIT', 2)
+    created = await asyncio.gather(
+        *(db.create_user(f'tester{number}') for number in range(5)),
+    )
+    assert sum(user_id is not None for user_id, _ in created) == 2
+    assert await db.get_user_count() == 2
+    assert await db.is_quota_over() is True
+
+
+async def test_waitlist_admitted_after_delete(monkeypatch):
+    """Test the waitlisted user is created when a quota place is freed."""
+    monkeypatch.setattr(db, 'USER_LIMIT', 1)
+    user_id, _ = await db.create_user('tester')
+    assert await db.create_user('waiter', 'Running', 42) == (None, None)
+    assert await db.get_waitlist_position('waiter') == 1
+    assert await db.admit_from_waitlist() is None
+    assert await db.delete_user(user_id) is True
+    waiter_id, activity, chat_id = await db.admit_from_waitlist()
+    assert (activity, chat_id) == ('Running', 42)
+    assert await db.get_user_id('waiter') == (waiter_id, 'Running')
+    assert await db.get_waitlist_position('waiter') is None
+
+
+async def test_rollups_follow_records():
+    """Test the rollups are updated with the records and match a rebuild."""
+    user_id, _ = await db.create_user('tester')
+    start = datetime.datetime(2000, 1, 1, 10)
+    for hours in (0, 2, 30):
+        date = start + datetime.timedelta(hours=hours)
+        await db.create_record(user_id, date)
+    await db.create_activity(user_id, 'Running')
+    await db.track_activity(user_id, 'Running')
+    day = start.date()
+    today = db.get_day(datetime.datetime.utcnow())
+    assert await db.get_daily_records(day, today) == {
+        day: (1, 2),
+        day + datetime.timedelta(days=1): (1, 1),
+        today: (1, 1),
+    }
+    assert await db.get_interval_records() == [0, 1, 0, 1, 0, 0]
+    assert await db.delete_last_record(user_id) is True
+    assert await db.get_interval_records() == [0, 1, 0, 0, 0, 0]
+    daily = await db.get_daily_records(day, today)
+    intervals = await db.get_interval_records()
+    assert await db.rebuild_rollups(db.shards[0]) == 3
+    assert await db.get_daily_records(day, today) == daily
+    assert await db.get_interval_records() == intervals
+    assert await db.delete_user(user_id) is True
+    assert await db.get_daily_records(day, today) == {}
+    assert await db.get_interval_records() == [0] * 6
+
+
+async def test_rollups_not_negative_before_rebuild():
+    """Test deleting the records not counted in the rollups keeps them."""
+    user_id, _ = await db.create_user('tester')
+    async with db.async_session() as session:
+        async with session.begin():
+            for day in (1, 2, 3):
+                session.add(
+                    db.Record(
+                        user_id=user_id,
+                        date=datetime.datetime(2000, 1, day, 10),
+                    ),
+                )
+    await db.create_record(user_id, datetime.datetime(2000, 1, 4, 10))
+    assert await db.delete_last_record(user_id) is True
+    assert await db.delete_records(user_id) is True
+    assert await db.get_interval_records() == [0] * 6
+    assert await db.get_daily_records(
+        datetime.date(2000, 1, 1),
+        datetime.date(2000, 1, 5),
+    ) == {}
+
+
+async def test_events_read_after_cursor(monkeypatch):
+    """Test the changes are appended as events and read after the cursor."""
+    monkeypatch.setattr(db, 'EVENTS_SETTLE_SECONDS', 0)
+    user_id, _ = await db.create_user('tester')
+    await db.create_record(user_id, datetime.datetime(2000, 1, 1))
+    await db.create_record(user_id, datetime.datetime(2000, 1, 2))
+    assert await db.delete_last_record(user_id) is True
+    batches = [batch async for batch in db.iter_events(batch_size=2)]
+    assert [cursor for cursor, _ in batches] == [[2], [4]]
+    events = [event for _, batch in batches for event in batch]
+    assert [event['kind'] for event in events] == [
+        'user_created',
+        'record_created',
+        'record_created',
+        'records_deleted',
+    ]
+    assert events[0]['data'] == {'name': 'tester', 'activity': 'Default'}
+    assert events[3]['data']['dates'] == ['2000-01-02T00:00:00']
+    assert await db.delete_user(user_id) is True
+    batches = [batch async for batch in db.iter_events([4])]
+    assert len(batches) == 1
+    assert batches[0][0] == [5]
+    assert batches[0][1][0]['kind'] == 'user_deleted'
+    monkeypatch.setattr(db, 'EVENTS_SETTLE_SECONDS', 60)
+    assert [batch async for batch in db.iter_events()] == []
+
+
+async def test_bulk_deletes_write_events(monkeypatch):
+    """Test the pruned and the orphan records are written as events."""
+    monkeypatch.setattr(db, 'EVENTS_SETTLE_SECONDS', 0)
+    user_id, _ = await db.create_user('tester')
+    other_id, _ = await db.create_user('other')
+    for day in (1, 2, 3):
+        date = datetime.datetime(2000, 1, day)
+        await db.create_record(user_id, date)
+        await db.create_record(other_id, date)
+    args = argparse.Namespace(limit=1, batch_size=1)
+    await admin.prune(args)
+    async with db.async_engine.begin() as conn:
+        await conn.execute(text('DELETE FROM user_table WHERE id = 2'))
+    await admin.orphans(args)
+    async with db.async_session() as session:
+        dates = (await session.scalars(select(db.Record.date))).all()
+    assert dates == [datetime.datetime(2000, 1, 3)]
+    events = [
+        (event['user_id'], event['data']['dates'])
+        async for _, batch in db.iter_events()
+        for event in batch
+        if event['kind'] == 'records_deleted'
+    ]
+    assert events == [
+        (user_id, ['2000-01-01T00:00:00', '2000-01-02T00:00:00']),
+        (other_id, ['2000-01-01T00:00:00', '2000-01-02T00:00:00']),
+        (other_id, ['2000-01-03T00:00:00']),
+    ]
+
+
+async def test_tenants_users_apart(monkeypatch):
+    """Test the same username is a separate user with a quota per tenant."""
+    monkeypatch.setattr(db, 'USER_LIMIT', 1)
+    user_id, _ = await db.create_user('tester')
+    token = db.current_tenant.set('42')
+    try:
+        assert await db.get_user_id('tester') == (None, None)
+        other_id, _ = await db.create_user('tester')
+        assert other_id not in (None, user_id)
+        assert await db.get_user_id('tester') == (other_id, 'Default')
+        assert await db.get_user_count() == 1
+    finally:
+        db.current_tenant.reset(token)
+    assert await db.get_user_id('tester') == (user_id, 'Default')
+
+
+# Sharding tests
+
+
+def test_hash_ring_moves_keys_to_new_shard_only():
+    """Test adding a shard moves keys only to the new shard."""
+    keys = [f'user{number}' for number in range(1000)]
+    two_shards = db.HashRing(2)
+    three_shards = db.HashRing(3)
+    moved = [
+        key for key in keys if two_shards.get(key) != three_shards.get(key)
+    ]
+    assert all(three_shards.get(key) == 2 for key in moved)
+    assert 200 < len(moved) < 470
+
+
+def test_locate_user_first_shard_ids():
+    """Test the first shard user IDs are the global user IDs."""
+    assert db.locate_user(5) == (db.shards[0], 5)
+    assert db.to_global_id(0, 5) == 5
+
+
+async def get_shard_rollups(shard: db.Shard) -> list[set[tuple]]:
+    """Get the non-zero rollup rows of the shard."""
+    async with shard.session() as session:
+        return [
+            {
+                tuple(row)
+                for row in await session.execute(select(model.__table__))
+                if row[-1]
+            }
+            for model in (
+                db.DailyUserRecords,
+                db.DailyRecords,
+                db.IntervalRecords,
+            )
+        ]
+
+
+async def test_unmoved_user_found_while_rebalancing(tmp_path, monkeypatch):
+    """Test the other shards are looked up in the rebalancing mode only."""
+    urls = [
+        f'sqlite+aiosqlite:///{tmp_path / f"{index}.db"}' for index in (0, 1)
+    ]
+    db.init_engine(urls[0])
+    try:
+        await db.init_models()
+        await db.create_user('tester')
+        await db.dispose_engine()
+        db.init_engine(*urls)
+        await db.init_models()
+        # The first shard's user of a name placed in the second one
+        name = next(
+            f'user{number}'
+            for number in range(100)
+            if db.get_user_shard(f'user{number}') is db.shards[1]
+        )
+        async with db.shards[0].session() as session:
+            async with session.begin():
+                session.add(db.User(name=name))
+        assert await db.get_user_id(name) == (None, None)
+        monkeypatch.setattr(db, 'REBALANCING', True)
+        assert await db.get_user_id(name) == (2, 'Default')
+        progress = []
+        moved = await db.rebalance_shards(
+            on_progress=lambda shard, last_id: progress.append(
+                (shard.index, last_id),
+            ),
+        )
+        assert moved == 1
+        assert progress == [(0, 2), (1, 1)]
+        monkeypatch.setattr(db, 'REBALANCING', False)
+        assert (await db.get_user_id(name))[0] == db.to_global_id(1, 1)
+    finally:
+        await db.dispose_engine()
+        db.init_engine()
+
+
+async def test_rebalance_moves_rollups_events_quota(tmp_path, monkeypatch):
+    """Test the moved users keep the rollups, the quota and get events."""
+    monkeypatch.setattr(db, 'USER_LIMIT', 10)
+    monkeypatch.setattr(db, 'EVENTS_SETTLE_SECONDS', 0)
+    urls = [
+        f'sqlite+aiosqlite:///{tmp_path / f"{index}.db"}' for index in (0, 1)
+    ]
+    db.init_engine(urls[0])
+    try:
+        await db.init_models()
+        start = datetime.datetime(2000, 1, 1, 10)
+        for number in range(6):
+            user_id, _ = await db.create_user(f'user{number}')
+            for hours in (0, 5, 30):
+                date = start + datetime.timedelta(hours=hours + number)
+                await db.create_record(user_id, date)
+            await db.create_activity(user_id, 'Running')
+            await db.track_activity(user_id, 'Running')
+        today = db.get_day(datetime.datetime.utcnow())
+        daily = await db.get_daily_records(start.date(), today)
+        intervals = await db.get_interval_records()
+        await db.dispose_engine()
+        db.init_engine(*urls)
+        moved = await db.rebalance_shards()
+        assert moved
+        assert await db.get_daily_records(start.date(), today) == daily
+        assert await db.get_interval_records() == intervals
+        rollups = [await get_shard_rollups(shard) for shard in db.shards]
+        for shard in db.shards:
+            await db.rebuild_rollups(shard)
+        assert [
+            await get_shard_rollups(shard) for shard in db.shards
+        ] == rollups
+        events = [
+            event
+            async for _, batch in db.iter_events()
+            for event in batch
+            if event['kind'] == 'user_moved'
+        ]
+        assert len(events) == moved
+        assert {event['shard'] for event in events} == {1}
+        async with db.shards[0].session() as session:
+            quota = await session.get(db.Quota, db.USERS_QUOTA)
+        assert quota.used == 6
+    finally:
+        await db.dispose_engine()
+        db.init_engine()
+
+
+async def test_read_replica_after_write_window(tmp_path):
+    """Test the user reads own writes from the primary, then the replica."""
+    db.init_engine(
+        db.SHARD_URLS[0],
+        replica_urls=[f'sqlite+aiosqlite:///{tmp_path / "replica.db"}'],
+    )
+    try:
+        await db.init_models()
+        async with db.shards[0].replica_engine.begin() as conn:
+            await conn.run_sync(db.Base.metadata.create_all)
+        user_id, _ = await db.create_user('tester')
+        assert await db.get_user_id('tester') == (user_id, 'Default')
+        db.recent_writes.clear()
+        # The empty replica doesn't have the user
+        assert await db.get_user_id('tester') == (None, None)
+    finally:
+        await db.dispose_engine()
+        db.init_engine()
+
+
+# Migrations tests
+
+
+async def test_migrate_old_schema(tmp_path):
+    """Test an old version database is migrated once, keeping its rows."""
+    db.init_engine(f'sqlite+aiosqlite:///{tmp_path / "old.db"}')
+    try:
+        async with db.async_engine.begin() as conn:
+            for statement in (
+                'CREATE TABLE user_table (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(50) NOT NULL, activity VARCHAR(50) NOT NULL)',
+                'CREATE UNIQUE INDEX ix_user_table_name ON user_table (name)',
+                'CREATE TABLE record_table (id INTEGER PRIMARY KEY, '
+                'date DATETIME NOT NULL, user_id INTEGER NOT NULL '
+                'REFERENCES user_table (id))',
+                'CREATE TABLE waitlist_table (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(50) NOT NULL UNIQUE, activity VARCHAR(50) '
+                'NOT NULL, chat_id BIGINT NOT NULL)',
+                "INSERT INTO user_table VALUES (1, 'tester', 'Default')",
+                "INSERT INTO record_table VALUES (1, '2000-01-01', 1)",
+                "INSERT INTO waitlist_table VALUES "
+                "(1, 'waiter', 'Default', 42)",
+            ):
+                await conn.execute(text(statement))
+        assert await db.init_models() == {0: [1, 2, 3, 4, 5, 6]}
+        assert await db.init_models() == {0: []}
+        async with db.async_engine.connect() as conn:
+            indexes = await conn.run_sync(
+                lambda sync_conn: inspect(sync_conn).get_indexes('user_table'),
+            )
+            version = await conn.run_sync(migrations.get_version)
+        assert 'ix_user_table_name' not in {index['name'] for index in indexes}
+        assert version == migrations.LATEST_VERSION
+        assert await db.get_user_id('tester') == (1, 'Default')
+        assert await db.get_user_records(1) == [datetime.datetime(2000, 1, 1)]
+        assert await db.get_waitlist_position('waiter') == 1
+        day = datetime.date(2000, 1, 1)
+        assert await db.get_daily_records(day, day) == {day: (1, 1)}
+        token = db.current_tenant.set('42')
+        try:
+            user_id, _ = await db.create_user('tester')
+        finally:
+            db.current_tenant.reset(token)
+        assert user_id not in (None, 1)
+    finally:
+        await db.dispose_engine()
+        db.init_engine()
@@ -0,0 +1,107 @@
+"""Bot handlers tests."""
+import json
+
+import pytest
+from telegram import Update
+
+from teledate.benchmarks.fake_api import FakeRequest, make_update
+from teledate.tests import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+import main  # noqa: E402
+
+WAITLISTED_CHAT_ID = 99
+
+
+class ChatsRequest(FakeRequest):
+    """Answer the Bot API calls, the bot is blocked in the given chats."""
+
+    def __init__(self, blocked: set[int]) -> None:
+        super().__init__()
+        self.blocked = blocked
+        self.messages: list[tuple[int, str]] = []
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data=None,
+        *args,
+        **kwargs,
+    ) -> tuple[int, bytes]:
+        """Get the Bot API method result or the blocked chat error."""
+        if url.endswith('/sendMessage'):
+            params = request_data.parameters
+            chat_id = int(params['chat_id'])
+            self.messages.append((chat_id, params['text']))
+            if chat_id in self.blocked:
+                return 403, json.dumps(
+                    {
+                        'ok': False,
+                        'error_code': 403,
+                        'description': 'Forbidden: bot was blocked',
+                    },
+                ).encode()
+        return await super().do_request(
+            url,
+            method,
+            request_data,
+            *args,
+            **kwargs,
+        )
+
+
+@pytest.mark.parametrize('reachable', [True, False])
+async def test_waitlist_admitted_on_delete(
+    tmp_database,
+    monkeypatch,
+    reachable,
+):
+    """Test the waitlist head gets the freed place of the deleted user."""
+    monkeypatch.setattr(db, 'USER_LIMIT', 1)
+    await db.create_user('user7')
+    assert await db.join_waitlist('waiter', 'Running', WAITLISTED_CHAT_ID) == 1
+    request = ChatsRequest(set() if reachable else {WAITLISTED_CHAT_ID})
+    application = main.build_application(request=request)
+    errors = []
+
+    async def collect_error(update: object, context: main.Context) -> None:
+        errors.append(context.error)
+
+    application.add_error_handler(collect_error)
+    await application.initialize()
+    try:
+        for update_id, text in enumerate(
+            ['Manage database', 'Delete database', 'Manage database'],
+            1,
+        ):
+            await application.process_update(
+                Update.de_json(
+                    make_update(update_id, 7, text),
+                    application.bot,
+                ),
+            )
+    finally:
+        await application.shutdown()
+    assert errors == []
+    assert request.messages[1:3] == [
+        (7, 'Database has been deleted'),
+        (
+            WAITLISTED_CHAT_ID,
+            '*Database has been created*\n\n'
+            'A place of the quota is free, use /start to begin',
+        ),
+    ]
+    # The conversation is ended, so the next message starts a new one
+    assert request.messages[3][0] == 7
+    assert await db.get_user_id('user7') == (None, None)
+    assert (await db.get_user_id('waiter'))[1] == 'Running'
+    assert await db.get_waitlist_position('waiter') is None
+
+
+def test_workers_with_hosted_bots_exit(monkeypatch):
+    """Test the hosted bots aren't dropped silently by the workers mode."""
+    monkeypatch.setattr(main, 'WORKERS', 2)
+    monkeypatch.setattr(main, 'TELEGRAM_TOKENS', ['123:TEST'])
+    with pytest.raises(SystemExit, match='WORKERS'):
+        main.main()
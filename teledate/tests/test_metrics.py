@@ -0,0 +1,83 @@
+"""Metrics tests."""
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+import metrics  # noqa: E402
+
+
+@pytest.fixture()
+def registry(monkeypatch) -> metrics.Registry:
+    """Fixture for recording the metrics apart from the app ones."""
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    return registry
+
+
+async def test_engine_statements_and_connections(registry):
+    """Test the failed statements leave no start times on the connection."""
+    engine = create_async_engine('sqlite+aiosqlite://')
+    metrics.instrument_engine(engine)
+    metrics.instrument_engine(engine)
+    try:
+        async with engine.connect() as conn:
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    await conn.execute(text('SELECT * FROM missing_table'))
+            await conn.execute(text('SELECT 1'))
+            assert 'statement_started' not in conn.sync_connection.info
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+    finally:
+        await engine.dispose()
+    statements = registry.summaries[metrics.DB_STATEMENT_SECONDS]
+    assert statements[(('statement', 'SELECT'),)].count == 2
+    assert registry.summaries[metrics.DB_POOL_CONNECT_SECONDS][()].count == 1
+    assert registry.summaries[metrics.DB_POOL_CHECKOUT_SECONDS][()].count == 2
+
+
+async def test_pool_checkout_wait(registry, tmp_path):
+    """Test the wait for a connection of the pool at capacity is recorded."""
+    engine = create_async_engine(
+        f'sqlite+aiosqlite:///{tmp_path / "pool.db"}',
+        pool_size=1,
+        max_overflow=0,
+    )
+    metrics.instrument_engine(engine)
+
+    async def query() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+            waiting = asyncio.create_task(query())
+            await asyncio.sleep(0.2)
+            assert not waiting.done()
+        await waiting
+    finally:
+        await engine.dispose()
+    checkouts = registry.summaries[metrics.DB_POOL_CHECKOUT_SECONDS][()]
+    assert checkouts.count == 2
+    assert max(checkouts.samples) >= 0.2
+
+
+async def test_server_address_in_use():
+    """Test the endpoint is skipped if its port is taken."""
+    server = await asyncio.start_server(
+        lambda reader, writer: writer.close(),
+        metrics.METRICS_HOST,
+        0,
+    )
+    port = server.sockets[0].getsockname()[1]
+    try:
+        assert await metrics.start_server(port=port) is None
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,91 @@
+"""Commands router tests."""
+import datetime
+
+import pytest
+from telegram import Chat, Message, Update
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+from router import Command, CommandTable  # noqa: E402
+
+COMMANDS = CommandTable(
+    {
+        'Status': Command('status'),
+        'Graph week': Command('graph', 'week'),
+        'Add record': Command('add_record'),
+    },
+    {
+        'Track ': ('track', r'([a-zA-Z]|\s|\d){1,50}'),
+        'Add record ': ('add_record', r'\d{2}.\d{2}.\d{4}\s\d{2}:\d{2}'),
+    },
+)
+
+
+def make_update(text: str | None) -> Update:
+    """Get an update of the private chat message with the text."""
+    return Update(
+        1,
+        message=Message(
+            1,
+            datetime.datetime(2000, 1, 1),
+            Chat(1, Chat.PRIVATE),
+            text=text,
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    ('text', 'command'),
+    [
+        ('Status', Command('status')),
+        ('Graph week', Command('graph', 'week')),
+        ('Add record', Command('add_record')),
+    ],
+)
+def test_exact_commands(text, command):
+    """Test the whole message texts are looked up as commands."""
+    assert COMMANDS.parse(text) == command
+
+
+@pytest.mark.parametrize(
+    ('text', 'command'),
+    [
+        ('Track Running', Command('track', 'Running')),
+        ('Track swim 2', Command('track', 'swim 2')),
+        (
+            'Add record 01.01.2000 10:00',
+            Command('add_record', '01.01.2000 10:00'),
+        ),
+    ],
+)
+def test_prefixed_commands(text, command):
+    """Test the argument after the prefix is parsed with the command."""
+    assert COMMANDS.parse(text) == command
+
+
+@pytest.mark.parametrize(
+    'text',
+    [
+        'Track ',
+        'Track bad!name',
+        f'Track {"a" * 51}',
+        'Add record garbage',
+        'Add record 01.01.2000 10:00 extra',
+    ],
+)
+def test_prefixed_commands_invalid_argument(text):
+    """Test the prefixed commands with an invalid argument don't match."""
+    assert COMMANDS.parse(text) is None
+
+
+@pytest.mark.parametrize('text', ['status', 'Hello', 'Tracking', '', None])
+def test_other_messages_fall_through(text):
+    """Test the filter passes nothing for the messages of other commands."""
+    assert COMMANDS.check_update(make_update(text)) is None
+
+
+def test_filter_passes_command():
+    """Test the filter passes the parsed command to the callback context."""
+    assert COMMANDS.check_update(make_update('Track Running')) == {
+        'command': Command('track', 'Running'),
+    }
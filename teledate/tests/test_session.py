@@ -0,0 +1,94 @@
+"""User sessions tests."""
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, ApplicationBuilder, CallbackContext
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+import database as db  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+import session as user_session  # noqa: E402
+
+
+@pytest.fixture()
+def application() -> Application:
+    """Fixture for creating the application with the user sessions."""
+    return (
+        ApplicationBuilder()
+        .token('123:TEST')
+        .context_types(user_session.CONTEXT_TYPES)
+        .build()
+    )
+
+
+@pytest.fixture()
+async def db_user_id(tmp_database) -> int:
+    """Fixture for creating the database user of the test Telegram user."""
+    user_id, _ = await db.create_user('tester')
+    return user_id
+
+
+def make_update(text: str) -> Update:
+    """Get an update of the test user's message with the text."""
+    return Update(
+        1,
+        message=Message(
+            1,
+            datetime.datetime(2000, 1, 1),
+            Chat(7, Chat.PRIVATE),
+            from_user=User(7, 'Tester', False, username='tester'),
+            text=text,
+        ),
+    )
+
+
+async def test_idle_sessions_evicted(application, monkeypatch):
+    """Test the idle sessions are dropped and the active ones are kept."""
+    monkeypatch.setattr(metrics, 'REGISTRY', metrics.Registry())
+    idle = application.user_data[1]
+    idle.db_user_id = 1
+    idle.last_seen -= user_session.SESSION_TTL + 1
+    active = application.user_data[2]
+    active.db_user_id = 2
+    context = SimpleNamespace(application=application)
+    await user_session.evict_idle_sessions(context)
+    assert list(application.user_data) == [2]
+    assert application.user_data[2] is active
+    assert metrics.REGISTRY.counters[metrics.SESSIONS_EVICTED][()] == 1
+    await user_session.evict_idle_sessions(context)
+    assert list(application.user_data) == [2]
+
+
+async def test_session_reloaded_after_eviction(application, db_user_id):
+    """Test the next update loads the evicted session from the database."""
+    application.job_queue.run_repeating(
+        main.alarm,
+        3600,
+        name='tester',
+        data=(db_user_id, 'Default', '10:00'),
+    )
+    update = make_update('Status')
+    context = CallbackContext.from_update(update, application)
+    session = await main.get_session(update, context)
+    assert (session.db_user_id, session.db_user_activity) == (
+        db_user_id,
+        'Default',
+    )
+    assert session.reminder is True
+    session.last_seen -= user_session.SESSION_TTL + 1
+    await user_session.evict_idle_sessions(
+        SimpleNamespace(application=application),
+    )
+    assert 7 not in application.user_data
+    context = CallbackContext.from_update(update, application)
+    reloaded = await main.get_session(update, context)
+    assert reloaded is not session
+    assert (reloaded.db_user_id, reloaded.db_user_activity) == (
+        db_user_id,
+        'Default',
+    )
+    assert reloaded.reminder is True
@@ -0,0 +1,45 @@
+"""Graph rendering tests."""
+import pytest
+
+from teledate.tests import APP_DIR  # noqa: F401
+
+import utils  # noqa: E402
+
+
+def draw_figure():
+    """Draw a figure of the user's records per weekday and hour."""
+    return utils.draw_heatmap(
+        [[(day * hour) % 5 for hour in range(24)] for day in range(7)],
+        'Test',
+    )
+
+
+@pytest.fixture()
+def profiles(monkeypatch) -> dict:
+    """Fixture for the profiles with the full PNG encoded first."""
+    profiles = {
+        'fits': utils.RenderProfile(
+            dpi=72,
+            budget=1_000_000,
+            formats=('png', 'png8'),
+        ),
+        'over': utils.RenderProfile(dpi=72, budget=1, formats=('png', 'png8')),
+    }
+    monkeypatch.setattr(utils, 'RENDER_PROFILES', profiles)
+    return profiles
+
+
+def test_first_fitting_format_used(profiles):
+    """Test the cheap format fitting the budget wins over a smaller one."""
+    graph = utils.render_figure(draw_figure(), 'fits')
+    smallest = utils.render_figure(draw_figure(), 'over')
+    assert graph.image_format == 'png'
+    assert graph.filename == 'graph.png'
+    assert len(smallest.data) < len(graph.data) <= profiles['fits'].budget
+
+
+def test_smallest_format_used_over_budget(profiles):
+    """Test the smallest image is used if no format fits the budget."""
+    graph = utils.render_figure(draw_figure(), 'over')
+    assert graph.image_format == 'png8'
+    assert len(graph.data) > profiles['over'].budget